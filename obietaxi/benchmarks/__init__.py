@@ -0,0 +1,9 @@
+'''
+Benchmarks for Obietaxi. Run them from the project directory, e.g.:
+
+    python -m benchmarks.haversine
+    python -m benchmarks.run --offers 10000 --requests 10000
+
+benchmarks.run fills a local mongod with synthetic rides (see benchmarks.generator)
+and times the scenarios in benchmarks.scenarios against them.
+'''
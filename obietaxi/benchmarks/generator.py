@@ -0,0 +1,175 @@
+'''
+Generates synthetic users, RideOffers and RideRequests around Oberlin for the
+benchmarks in benchmarks.run. Rides go between a fixed set of places, leave at
+some time in the coming weeks and carry the same derived fields (time windows,
+routes, bounding boxes) that saving them through the site would give them.
+
+Everything is written to the local database DB_NAME and nowhere else.
+'''
+import os
+os.environ.setdefault( "DJANGO_SETTINGS_MODULE", "obietaxi.settings" )
+
+import math
+import random
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from mongoengine.connection import get_db
+from obietaxi import settings
+from obietaxi.mongo import register
+from mongoengine.django.auth import User
+from taxi.models import UserProfile, RideOffer, RideRequest, RideMatch, Location
+from taxi.helpers import route_boxes
+from taxi.views import _merge_boxes, ROUTE_BOX_DISTANCE
+
+DB_NAME = 'obietaxi_benchmark'
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+# Places rides go between
+#           name                            lat         lng
+PLACES = ( ("Oberlin College",              41.2939,    -82.2175),
+           ("IGA",                          41.293209,  -82.205519),
+           ("Walmart",                      41.266583,  -82.223344),
+           ("CVS Pharmacy",                 41.2847,    -82.2181),
+           ("Elyria",                       41.3684,    -82.1076),
+           ("Lorain",                       41.4528,    -82.1824),
+           ("Amherst",                      41.3978,    -82.2224),
+           ("Wellington",                   41.1689,    -82.2179),
+           ("Vermilion",                    41.4217,    -82.3646),
+           ("Sandusky",                     41.4489,    -82.7080),
+           ("Cleveland Airport",            41.410339,  -81.836167),
+           ("Downtown Cleveland",           41.4993,    -81.6944),
+           ("Akron",                        41.0814,    -81.5190),
+           ("Columbus",                     39.9612,    -82.9988),
+           ("Toledo",                       41.6528,    -83.5379),
+           ("Pittsburgh",                   40.4406,    -79.9959) )
+
+# Fuzziness values and how often people choose them
+FUZZINESS = ( ("1-hours", 40), ("2-hours", 20), ("3-hours", 10), ("4-hours", 5),
+              ("5-hours", 5), ("day", 10), ("week", 5), ("anytime", 5) )
+
+# Rides leave within this many days, on the quarter hour
+DAYS_AHEAD = 21
+# Ends of a ride are scattered this many degrees (about a km) around the place
+JITTER = 0.01
+# Documents are inserted this many at a time
+CHUNK_SIZE = 1000
+# Kilometres between the points of a generated route
+PATH_STEP = 2.0
+
+def connect( host='localhost', port=27017 ):
+    '''
+    Connects mongoengine to DB_NAME on a mongod running on this machine, instead of
+    the site's database. Any other host is refused, so that the benchmarks can never
+    write to a shared database.
+    '''
+    if host not in LOCAL_HOSTS:
+        raise ValueError( "The benchmarks only run against a local mongod, not %s"%host )
+    register( dict( settings.MONGODB, NAME=DB_NAME, HOST=host, PORT=port,
+                    USERNAME=None, PASSWORD=None ) )
+    return get_db()
+
+def clear():
+    ''' Drops the collections the generator fills '''
+    for cls in (User, UserProfile, RideOffer, RideRequest, RideMatch):
+        cls.drop_collection()
+
+def _path( start, end, rng ):
+    ''' A wandering path from <start> to <end>, both (lat,lng), standing in for a driving route '''
+    km = math.hypot( (end[0]-start[0])*111.2, (end[1]-start[1])*83.5 )
+    steps = max( int(km / PATH_STEP), 1 )
+    path = [start]
+    for i in xrange(1, steps):
+        t = float(i) / steps
+        # Roads don't run in straight lines
+        wobble = math.sin( t * math.pi ) * rng.uniform(-0.02, 0.02)
+        path.append( (start[0] + (end[0]-start[0])*t + wobble,
+                      start[1] + (end[1]-start[1])*t - wobble) )
+    path.append( end )
+    return path
+
+class RideGenerator( object ):
+    '''
+    Makes rides between PLACES. Routes are only worked out once for each pair of
+    places, since boxing and merging them is much slower than anything else here.
+    '''
+
+    def __init__( self, seed=0 ):
+        self.rng = random.Random( seed )
+        self.now = datetime.now().replace( second=0, microsecond=0 )
+        self._routes = {}
+        self._fuzziness = []
+        for value, weight in FUZZINESS:
+            self._fuzziness.extend( [value]*weight )
+
+    def route( self, start, end ):
+        ''' The simplified route polygon between places <start> and <end> '''
+        key = (start[0], end[0])
+        if key not in self._routes:
+            path = _path( start[1:], end[1:], random.Random(key) )
+            self._routes[key] = _merge_boxes( route_boxes(path, ROUTE_BOX_DISTANCE) )[1]
+        return self._routes[key]
+
+    def places( self ):
+        ''' Two different places '''
+        return self.rng.sample( PLACES, 2 )
+
+    def location( self, place ):
+        return Location( position=(place[1] + self.rng.uniform(-JITTER, JITTER),
+                                   place[2] + self.rng.uniform(-JITTER, JITTER)),
+                         title=place[0] )
+
+    def date( self ):
+        return self.now + timedelta( minutes=15*self.rng.randint(1, DAYS_AHEAD*24*4) )
+
+    def fuzziness( self ):
+        return self.rng.choice( self._fuzziness )
+
+    def users( self, count ):
+        ''' Inserts <count> users with profiles, and returns the profiles '''
+        profiles = []
+        for first in xrange(0, count, CHUNK_SIZE):
+            users = [User( id=ObjectId(), username="rider%d@obietaxi.com"%i,
+                           email="rider%d@obietaxi.com"%i, first_name="Rider", last_name=str(i),
+                           password="!", is_active=True )
+                     for i in xrange(first, min(first + CHUNK_SIZE, count))]
+            User.objects.insert( users, load_bulk=False )
+            chunk = [UserProfile( id=ObjectId(), user=user, phone_number="%010d"%i, active=True )
+                     for i, user in enumerate( users, first )]
+            UserProfile.objects.insert( chunk, load_bulk=False )
+            profiles.extend( chunk )
+        return profiles
+
+    def offer( self, driver ):
+        start, end = self.places()
+        offer = RideOffer( id=ObjectId(), driver=driver,
+                           start=self.location(start), end=self.location(end),
+                           date=self.date(), fuzziness=self.fuzziness(),
+                           message="Driving from %s to %s"%(start[0], end[0]),
+                           polygon=self.route(start, end) )
+        offer.derive()
+        return offer
+
+    def request( self, passenger ):
+        start, end = self.places()
+        req = RideRequest( id=ObjectId(), passenger=passenger,
+                           start=self.location(start), end=self.location(end),
+                           date=self.date(), fuzziness=self.fuzziness(),
+                           message="Looking for a ride from %s to %s"%(start[0], end[0]) )
+        req.derive()
+        return req
+
+    def _insert( self, cls, make, count, profiles ):
+        for first in xrange(0, count, CHUNK_SIZE):
+            rides = [make( self.rng.choice(profiles) )
+                     for i in xrange(first, min(first + CHUNK_SIZE, count))]
+            cls.objects.insert( rides, load_bulk=False )
+
+    def populate( self, offers, requests, users=None ):
+        '''
+        Fills the database with <offers> RideOffers and <requests> RideRequests posted
+        by <users> users (by default, one for every ten rides).
+        '''
+        users = users or max( (offers + requests) // 10, 1 )
+        profiles = self.users( users )
+        self._insert( RideOffer, self.offer, offers, profiles )
+        self._insert( RideRequest, self.request, requests, profiles )
@@ -0,0 +1,34 @@
+'''
+Compares calculating distances one offer at a time, with geospatial_distance,
+against the batch haversine, geospatial_distances.
+
+    python -m benchmarks.haversine
+'''
+import random
+import timeit
+from taxi.helpers import geospatial_distance, geospatial_distances
+
+SIZES = (1000, 10000, 100000)
+OBERLIN = (41.2939, -82.2175)
+
+def random_points( n ):
+    return [(OBERLIN[0] + random.uniform(-1, 1), OBERLIN[1] + random.uniform(-1, 1))
+            for i in range(n)]
+
+def best_of( func, repeat=3 ):
+    return min( timeit.repeat(func, number=1, repeat=repeat) )
+
+def main():
+    print( "%10s %14s %14s" % ("offers", "math loop", "batch") )
+    for n in SIZES:
+        # Start and end of every candidate offer, as in _offer_search
+        starts, ends = random_points(n), random_points(n)
+        req_start, req_end = random_points(1)[0], random_points(1)[0]
+        loop = best_of( lambda: ([geospatial_distance(p, req_start) for p in starts],
+                                 [geospatial_distance(p, req_end) for p in ends]) )
+        batch = best_of( lambda: (geospatial_distances(starts, req_start),
+                                  geospatial_distances(ends, req_end)) )
+        print( "%10d %12.2fms %12.2fms" % (n, loop*1000, batch*1000) )
+
+if __name__ == '__main__':
+    main()
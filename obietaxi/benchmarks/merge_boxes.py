@@ -0,0 +1,60 @@
+'''
+Times _merge_boxes on synthetic routes of 10 to 1,000 RouteBoxer boxes, against
+adding the boxes into the polygon one at a time.
+
+    python -m benchmarks.merge_boxes
+'''
+import os
+os.environ.setdefault( "DJANGO_SETTINGS_MODULE", "obietaxi.settings" )
+
+import random
+import timeit
+from Polygon.Shapes import Rectangle
+from taxi.views import _merge_boxes
+
+SIZES = (10, 30, 100, 300, 1000)
+OBERLIN = (41.2939, -82.2175)
+# Roughly the size of a 10 km RouteBoxer cell, in degrees
+BOX_SIZE = 0.09
+
+def route_boxes( n ):
+    '''
+    Boxes along a random route leaving Oberlin, in the format posted by points.js:
+    [ne.lat, ne.lng, sw.lat, sw.lng, ...]. Neighbouring boxes overlap.
+    '''
+    boxes = []
+    lat, lng = OBERLIN
+    for i in range(n):
+        height = BOX_SIZE * random.uniform(1, 3)
+        width = BOX_SIZE * random.uniform(1, 3)
+        boxes.extend( [lat + height, lng + width, lat, lng] )
+        # Move mostly east, sometimes north or south
+        lat += random.choice( (0, height/2, -BOX_SIZE/2) )
+        lng += width * random.uniform(0.5, 0.9)
+    return boxes
+
+def sequential_merge( boxes ):
+    ''' _merge_boxes as it was: one union per box, no simplification '''
+    bboxArea = None
+    for i in range(0,len(boxes),4):
+        theRect = Rectangle( abs(boxes[i] - boxes[i+2]),
+                             abs(boxes[i+1] - boxes[i+3]) )
+        theRect.shift( boxes[i+2], boxes[i+3] )
+        bboxArea = bboxArea + theRect if bboxArea else theRect
+    return bboxArea, [list(t) for t in bboxArea.contour( 0 )]
+
+def best_of( func, repeat=3 ):
+    return min( timeit.repeat(func, number=1, repeat=repeat) )
+
+def main():
+    print( "%8s %14s %14s %12s %12s" % ("boxes", "sequential", "cascaded", "vertices", "simplified") )
+    for n in SIZES:
+        boxes = route_boxes( n )
+        sequential = best_of( lambda: sequential_merge(boxes) )
+        cascaded = best_of( lambda: _merge_boxes(boxes) )
+        vertices = len( sequential_merge(boxes)[1] )
+        simplified = len( _merge_boxes(boxes)[1] )
+        print( "%8d %12.2fms %12.2fms %12d %12d" % (n, sequential*1000, cascaded*1000, vertices, simplified) )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+'''
+Runs the matching benchmarks against synthetic rides in a local mongod, and writes
+the timings as JSON so that runs from different releases can be compared:
+
+    python -m benchmarks.run --offers 100000 --requests 100000 --output results.json
+    python -m benchmarks.run --offers 100000 --requests 100000 --compare results.json
+
+With --compare, the run fails (exit status 1) when the median time of any scenario
+grew by more than --threshold over the earlier results.
+'''
+import os
+os.environ.setdefault( "DJANGO_SETTINGS_MODULE", "obietaxi.settings" )
+
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+from benchmarks import generator
+from benchmarks.scenarios import SCENARIOS
+
+def _revision():
+    ''' The git revision being benchmarked, if we can tell '''
+    try:
+        return subprocess.check_output( ["git", "rev-parse", "HEAD"] ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _stats( times ):
+    times = sorted( times )
+    middle = len(times) // 2
+    median = times[middle] if len(times) % 2 else (times[middle-1] + times[middle]) / 2
+    return { 'min_ms':times[0] * 1000,
+             'median_ms':median * 1000,
+             'mean_ms':sum(times) / len(times) * 1000,
+             'max_ms':times[-1] * 1000,
+             'repeat':len(times) }
+
+def run_scenarios( gen, repeat, names=None ):
+    ''' Times each scenario <repeat> times after one untimed warm-up call '''
+    results = {}
+    for scenario in SCENARIOS:
+        if names and scenario.__name__ not in names:
+            continue
+        func = scenario( gen )
+        func()
+        times = []
+        for i in xrange(repeat):
+            begin = time.time()
+            func()
+            times.append( time.time() - begin )
+        results[scenario.__name__] = _stats( times )
+        sys.stdout.write( "%-20s median %10.2fms   min %10.2fms\n"%(scenario.__name__,
+                                                                    results[scenario.__name__]['median_ms'],
+                                                                    results[scenario.__name__]['min_ms']) )
+    return results
+
+def compare( results, baseline, threshold ):
+    ''' Returns a message for each scenario whose median is more than <threshold> slower than in <baseline> '''
+    regressions = []
+    for name, stats in sorted( results.iteritems() ):
+        before = baseline.get( name )
+        if before and stats['median_ms'] > before['median_ms'] * (1 + threshold):
+            regressions.append( "%s: median %.2fms, was %.2fms"%(name, stats['median_ms'], before['median_ms']) )
+    return regressions
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description="Benchmarks ride matching on synthetic data" )
+    parser.add_argument( "--offers", type=int, default=1000, help="RideOffers to generate" )
+    parser.add_argument( "--requests", type=int, default=1000, help="RideRequests to generate" )
+    parser.add_argument( "--users", type=int, default=None, help="users to generate (default: one per ten rides)" )
+    parser.add_argument( "--repeat", type=int, default=20, help="timed calls per scenario" )
+    parser.add_argument( "--seed", type=int, default=0, help="seed for the generator" )
+    parser.add_argument( "--scenario", action="append", help="only run this scenario (may be repeated)" )
+    parser.add_argument( "--reuse", action="store_true", help="keep the rides from the last run instead of generating new ones" )
+    parser.add_argument( "--host", default="localhost", help="host of the local mongod" )
+    parser.add_argument( "--port", type=int, default=27017, help="port of the local mongod" )
+    parser.add_argument( "--output", help="file to write the results to, as JSON" )
+    parser.add_argument( "--compare", help="results of an earlier run to check for regressions" )
+    parser.add_argument( "--threshold", type=float, default=0.2,
+                         help="how much slower (0.2 = 20%%) a scenario may get before it counts as a regression" )
+    args = parser.parse_args( argv )
+
+    generator.connect( args.host, args.port )
+    gen = generator.RideGenerator( args.seed )
+    if not args.reuse:
+        generator.clear()
+        begin = time.time()
+        gen.populate( args.offers, args.requests, args.users )
+        sys.stdout.write( "Generated %d offers and %d requests in %.1fs\n"%(args.offers, args.requests,
+                                                                           time.time() - begin) )
+
+    output = { 'meta':{ 'date':datetime.now().isoformat(),
+                        'revision':_revision(),
+                        'python':platform.python_version(),
+                        'offers':args.offers,
+                        'requests':args.requests,
+                        'users':args.users,
+                        'seed':args.seed,
+                        'repeat':args.repeat },
+               'scenarios':run_scenarios( gen, args.repeat, args.scenario ) }
+
+    if args.output:
+        with open( args.output, "w" ) as f:
+            json.dump( output, f, indent=2, sort_keys=True )
+
+    if args.compare:
+        with open( args.compare ) as f:
+            baseline = json.load( f )
+        regressions = compare( output['scenarios'], baseline['scenarios'], args.threshold )
+        for regression in regressions:
+            sys.stdout.write( "REGRESSION %s\n"%regression )
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
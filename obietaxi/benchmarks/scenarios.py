@@ -0,0 +1,103 @@
+'''
+Timed scenarios for benchmarks.run. Each scenario is set up once against the
+generated data and returns a function doing one unit of work; consecutive calls
+cycle through different searches, so that no result is served twice from a cache.
+'''
+import re
+import json
+import itertools
+from django.test.client import Client
+from django.core.urlresolvers import reverse
+from taxi.models import RideOffer, RideRequest, UserProfile
+from taxi.encoders import RideOfferEncoder, RideRequestEncoder
+from taxi.helpers import route_boxes, render_message
+from taxi.spatial import RouteIndex
+from taxi.views import _offer_search, _request_search, _merge_boxes, ROUTE_BOX_DISTANCE
+from benchmarks.generator import PLACES, _path
+
+# How many different searches each scenario cycles through
+SEARCHES = 50
+# How many rides the encoder scenarios encode at a time
+ENCODE_COUNT = 500
+# The email rendered by the email scenarios, once for each passenger of a cancelled ride
+EMAIL_TEMPLATE = 'taxi/static/emails/driver_cancelled.txt'
+
+def offer_search( generator ):
+    ''' _offer_search for a request between two random places '''
+    searches = []
+    for i in xrange(SEARCHES):
+        start, end = generator.places()
+        searches.append( dict( start_lat=start[1], start_lng=start[2],
+                               end_lat=end[1], end_lng=end[2],
+                               date=generator.date(), fuzziness=generator.fuzziness() ) )
+    searches = itertools.cycle( searches )
+    return lambda: _offer_search( **next(searches) )
+
+def request_search( generator ):
+    ''' _request_search along the route between two random places '''
+    searches = []
+    for i in xrange(SEARCHES):
+        start, end = generator.places()
+        searches.append( dict( polygon=generator.route(start, end),
+                               date=generator.date(), fuzziness=generator.fuzziness() ) )
+    searches = itertools.cycle( searches )
+    return lambda: _request_search( **next(searches) )
+
+def merge_boxes( generator ):
+    ''' _merge_boxes on the RouteBoxer boxes for a route to Columbus, about 150 km '''
+    start, end = PLACES[0], PLACES[13]
+    boxes = route_boxes( _path(start[1:], end[1:], generator.rng), ROUTE_BOX_DISTANCE )
+    return lambda: _merge_boxes( boxes )
+
+def route_index_build( generator ):
+    ''' Loading a new route index from the database and searching it once '''
+    start, end = generator.places()
+    return lambda: RouteIndex().containing( start[1:], end[1:] )
+
+def browse( generator ):
+    ''' The browse page, rendered through the test client '''
+    client = Client()
+    url = reverse( 'browse' )
+    return lambda: client.get( url )
+
+def _encode( cls, encoder ):
+    rides = list( cls.objects.order_by('date')[:ENCODE_COUNT] )
+    return lambda: json.dumps( rides, cls=encoder )
+
+def encode_offers( generator ):
+    ''' RideOfferEncoder on ENCODE_COUNT offers already fetched '''
+    return _encode( RideOffer, RideOfferEncoder )
+
+def encode_requests( generator ):
+    ''' RideRequestEncoder on ENCODE_COUNT requests already fetched '''
+    return _encode( RideRequest, RideRequestEncoder )
+
+def _render_message_eval( filename, context ):
+    ''' render_message as it was before taxi/emails.py, for comparison '''
+    replacements = {}
+    with open( filename, "r" ) as input:
+        contents = input.read()
+        for match in re.finditer( "{{(.*?)}}", contents ):
+            replacements[match.group(1)] = eval( match.group(1), context )
+    newstring = None
+    for orig, new in replacements.iteritems():
+        newstring = (newstring or contents).replace( '{{%s}}'%orig, str(new) )
+    return newstring
+
+def _render_email( render ):
+    context = dict( offer=RideOffer.objects.order_by('date').first(),
+                    passenger=UserProfile.objects.first(),
+                    reason_msg="Something came up, sorry!" )
+    return lambda: render( EMAIL_TEMPLATE, context )
+
+def render_email( generator ):
+    ''' render_message on the email telling a passenger their ride was cancelled '''
+    return _render_email( render_message )
+
+def render_email_eval( generator ):
+    ''' The same, with the eval-based render_message it replaced '''
+    return _render_email( _render_message_eval )
+
+# Every scenario, in the order they are run
+SCENARIOS = ( offer_search, request_search, merge_boxes, route_index_build,
+              browse, encode_offers, encode_requests, render_email, render_email_eval )
@@ -3,8 +3,51 @@ Tests for the mongologin module.
 """
 
 from mongorunner import TestCase
+from mongoengine.django.auth import User
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from taxi.models import UserProfile
+from taxi.middleware import PROFILE_SESSION_KEY, LEGACY_PROFILE_SESSION_KEY
 
 class LoginTestCase(TestCase):
 
     def test_login(self):
         pass
+
+    def test_session_holds_profile_id(self):
+        '''Only the id of the profile goes into the session'''
+        user = User.create_user("jschm@obietaxi.com", "password")
+        user.is_active = True
+        user.save()
+        profile = UserProfile.objects.create(phone_number="1231231234", user=user)
+        try:
+            client = Client()
+            client.post(reverse('login'), {'username':"jschm@obietaxi.com", 'password':"password"})
+            self.assertEqual(client.session[PROFILE_SESSION_KEY], str(profile.id))
+            self.assertFalse('profile' in client.session)
+        finally:
+            profile.delete()
+            user.delete()
+
+    def test_legacy_session(self):
+        '''Sessions that hold the whole profile still work, and are moved to the profile id'''
+        user = User.create_user("jschm@obietaxi.com", "password")
+        user.is_active = True
+        user.save()
+        profile = UserProfile.objects.create(phone_number="1231231234", user=user)
+        try:
+            client = Client()
+            client.post(reverse('login'), {'username':"jschm@obietaxi.com", 'password':"password"})
+            session = client.session
+            del session[PROFILE_SESSION_KEY]
+            session[LEGACY_PROFILE_SESSION_KEY] = profile
+            session.save()
+
+            response = client.get(reverse('user_landing'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['profile'], profile)
+            self.assertEqual(client.session[PROFILE_SESSION_KEY], str(profile.id))
+            self.assertFalse(LEGACY_PROFILE_SESSION_KEY in client.session)
+        finally:
+            profile.delete()
+            user.delete()
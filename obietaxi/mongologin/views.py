@@ -10,6 +10,7 @@ from mongoengine.django.auth import User
 from random import choice
 from models import RegistrationStub, OpenidAuthStub
 from taxi.models import UserProfile
+from taxi.middleware import set_profile
 from taxi.helpers import _hostname, send_email, random_string, render_message
 import smtplib
 from obietaxi import settings
@@ -35,7 +36,7 @@ def login_view( request ):
                     user.backend = 'mongoengine.django.auth.MongoEngineBackend'
                     login( request, user )
                     # Put profile in the session
-                    request.session['profile'] = UserProfile.objects.get(user=user)
+                    set_profile( request, UserProfile.objects.get(user=user) )
                     return HttpResponseRedirect( reverse('user_landing' ) )
                 else:
                     return _fail_login( request, 'invalid login (note: you must Sign in with Google if that\'s how you signed up initially)' )
@@ -152,7 +153,7 @@ def google_login_success( request ):
         profile.save()
 
     # Store the profile in the session
-    request.session['profile'] = profile
+    set_profile( request, profile )
 
     # Get the user's phone number if they do not have one already registered
     if not profile.phone_number:
@@ -167,7 +168,7 @@ def google_register( request ):
         form = GoogleRegisterForm( request.POST )
         if form.is_valid():
             # Get the user's profile
-            profile = request.session.get("profile")
+            profile = request.profile
             # Store the phone number
             profile.phone_number = form.cleaned_data['phone']
             profile.save()
@@ -0,0 +1,69 @@
+'''
+Sets up the connection to MongoDB from the MONGODB setting.
+
+register() only records how to connect: mongoengine opens the connection the first
+time the database is used, so importing the project does no network I/O. Each
+process keeps its own pool of MAX_POOL_SIZE connections. A process forked after
+the connection was opened (as pre-forking WSGI servers do) must not share its
+parent's sockets, so MongoConnectionMiddleware checks which process it is running
+in and reconnects when that changes.
+'''
+import os
+from pymongo import ReadPreference
+from mongoengine.connection import register_connection, disconnect, DEFAULT_CONNECTION_NAME
+from mongoengine.base.common import _document_registry
+
+# Settings with defaults, and the keyword arguments to pymongo's MongoClient they become
+_CLIENT_OPTIONS = ( ('MAX_POOL_SIZE', 'max_pool_size', 10),
+                    ('CONNECT_TIMEOUT_MS', 'connectTimeoutMS', 5000),
+                    ('SOCKET_TIMEOUT_MS', 'socketTimeoutMS', None),
+                    ('WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS', None) )
+
+# The process that registered or last reset the connection
+_pid = None
+
+def register( options ):
+    '''
+    Records how to connect to the database described by <options>, a dictionary like
+    the MONGODB setting. Replaces any earlier connection.
+    '''
+    global _pid
+    kwargs = dict( (kwarg, options.get(name, default)) for name, kwarg, default in _CLIENT_OPTIONS )
+    kwargs = dict( (kwarg, value) for kwarg, value in kwargs.iteritems() if value is not None )
+    reset()
+    register_connection( DEFAULT_CONNECTION_NAME,
+                         name=options.get( 'NAME', 'obietaxi' ),
+                         host=options.get( 'HOST', 'localhost' ),
+                         port=options.get( 'PORT', 27017 ),
+                         username=options.get( 'USERNAME' ),
+                         password=options.get( 'PASSWORD' ),
+                         read_preference=getattr( ReadPreference, options.get('READ_PREFERENCE', 'primary').upper() ),
+                         **kwargs )
+    _pid = os.getpid()
+
+def reset():
+    '''
+    Drops the current connection, if any, so that the next use of the database
+    opens a new one
+    '''
+    disconnect( DEFAULT_CONNECTION_NAME )
+    # Documents hold on to the collection they were first used with
+    for cls in _document_registry.itervalues():
+        if getattr( cls, '_collection', None ) is not None:
+            cls._collection = None
+
+def ensure_connection():
+    ''' Reconnects if this process was forked from the one that connected '''
+    global _pid
+    if _pid != os.getpid():
+        reset()
+        _pid = os.getpid()
+
+class MongoConnectionMiddleware( object ):
+    '''
+    Makes sure each worker process uses its own connection to the database.
+    Must come before any middleware that uses the database (e.g. sessions).
+    '''
+    def process_request( self, request ):
+        ensure_connection()
+        return None
@@ -0,0 +1,195 @@
+'''
+Counts the MongoDB operations each request makes, and how long they take.
+
+pymongo 2.x has no hooks for watching the operations it sends, so install() wraps
+the few methods every operation goes through: Cursor._refresh (queries and getmores),
+Collection.insert/update/remove and Database.command (count, distinct, findAndModify...).
+Outside of a request the wrappers only look up a thread-local and call through.
+
+QueryStatsMiddleware keeps a tally for each request, adds it to totals for the view
+that served it, and logs requests that spent more than SLOW_REQUEST_MS in the
+database or made more than SLOW_REQUEST_OPERATIONS operations, along with the
+shapes of the queries they made. Configured by the MONGODB_STATS setting.
+'''
+import logging
+import threading
+import time
+from functools import wraps
+from pymongo.cursor import Cursor
+from pymongo.collection import Collection
+from pymongo.database import Database
+from obietaxi import settings
+
+logger = logging.getLogger( __name__ )
+
+_local = threading.local()
+_installed = False
+
+# view name --> [requests, operations, seconds]
+_view_totals = {}
+_view_lock = threading.Lock()
+
+# Query shapes listed for each slow request
+SHAPES_LOGGED = 10
+
+def query_shape( value ):
+    '''
+    <value>, a query or command, with the values left out, e.g.
+    {date: {$gte: ?}, driver: ?}. Queries that differ only in their values have
+    the same shape.
+    '''
+    if isinstance( value, dict ):
+        return "{%s}"%", ".join( "%s: %s"%(key, query_shape(value[key])) for key in value )
+    if isinstance( value, (list, tuple) ):
+        if value and isinstance( value[0], dict ):
+            return "[%s, ...]"%query_shape( value[0] )
+        return "[?]"
+    return "?"
+
+class RequestStats( object ):
+    ''' The operations made while serving one request '''
+
+    def __init__( self ):
+        self.operations = 0
+        self.seconds = 0.0
+        self.view = None
+        # (operation, collection, query, seconds) for each operation. Shapes are only
+        # worked out when the request is logged.
+        self.log = []
+
+    def record( self, operation, collection, query, seconds ):
+        self.operations += 1
+        self.seconds += seconds
+        self.log.append( (operation, collection, query, seconds) )
+
+    def shapes( self ):
+        '''
+        (count, seconds, description) for each kind of operation made, the ones that
+        took longest first
+        '''
+        shapes = {}
+        for operation, collection, query, seconds in self.log:
+            key = "%s %s %s"%(operation, collection, query_shape(query))
+            count, total = shapes.get( key, (0, 0.0) )
+            shapes[key] = (count + 1, total + seconds)
+        return sorted( ((count, total, key) for key, (count, total) in shapes.iteritems()), reverse=True,
+                       key=lambda shape: shape[1] )
+
+def current():
+    ''' The RequestStats for the request being served on this thread, or None '''
+    return getattr( _local, 'stats', None )
+
+def view_totals():
+    ''' A copy of {view name : [requests, operations, seconds]} since this process started '''
+    with _view_lock:
+        return dict( (view, list(totals)) for view, totals in _view_totals.iteritems() )
+
+def _timed( operation, describe ):
+    '''
+    Wraps a pymongo method so that calls to it are recorded in the current RequestStats.
+    <describe> gives (collection, query) for the call, or None if it won't touch the
+    database.
+    '''
+    def wrap( method ):
+        @wraps( method )
+        def timed( self, *args, **kwargs ):
+            stats = current()
+            if stats is None:
+                return method( self, *args, **kwargs )
+            described = describe( self, args, kwargs )
+            if described is None:
+                return method( self, *args, **kwargs )
+            # Named before the call, which may change what the name depends on
+            # (e.g. the first _refresh of a cursor gives it its id)
+            name = operation( self ) if callable( operation ) else operation
+            start = time.time()
+            try:
+                return method( self, *args, **kwargs )
+            finally:
+                stats.record( name, described[0], described[1], time.time() - start )
+        return timed
+    return wrap
+
+def _describe_refresh( cursor, args, kwargs ):
+    # _refresh only goes to the server when the cursor has run out of buffered documents
+    if cursor._Cursor__data or cursor._Cursor__killed:
+        return None
+    return (cursor.collection.name, cursor._Cursor__spec)
+
+def _cursor_operation( cursor ):
+    # The first round trip is the query itself; the rest fetch more of its results
+    return "getmore" if cursor._Cursor__id else "find"
+
+def _describe_write( position, name ):
+    def describe( collection, args, kwargs ):
+        query = args[position] if len(args) > position else kwargs.get( name )
+        return (collection.name, query)
+    return describe
+
+def _describe_command( database, args, kwargs ):
+    command = args[0] if args else kwargs.get( 'command' )
+    return (database.name, command)
+
+def install():
+    ''' Wraps pymongo's methods. Only needs to happen once per process. '''
+    global _installed
+    if _installed:
+        return
+    Cursor._refresh = _timed( _cursor_operation, _describe_refresh )( Cursor._refresh )
+    Collection.insert = _timed( "insert", lambda collection, args, kwargs : (collection.name, None) )( Collection.insert )
+    Collection.update = _timed( "update", _describe_write(0, 'spec') )( Collection.update )
+    Collection.remove = _timed( "remove", _describe_write(0, 'spec_or_id') )( Collection.remove )
+    # Later 2.x releases send every command through Database._command
+    name = '_command' if hasattr( Database, '_command' ) else 'command'
+    setattr( Database, name, _timed( "command", _describe_command )( getattr(Database, name) ) )
+    _installed = True
+
+class QueryStatsMiddleware( object ):
+    '''
+    Counts the database operations made by each request. Should come first in
+    MIDDLEWARE_CLASSES, so that operations made by other middleware (e.g. loading
+    the session) are counted too.
+    '''
+
+    def __init__( self ):
+        self.options = getattr( settings, 'MONGODB_STATS', {} )
+        if self.options.get( 'ENABLED' ):
+            install()
+
+    def process_request( self, request ):
+        if self.options.get( 'ENABLED' ):
+            _local.stats = RequestStats()
+        return None
+
+    def process_view( self, request, view_func, view_args, view_kwargs ):
+        stats = current()
+        if stats is not None:
+            stats.view = "%s.%s"%(view_func.__module__, view_func.__name__)
+        return None
+
+    def process_response( self, request, response ):
+        stats = current()
+        if stats is None:
+            return response
+        _local.stats = None
+        view = stats.view or request.path
+
+        with _view_lock:
+            totals = _view_totals.setdefault( view, [0, 0, 0.0] )
+            totals[0] += 1
+            totals[1] += stats.operations
+            totals[2] += stats.seconds
+            average = float(totals[1]) / totals[0]
+
+        if stats.seconds*1000 > self.options.get( 'SLOW_REQUEST_MS', 250 ) \
+                or stats.operations > self.options.get( 'SLOW_REQUEST_OPERATIONS', 30 ):
+            lines = ["%s %s (%s): %d operations, %dms in MongoDB (%.1f operations on average)"%(
+                    request.method, request.get_full_path(), view, stats.operations, stats.seconds*1000, average)]
+            for count, seconds, shape in stats.shapes()[:SHAPES_LOGGED]:
+                lines.append( "  %4dx %6dms  %s"%(count, seconds*1000, shape) )
+            logger.warning( "\n".join(lines) )
+
+        if settings.DEBUG:
+            response['X-Mongo-Operations'] = str( stats.operations )
+            response['X-Mongo-Time-Ms'] = "%d"%(stats.seconds*1000)
+        return response
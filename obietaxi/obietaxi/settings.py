@@ -13,6 +13,76 @@ HERE = os.path.dirname( os.path.abspath(__file__) )
 # This needs to be changed as the site is moved around
 HOSTNAME='localhost:8000'
 
+# Route polygons are simplified before being stored: the route's boxes are grown
+# by this many degrees, and vertices within as many degrees of the simplified
+# outline are dropped. The tolerance is raised until the polygon has at most
+# ROUTE_MAX_VERTICES vertices, but never past ROUTE_MAX_SIMPLIFY_TOLERANCE
+# (about 2 km), so that routes aren't widened by much
+ROUTE_SIMPLIFY_TOLERANCE = 0.005
+ROUTE_MAX_VERTICES = 500
+ROUTE_MAX_SIMPLIFY_TOLERANCE = 0.02
+
+# How long to cache the logged-in user's profile between requests, in seconds.
+# 0 turns the cache off. Saving a profile clears its cached copy, so only turn this
+# on with a cache shared by every process (see CACHES).
+PROFILE_CACHE_SECONDS = 0
+
+CACHES = {
+    'default' : {
+        'BACKEND' : 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Caching of the offers near a search (see taxi/searchcache.py). Searches starting in
+# the same GRID-degree cell, in the same BUCKET_HOURS-long stretch of time, with the
+# same fuzziness share an entry, kept for SECONDS. BACKEND is one of CACHES; only
+# enable this with one shared by every process (e.g. memcached, or a file-based
+# cache on a single machine), since saving an offer must clear entries everywhere.
+SEARCH_CACHE = {
+    'ENABLED' : False,
+    'BACKEND' : 'default',
+    'GRID' : 0.05,
+    'BUCKET_HOURS' : 24,
+    'SECONDS' : 3600,
+}
+
+# How many rides to show on each page of browsing and search results
+RIDES_PER_PAGE = 50
+
+# The most searches of each kind one call to /search/bulk/ may make
+MAX_BULK_SEARCHES = 50
+
+# Rides are moved to the archive this many days after they happen
+# (see "manage.py archive_rides"). A user's page shows at most
+# ARCHIVE_HISTORY_SIZE of their archived offers and requests.
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_HISTORY_SIZE = 50
+
+# Outgoing email is queued in MongoDB and sent by "manage.py mail_worker" (see
+# taxi/mail.py). With QUEUE off, email is sent while the request waits instead.
+MAIL_QUEUE = {
+    'QUEUE' : True,
+    'SMTP_HOST' : 'localhost',
+    'SMTP_PORT' : 25,
+    # An email that can't be sent is tried again RETRY_SECONDS later, then twice as
+    # long after each failure (at most RETRY_MAX_SECONDS), MAX_ATTEMPTS times in all
+    'MAX_ATTEMPTS' : 8,
+    'RETRY_SECONDS' : 30,
+    'RETRY_MAX_SECONDS' : 3600,
+    # How long a worker has to send an email before another may try it
+    'LEASE_SECONDS' : 300,
+    # Workers hang up on the mail server after this long with nothing to send
+    'IDLE_SECONDS' : 60,
+    # How often idle workers look for new email
+    'POLL_SECONDS' : 2,
+    # Workers that can't reach the queue wait longer after each failure, up to this
+    'ERROR_MAX_SECONDS' : 60,
+}
+
+# Users who take digests (see taxi/digest.py) get theirs from "manage.py flush_digests",
+# or as soon as this many notifications are waiting for them
+DIGEST_MAX_PENDING = 10
+
 # Message storage backend
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 
@@ -90,10 +160,13 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'obietaxi.querystats.QueryStatsMiddleware',
+    'obietaxi.mongo.MongoConnectionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'taxi.middleware.ProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -105,6 +178,37 @@ AUTHENTICATION_BACKENDS = (
 
 SESSION_ENGINE = 'mongoengine.django.sessions'
 
+# The MongoDB database. Each process keeps a pool of up to MAX_POOL_SIZE connections,
+# opened when the database is first used (see obietaxi/mongo.py).
+MONGODB = {
+    'NAME' : 'obietaxi',
+    'HOST' : 'localhost',
+    'PORT' : 27017,
+    'USERNAME' : None,
+    'PASSWORD' : None,
+    'MAX_POOL_SIZE' : 10,
+    # In milliseconds. None waits forever.
+    'CONNECT_TIMEOUT_MS' : 5000,
+    'SOCKET_TIMEOUT_MS' : 30000,
+    # How long to wait for a free connection from the pool
+    'WAIT_QUEUE_TIMEOUT_MS' : 5000,
+    # primary, primary_preferred, secondary, secondary_preferred or nearest
+    'READ_PREFERENCE' : 'primary',
+}
+
+from obietaxi.mongo import register
+register( MONGODB )
+
+# Counting the database operations each request makes (see obietaxi/querystats.py).
+# Requests that spend more than SLOW_REQUEST_MS milliseconds in MongoDB, or make more
+# than SLOW_REQUEST_OPERATIONS operations, are logged to "obietaxi.querystats" with
+# the queries they made.
+MONGODB_STATS = {
+    'ENABLED' : True,
+    'SLOW_REQUEST_MS' : 250,
+    'SLOW_REQUEST_OPERATIONS' : 30,
+}
+
 ROOT_URLCONF = 'obietaxi.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -153,6 +257,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -161,5 +269,10 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'obietaxi.querystats': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     }
 }
@@ -1,11 +1,7 @@
-import mongoengine as mdb
 from django.conf.urls import patterns, include, url
 from django.views.generic.simple import direct_to_template
 from taxi import views
 
-# Connect to database
-mdb.connect('obietaxi')
-
 urlpatterns = patterns(
     '',
     url( r'^$', views.request_or_offer_ride, name="main_page" ),
@@ -32,6 +28,10 @@ urlpatterns = patterns(
     url( r'^request/show/(?P<request_id>[a-z0-9]+)/$', views.request_show, name="request_show" ),
     url( r'^request/feedback/(?P<request_id>[a-z0-9]+)/$', views.rider_feedback, name="ride_feedback" ),
 
+    url( r'^search/bulk/$', views.bulk_search, name="bulk_search" ),
+
+    url( r'^digest/$', views.digest_toggle, name="digest_toggle" ),
+
     url( r'^browse/$', views.browse, name="browse" ),
     url( r'^accounts/', include( 'mongologin.urls' ) ),
 
@@ -0,0 +1,74 @@
+'''
+Cold storage for rides that have already happened.
+
+Views and the matcher only ever look at upcoming rides, but past rides stayed in
+the same collections forever, growing every index the matcher uses. archive_rides()
+moves rides older than a horizon, together with their RideMatches and Trusts, into
+collections of their own, named in ARCHIVES. Documents are moved as they are, so
+they can be read back with the usual models through archived().
+'''
+from models import RideOffer, RideRequest, RideMatch, Trust
+
+ARCHIVES = { RideOffer : 'ride_offer_archive',
+             RideRequest : 'ride_request_archive',
+             RideMatch : 'ride_match_archive',
+             Trust : 'trust_archive' }
+
+# Fields the archives are searched by
+ARCHIVE_INDEXES = { RideOffer : ('driver',),
+                    RideRequest : ('passenger',) }
+
+def archive_collection( cls ):
+    ''' The pymongo collection holding archived <cls> documents '''
+    return cls._get_db()[ARCHIVES[cls]]
+
+def archived( cls, projection=None, limit=0, **query ):
+    '''
+    The archived <cls> documents matching <query>, a raw pymongo query, most recent first.
+    <projection> is a projection for pymongo's find(), e.g. from projections.raw_projection().
+    '''
+    cursor = archive_collection( cls ).find( query, projection ).sort( 'date', -1 ).limit( limit )
+    return [cls._from_son( son ) for son in cursor]
+
+def _move( cls, query, batch_size, dependents=None ):
+    '''
+    Moves documents of <cls> matching <query> to the archive, <batch_size> at a time.
+    <dependents> is called with the ids of each batch, to move what refers to them.
+    Returns how many documents were moved.
+    '''
+    hot, cold = cls._get_collection(), archive_collection( cls )
+    moved = 0
+    while True:
+        batch = list( hot.find( query ).limit( batch_size ) )
+        if not batch:
+            return moved
+        ids = [son['_id'] for son in batch]
+        # Copy before deleting, and overwrite any copy left by an interrupted run
+        for son in batch:
+            cold.save( son )
+        if dependents:
+            dependents( ids )
+        hot.remove( {'_id' : {'$in' : ids}} )
+        moved += len(batch)
+
+def ensure_archive_indexes():
+    for cls, fields in ARCHIVE_INDEXES.iteritems():
+        for field in fields:
+            archive_collection( cls ).create_index( field, background=True )
+
+def archive_rides( before, batch_size=500 ):
+    '''
+    Moves RideOffers and RideRequests dated before <before> to the archive, along with
+    their RideMatches and the Trusts left on the offers. Returns a dictionary giving
+    how many documents of each class were moved.
+    '''
+    counts = dict( (cls, 0) for cls in ARCHIVES )
+    def offer_dependents( ids ):
+        counts[RideMatch] += _move( RideMatch, {'offer' : {'$in' : ids}}, batch_size )
+        counts[Trust] += _move( Trust, {'offer' : {'$in' : ids}}, batch_size )
+    def request_dependents( ids ):
+        counts[RideMatch] += _move( RideMatch, {'request' : {'$in' : ids}}, batch_size )
+
+    counts[RideOffer] = _move( RideOffer, {'date' : {'$lt' : before}}, batch_size, offer_dependents )
+    counts[RideRequest] = _move( RideRequest, {'date' : {'$lt' : before}}, batch_size, request_dependents )
+    return counts
@@ -0,0 +1,72 @@
+'''
+Digests: one email in place of a burst of them.
+
+A popular offer can bring its driver an email for every person who asks to join it
+within a few minutes. Users who turn on digest mode (UserProfile.digest) get those
+emails kept for them as PendingNotifications instead, and "manage.py flush_digests",
+run on a schedule, sends each of them everything that is waiting as one email. A
+user's digest is also sent as soon as DIGEST_MAX_PENDING notifications are waiting.
+
+Only news about rides goes into digests; notify() is used for it in views.py.
+Confirmations, cancellations and account emails are still sent right away.
+'''
+from datetime import datetime, timedelta
+from itertools import groupby
+from bson.objectid import ObjectId
+from django.core.urlresolvers import reverse
+from mongoengine.queryset import Q
+from obietaxi import settings
+from helpers import send_email, send_emails, render_message, _hostname
+from prefetch import reference_id
+from models import PendingNotification
+
+TEMPLATE = 'taxi/static/emails/digest.txt'
+SEPARATOR = "\r\n\r\n%s\r\n\r\n"%(30*'=')
+
+# A flush that hasn't finished with its notifications in this long is taken to have
+# died, and the notifications are sent by the next one
+STALE_BATCH = timedelta( hours=1 )
+
+def notify( profile, email_subject, email_body ):
+    ''' Emails <profile> right away, or puts the email in their digest if they take digests '''
+    if not profile.digest:
+        send_email( email_to=profile.user.username, email_subject=email_subject, email_body=email_body )
+        return
+    PendingNotification.objects.create( recipient=profile, email=profile.user.username,
+                                        subject=email_subject, body=email_body )
+    if PendingNotification.objects( recipient=profile, batch=None ).count() >= settings.DIGEST_MAX_PENDING:
+        flush( recipient=profile )
+
+def _digest( notifications ):
+    ''' The arguments to send_email() for the digest of <notifications>, all for one recipient '''
+    email_to = notifications[0].email
+    count = len(notifications)
+    plural = "" if count == 1 else "s"
+    text = SEPARATOR.join( "%s\r\n\r\n%s"%(n.subject, n.body) for n in notifications )
+    settings_link = '%s%s'%( _hostname(), reverse('user_landing') )
+    body = render_message( TEMPLATE, { 'count' : count, 'plural' : plural, 'notifications' : text,
+                                       'settings_link' : settings_link } )
+    return dict( email_to=email_to, email_subject="%d message%s about your rides"%(count, plural),
+                 email_body=body )
+
+def flush( recipient=None ):
+    '''
+    Sends everything waiting for <recipient>, or for everyone, with one digest per
+    recipient. Returns how many digests were sent.
+    '''
+    # Mark the notifications this flush sends, so that another flush running at the
+    # same time doesn't send them too
+    batch = ObjectId()
+    stale = ObjectId.from_datetime( datetime.utcnow() - STALE_BATCH )
+    waiting = PendingNotification.objects( Q(batch=None) | Q(batch__lt=stale) )
+    if recipient is not None:
+        waiting = waiting.filter( recipient=recipient )
+    if not waiting.update( set__batch=batch ):
+        return 0
+
+    claimed = PendingNotification.objects( batch=batch ).order_by( 'recipient', 'created' )
+    emails = [_digest( list(notifications) )
+              for key, notifications in groupby( claimed, lambda n: reference_id(n._data['recipient']) )]
+    send_emails( emails )
+    PendingNotification.objects( batch=batch ).delete()
+    return len(emails)
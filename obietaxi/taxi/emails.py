@@ -0,0 +1,88 @@
+'''
+Renders the email templates in taxi/static/emails and mongologin/static/emails.
+
+Templates are plain text with placeholders like {{offer.driver.user.first_name}} or
+{{offer.time()}}: a variable, followed by any number of attributes and calls
+without arguments. Nothing else is allowed, so templates can't run arbitrary code.
+
+Each template is read and split into text and placeholders once, then kept until
+its file changes on disk. Rendering is a single pass over the pieces.
+'''
+import ast
+import os
+import re
+
+PLACEHOLDER = re.compile( r"{{(.*?)}}" )
+
+class TemplateError( ValueError ):
+    ''' A placeholder that is not a variable, attribute or call without arguments '''
+    pass
+
+def _compile_expression( source, filename ):
+    '''
+    Turns <source>, the inside of a placeholder, into (variable, steps) where each
+    step is an attribute name to look up, or None for a call
+    '''
+    try:
+        node = ast.parse( source.strip(), mode='eval' ).body
+    except SyntaxError:
+        raise TemplateError( "Can't read {{%s}} in %s"%(source, filename) )
+    steps = []
+    while not isinstance( node, ast.Name ):
+        if isinstance( node, ast.Attribute ):
+            steps.append( node.attr )
+            node = node.value
+        elif isinstance( node, ast.Call ) and not (node.args or node.keywords or node.starargs or node.kwargs):
+            steps.append( None )
+            node = node.func
+        else:
+            raise TemplateError( "{{%s}} in %s is not allowed in an email template"%(source, filename) )
+    steps.reverse()
+    return node.id, tuple(steps)
+
+def compile_template( contents, filename='<string>' ):
+    '''
+    Splits <contents> into a list of strings, for text, and (variable, steps)
+    tuples, for placeholders
+    '''
+    pieces = []
+    position = 0
+    for match in PLACEHOLDER.finditer( contents ):
+        if match.start() > position:
+            pieces.append( contents[position:match.start()] )
+        pieces.append( _compile_expression(match.group(1), filename) )
+        position = match.end()
+    if position < len(contents):
+        pieces.append( contents[position:] )
+    return pieces
+
+def _evaluate( variable, steps, context ):
+    value = context[variable]
+    for step in steps:
+        value = value() if step is None else getattr( value, step )
+    return value
+
+def render( pieces, context ):
+    ''' Fills in the placeholders of a compiled template from <context>, a dictionary '''
+    return "".join( piece if isinstance( piece, basestring ) else str( _evaluate(piece[0], piece[1], context) )
+                    for piece in pieces )
+
+def variables( pieces ):
+    ''' The names of the variables used by a compiled template '''
+    return set( piece[0] for piece in pieces if not isinstance( piece, basestring ) )
+
+# filename --> (modification time, compiled template)
+_cache = {}
+
+def load( filename ):
+    ''' The compiled template in <filename>, read again only if the file has changed '''
+    mtime = os.stat( filename ).st_mtime
+    cached = _cache.get( filename )
+    if cached is None or cached[0] != mtime:
+        with open( filename, "r" ) as input:
+            cached = (mtime, compile_template( input.read(), filename ))
+        _cache[filename] = cached
+    return cached[1]
+
+def render_file( filename, context ):
+    return render( load(filename), context )
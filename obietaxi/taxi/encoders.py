@@ -2,6 +2,8 @@ import models
 import json
 from datetime import datetime
 
+# The encoders only read fields loaded by the "match" projection (see projections.py)
+
 class RideRequestEncoder( json.JSONEncoder ):
     ''' Encodes a RideRequest as JSON '''
     def default( self, o ):
@@ -23,9 +25,7 @@ class UserProfileEncoder( json.JSONEncoder ):
         if isinstance( o, models.UserProfile ):
             return {
                 'phone_number': o.phone_number,
-                'trust': o.trust,
-                'offers': [str(offer.id) for offer in o.offers],
-                'requests': [str(request.id) for request in o.requests],
+                'trust': o.trust_count,
                 'first_name': o.user.first_name,
                 'last_name': o.user.last_name,
                 'id': str(o.id)
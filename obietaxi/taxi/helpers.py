@@ -2,33 +2,52 @@ import smtplib
 from random import choice
 from obietaxi import settings
 import math
+import numpy
+from datetime import datetime, timedelta
 from django.http import Http404
-import re
+from emails import render_file, load as load_template, render as render_template, variables as template_variables
 
 def render_message( filename, context ):
     '''
     Render a message as a string. The source of the message can be found in the text file
     named by <filename>, with substitutions being as variables supplied by locals() or
-    globals() in <context>.
-    '''
-    replacements = {}
-    with open( filename, "r" ) as input:
-        contents = input.read()
-        for match in re.finditer( "{{(.*?)}}", contents ):
-            replacements[match.group(1)] = eval( match.group(1), context )
-    newstring = None
-    for orig, new in replacements.iteritems():
-        newstring = (newstring or contents).replace( '{{%s}}'%orig, str(new) )
-    return newstring
+    globals() in <context>. See emails.py for what may go in a substitution.
+    '''
+    return render_file( filename, context )
+
+# Offers starting and ending within this many km of a request's start and end match it
+NEARBY_DISTANCE = 5
+
+# Bounds of the time window of a ride that can happen anytime
+EARLIEST = datetime(1970, 1, 1)
+LATEST = datetime(3000, 1, 1)
+
+def time_window( date, fuzziness ):
+    '''
+    Returns (start, end): the range of times a ride leaving at <date> could happen,
+    given its <fuzziness> ('1-hours' through '5-hours', 'day', 'week' or 'anytime').
+    '''
+    date = date.replace( tzinfo=None )
+    if '-' in fuzziness:
+        delta = timedelta( hours=int(fuzziness.split('-')[0]) )
+        return date - delta, date + delta
+    elif fuzziness == 'day':
+        start = datetime( date.year, date.month, date.day )
+        return start, start + timedelta(days=1)
+    elif fuzziness == 'week':
+        delta = timedelta( days=3, hours=12 )
+        return date - delta, date + delta
+    return EARLIEST, LATEST
 
 def get_mongo_or_404( cls, **kwargs ):
     '''
-    cls = The type of model to get an object of
+    cls = The type of model to get an object of, or a QuerySet to get it from
     kwargs = used for filtering
     '''
+    objects = getattr( cls, 'objects', cls )
     try:
-        return cls.objects.get( **kwargs )
-    except cls.DoesNotExist:
+        return objects.get( **kwargs )
+    except objects._document.DoesNotExist:
         raise Http404
 
 def _hostname( protocol="http" ):
@@ -37,37 +56,336 @@ def _hostname( protocol="http" ):
         basename = "{}://{}".format( protocol, basename )
     return basename
 
+def profile_cache_key( profile_id ):
+    ''' Key under which a UserProfile is cached when PROFILE_CACHE_SECONDS is set '''
+    return 'profile:%s'%profile_id
+
+def forget_cached_profile( profile_id ):
+    ''' Drop the cached copy of the UserProfile with id <profile_id>, if there is one '''
+    if getattr( settings, 'PROFILE_CACHE_SECONDS', 0 ):
+        from django.core.cache import cache
+        cache.delete( profile_cache_key(profile_id) )
+
 def random_string( chars='abcdefghijklmnopqrstubwxyz1234567890', length=80 ):
     return "".join( choice(chars) for i in xrange(length) )
 
-def send_email( email_from="", email_subject="", email_to=[], email_body="" ):
+def _email( email_from="", email_subject="", email_to=[], email_body="" ):
+    ''' (sender, recipients, subject, body) of an email, with the defaults filled in '''
     if len(email_from) == 0:
         email_from = 'noreply@{}'.format( _hostname(protocol="") )
     if not type(email_to) is list:
         email_to=[email_to]
     email_subject = "Obietaxi: %s"%email_subject if len(email_subject) > 0 else "Message from Obietaxi!"
+    return email_from, email_to, email_subject, email_body
+
+def send_email( email_from="", email_subject="", email_to=[], email_body="" ):
+    send_emails( [dict( email_from=email_from, email_subject=email_subject,
+                        email_to=email_to, email_body=email_body )] )
 
-    hostname = _hostname( protocol="" )
-    email_message = "\r\n".join( ["From: {}".format(email_from),
-                                  "To: {}".format(', '.join(email_to)),
-                                  "Subject: {}".format(email_subject),
-                                  "",
-                                  email_body] )
-    server = smtplib.SMTP( 'localhost' )
-    server.sendmail( email_from, email_to, email_message )
+def send_emails( emails ):
+    '''
+    Sends each of <emails>, dictionaries of arguments to send_email(), all at once:
+    queued with one insert, or sent over one SMTP connection if the queue is off
+    '''
+    emails = [_email( **email ) for email in emails]
+    if not emails:
+        return
+    # Queued for "manage.py mail_worker" to send, unless the queue is turned off
+    from taxi import mail
+    options = mail.options()
+    if options['QUEUE']:
+        mail.enqueue_many( emails )
+        return
+    server = smtplib.SMTP( options['SMTP_HOST'], options['SMTP_PORT'] )
+    for email in emails:
+        server.sendmail( email[0], email[1], mail.format_message(*email) )
     server.quit()
 
-def geospatial_distance( p1, p2 ):
+def _context_key( value ):
+    try:
+        hash( value )
+        return value
+    except TypeError:
+        return id( value )
+
+def send_message_emails( filename, email_subject, recipients, context ):
     '''
-    Calculates geospatial distance between two points specified in (lat,lng).
-    Returns the distance in km.
+    Emails the message in <filename> (see render_message) to each of <recipients>, a
+    list of (email address, context) pairs, all at once. Each recipient's context is
+    added to <context>, which they all share. The message is only rendered again for
+    recipients whose contexts differ in variables it uses.
+    '''
+    pieces = load_template( filename )
+    used = template_variables( pieces )
+    bodies = {}
+    emails = []
+    for address, own in recipients:
+        key = tuple( sorted( (name, _context_key(value)) for name, value in own.iteritems() if name in used ) )
+        if key not in bodies:
+            full = dict( context )
+            full.update( own )
+            bodies[key] = render_template( pieces, full )
+        emails.append( dict( email_to=address, email_subject=email_subject, email_body=bodies[key] ) )
+    send_emails( emails )
+
+# Radius of earth in km
+EARTH_RADIUS = 6371
+
+def geospatial_distances( points, origin ):
+    '''
+    Calculates geospatial distance between each of <points> (a sequence or N x 2 array
+    of (lat,lng)) and the single point <origin>. Returns a NumPy array of distances in km.
 
     Source:  http://stackoverflow.com/questions/27928/how-do-i-calculate-distance-between-two-latitude-longitude-points
     '''
-    # Radius of earth in km
-    R = 6371
+    points = numpy.radians( numpy.asarray(points, dtype=float).reshape(-1, 2) )
+    lat0, lng0 = math.radians(origin[0]), math.radians(origin[1])
+    dlat = lat0 - points[:,0]
+    dlng = lng0 - points[:,1]
+    a = numpy.sin(dlat/2)**2 + numpy.cos(points[:,0]) * math.cos(lat0) * numpy.sin(dlng/2)**2
+    c = 2 * numpy.arctan2( numpy.sqrt(a), numpy.sqrt(1-a) )
+    return EARTH_RADIUS * c
+
+def points_in_polygon( points, contour ):
+    '''
+    Tests which of <points> lie inside the polygon <contour>, both given as (lat,lng),
+    by counting how many of the polygon's edges a ray from each point crosses.
+    Returns a boolean NumPy array.
+    '''
+    points = numpy.asarray( points, dtype=float ).reshape(-1, 2)
+    a = numpy.asarray( contour, dtype=float )
+    b = numpy.roll( a, -1, axis=0 )
+    lat, lng = points[:,0:1], points[:,1:2]
+    # Edges that straddle each point's longitude...
+    straddles = (a[:,1] > lng) != (b[:,1] > lng)
+    # ...and cross the ray going north from the point
+    with numpy.errstate( divide='ignore', invalid='ignore' ):
+        crossing = a[:,0] + (b[:,0] - a[:,0]) * (lng - a[:,1]) / (b[:,1] - a[:,1])
+    return ((straddles & (lat < crossing)).sum(axis=1) % 2) == 1
+
+def geospatial_distance( p1, p2 ):
+    '''
+    Calculates geospatial distance between two points specified in (lat,lng).
+    Returns the distance in km. For a single pair this is much quicker than
+    geospatial_distances, which is for many points at once.
+    '''
     dlat, dlng = math.radians(p2[0]-p1[0]), math.radians(p2[1]-p1[1])
     a = math.sin(dlat/2)**2 + math.cos(math.radians(p1[0])) * math.cos(math.radians(p2[0])) * math.sin(dlng/2)**2
     c = 2 * math.atan2( math.sqrt(a), math.sqrt(1-a) )
-    d = R * c
-    return d
+    return EARTH_RADIUS * c
+
+def self_intersects( contour ):
+    '''
+    Whether two edges of the closed polygon <contour> (a list of points) cross.
+    Edges are only compared with those in the same block of rows at a time, so
+    that large contours don't need an N x N array.
+    '''
+    points = numpy.asarray( contour, dtype=float )
+    if len(points) > 1 and (points[0] == points[-1]).all():
+        points = points[:-1]
+    n = len(points)
+    if n < 4:
+        return False
+    ends = numpy.roll( points, -1, axis=0 )
+
+    def side( p, q, r ):
+        ''' Which side of the line p-q each r is on: -1, 0 or 1 '''
+        return numpy.sign( (q[...,0] - p[...,0]) * (r[...,1] - p[...,1]) -
+                           (q[...,1] - p[...,1]) * (r[...,0] - p[...,0]) )
+
+    others_a, others_b = points[None,:], ends[None,:]
+    j = numpy.arange( n )[None,:]
+    for first in xrange( 0, n, 256 ):
+        a, b = points[first:first+256,None], ends[first:first+256,None]
+        i = numpy.arange( first, first + len(a) )[:,None]
+        crossing = ( (side( a, b, others_a ) * side( a, b, others_b ) < 0) &
+                     (side( others_a, others_b, a ) * side( others_a, others_b, b ) < 0) )
+        # Neighbouring edges share a vertex, and each pair only needs checking once
+        crossing &= (j > i + 1) & ~((i == 0) & (j == n - 1))
+        if crossing.any():
+            return True
+    return False
+
+def simplify_contour( contour, tolerance, max_vertices=None, max_tolerance=None ):
+    '''
+    Simplifies the closed polygon <contour> (a list of points) with the Douglas-Peucker
+    algorithm, dropping vertices that lie within <tolerance> of the simplified outline.
+    If <max_vertices> is given, the tolerance is doubled until the result is no larger,
+    but not past <max_tolerance>: then the result has more vertices instead.
+
+    Douglas-Peucker can make an outline cross itself where two parts of it are
+    closer than the tolerance. Points inside such a polygon can test as outside it,
+    so <contour> is returned as it is instead.
+    '''
+    if len(contour) <= 4:
+        return contour
+    points = numpy.asarray( contour, dtype=float )
+
+    def keep_mask( tolerance ):
+        keep = numpy.zeros( len(points), dtype=bool )
+        # Split the ring at the first point and the point farthest from it
+        far = int( numpy.argmax(((points - points[0])**2).sum(axis=1)) )
+        keep[0] = keep[far] = True
+        stack = [(0, far), (far, len(points))]
+        while stack:
+            first, last = stack.pop()
+            if last - first < 2:
+                continue
+            a, b = points[first], points[last % len(points)]
+            inner = points[first+1:last]
+            # Distance of each inner point from the segment a-b
+            ab = b - a
+            length = (ab**2).sum()
+            if length == 0:
+                dists = numpy.sqrt( ((inner - a)**2).sum(axis=1) )
+            else:
+                t = numpy.clip( ((inner - a) * ab).sum(axis=1) / length, 0, 1 )
+                dists = numpy.sqrt( ((inner - (a + t[:,None] * ab))**2).sum(axis=1) )
+            worst = int( numpy.argmax(dists) )
+            if dists[worst] > tolerance:
+                keep[first + 1 + worst] = True
+                stack.append( (first, first + 1 + worst) )
+                stack.append( (first + 1 + worst, last) )
+        return keep
+
+    keep = keep_mask( tolerance )
+    while max_vertices and keep.sum() > max_vertices and 0 < tolerance * 2 <= (max_tolerance or tolerance * 2):
+        tolerance *= 2
+        keep = keep_mask( tolerance )
+    if keep.all():
+        return contour
+    simplified = points[keep].tolist()
+    return contour if self_intersects( simplified ) else simplified
+
+def decode_polyline( encoded ):
+    '''
+    Decodes a polyline in Google's encoded polyline format into a list of (lat,lng).
+
+    Source:  https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    '''
+    values, value, shift = [], 0, 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append( ~(value >> 1) if value & 1 else value >> 1 )
+            value, shift = 0, 0
+    # Values are deltas from the previous point, in 1e-5 degrees
+    points = numpy.cumsum( numpy.asarray(values[:len(values)//2*2], dtype=float).reshape(-1, 2), axis=0 )
+    return (points / 1e5).tolist()
+
+def _cell_runs( grid ):
+    '''
+    Finds the runs of marked cells along each row of the boolean array <grid>, merging
+    each run with one spanning the same columns in the row below. Returns boxes of cells
+    as [first row, first column, last row, last column].
+    '''
+    boxes = []
+    # (first column, last column) --> index of the box that reached the previous row
+    below = {}
+    for row in xrange( grid.shape[0] ):
+        edges = numpy.flatnonzero( numpy.diff(numpy.concatenate(([0], grid[row].astype(int), [0]))) )
+        reached = {}
+        for first, last in zip( edges[0::2], edges[1::2] - 1 ):
+            key = (first, last)
+            if key in below:
+                boxes[below[key]][2] = row
+                reached[key] = below[key]
+            else:
+                boxes.append( [row, first, row, last] )
+                reached[key] = len(boxes) - 1
+        below = reached
+    return boxes
+
+class RouteError( ValueError ):
+    ''' A route posted by a client that can't be boxed '''
+    pass
+
+# Clients choose how far from a route to look, within these limits (km)
+MIN_ROUTE_DISTANCE = 1
+MAX_ROUTE_DISTANCE = 50
+# The most grid cells route_boxes() will lay over a route
+MAX_ROUTE_CELLS = 250000
+
+def route_boxes( path, distance ):
+    '''
+    A port of RouteBoxer (see static/js/RouteBoxer.js). Returns boxes that together cover
+    every point within <distance> km of <path>, a list of (lat,lng). The boxes come as a
+    flat list [ne.lat, ne.lng, sw.lat, sw.lng, ...], just as points.js posts them.
+
+    A grid of cells <distance> km on a side is laid over the path; every cell the path
+    passes through is marked along with its neighbours, and the marked cells are merged
+    into as few boxes as possible.
+
+    <distance> is brought within MIN_ROUTE_DISTANCE and MAX_ROUTE_DISTANCE. Raises
+    RouteError if the path is empty or not made of numbers, or would need a grid
+    of more than MAX_ROUTE_CELLS cells.
+    '''
+    # How finely to sample the path when finding the cells it passes through
+    SAMPLES_PER_CELL = 8
+    # Written so that NaN becomes the minimum too
+    if not distance >= MIN_ROUTE_DISTANCE:
+        distance = MIN_ROUTE_DISTANCE
+    distance = min( distance, MAX_ROUTE_DISTANCE )
+    try:
+        path = numpy.asarray( path, dtype=float ).reshape(-1, 2)
+    except (TypeError, ValueError):
+        raise RouteError( "The route must be a list of (lat,lng)" )
+    if not len(path) or not numpy.isfinite( path ).all() or (numpy.abs( path[:,0] ) > 90).any():
+        raise RouteError( "The route must be a list of (lat,lng)" )
+    south, west = path.min( axis=0 )
+    north, east = path.max( axis=0 )
+    center = ((south + north) / 2, (west + east) / 2)
+
+    # Grid lines are <distance> km apart along rhumb lines through the center,
+    # extending at least one cell beyond the path on every side
+    step = numpy.degrees( [distance / float(EARTH_RADIUS),
+                           distance / float(EARTH_RADIUS) / math.cos(math.radians(center[0]))] )
+    below = numpy.ceil( (numpy.asarray(center) - (south, west)) / step ) + 2
+    above = numpy.ceil( ((north, east) - numpy.asarray(center)) / step ) + 2
+    origin = center - below * step
+    shape = (below + above).astype(int)
+    if shape.prod() > MAX_ROUTE_CELLS:
+        raise RouteError( "The route is too long to look %g km around"%distance )
+
+    # Sample each segment of the path at a fraction of a cell, all segments at once
+    coords = (path - origin) / step
+    segments = coords[1:] - coords[:-1]
+    counts = numpy.maximum( numpy.ceil(numpy.abs(segments).max(axis=1) * SAMPLES_PER_CELL), 1 ).astype(int) \
+        if len(segments) else numpy.zeros( 0, dtype=int )
+    which = numpy.repeat( numpy.arange(len(segments)), counts )
+    t = (numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)) \
+        / numpy.repeat( counts, counts ).astype(float)
+    samples = numpy.vstack( (coords[which] + segments[which] * t[:,None], coords[-1:]) )
+    cells = numpy.floor( samples ).astype(int)
+
+    # Mark the cells the path passes through, and their neighbours
+    marked = numpy.zeros( shape, dtype=bool )
+    marked[cells[:,0], cells[:,1]] = True
+    grid = numpy.zeros( shape, dtype=bool )
+    for drow in (-1, 0, 1):
+        for dcol in (-1, 0, 1):
+            grid[1+drow:shape[0]-1+drow, 1+dcol:shape[1]-1+dcol] |= marked[1:-1, 1:-1]
+
+    # Merge cells along rows and along columns; keep whichever makes fewer boxes
+    by_rows = _cell_runs( grid )
+    by_columns = [[box[1], box[0], box[3], box[2]] for box in _cell_runs( grid.T )]
+    boxes = []
+    for first_row, first_col, last_row, last_col in min( by_rows, by_columns, key=len ):
+        sw = origin + (first_row, first_col) * step
+        ne = origin + (last_row + 1, last_col + 1) * step
+        boxes.extend( [ne[0], ne[1], sw[0], sw[1]] )
+    return [float(b) for b in boxes]
+
+def bounding_box( point, distance ):
+    '''
+    Calculates a (lat,lng)-aligned box around <point> that contains every point
+    within <distance> km of it. Returns (south, west, north, east).
+    '''
+    # Length of a degree of latitude in km
+    KM_PER_DEGREE = 111.2
+    dlat = distance / KM_PER_DEGREE
+    # Degrees of longitude shrink towards the poles
+    dlng = distance / (KM_PER_DEGREE * max( math.cos(math.radians(point[0])), 0.01 ))
+    return point[0]-dlat, point[1]-dlng, point[0]+dlat, point[1]+dlng
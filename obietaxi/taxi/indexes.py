@@ -0,0 +1,88 @@
+'''
+The indexes behind the queries that taxi/views.py and mongologin/views.py run all
+the time. Each entry of HOT_QUERIES names a query, the index it needs and an
+example of the query, so that "manage.py ensure_indexes" can build the index and
+show how the database actually runs the query.
+
+Indexes declared in the models' meta (the geospatial ones, time windows,
+(date, id) for paging, RideMatch) are listed too when a hot query relies on them,
+so that their query plans get checked as well.
+'''
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from mongoengine.django.auth import User
+from mongologin.models import RegistrationStub
+from taxi.models import UserProfile, RideOffer, RideRequest, QueuedEmail
+
+def _ascending( *fields ):
+    return [(field, ASCENDING) for field in fields]
+
+# (description, document class, index keys, function returning an example QuerySet)
+HOT_QUERIES = (
+    ( "browse: upcoming requests without a driver, in order",
+      RideRequest, _ascending( "ride_offer", "date", "_id" ),
+      lambda: RideRequest.objects.filter( date__gte=datetime.now(), ride_offer=None ).order_by( 'date', 'id' ) ),
+    ( "browse: upcoming offers, in order",
+      RideOffer, _ascending( "date", "_id" ),
+      lambda: RideOffer.objects.filter( date__gte=datetime.now() ).order_by( 'date', 'id' ) ),
+    ( "search: offers whose time windows overlap a request's",
+      RideOffer, _ascending( "window_start", "window_end" ),
+      lambda: RideOffer.objects.filter( window_start__lte=datetime.now(), window_end__gte=datetime.now() ) ),
+    ( "route index: offers saved by other processes since the last check",
+      RideOffer, _ascending( "updated" ),
+      lambda: RideOffer.objects.filter( updated__gt=datetime.now() ) ),
+    ( "posting an offer: is it a duplicate?",
+      RideOffer, _ascending( "driver", "date" ),
+      lambda: RideOffer.objects.filter( driver=ObjectId(), date=datetime.now() ) ),
+    ( "profile page: a driver's open offers",
+      RideOffer, _ascending( "driver", "completed", "date" ),
+      lambda: RideOffer.objects.filter( driver=ObjectId(), completed=False ) ),
+    ( "posting a request: is it a duplicate? / profile page: a passenger's requests",
+      RideRequest, _ascending( "passenger", "date" ),
+      lambda: RideRequest.objects.filter( passenger=ObjectId(), date=datetime.now() ) ),
+    ( "cancelling an offer: requests riding with it",
+      RideRequest, _ascending( "ride_offer", "date", "_id" ),
+      lambda: RideRequest.objects.filter( ride_offer=ObjectId() ) ),
+    ( "logging in: a user's profile",
+      UserProfile, _ascending( "user" ),
+      lambda: UserProfile.objects.filter( user=ObjectId() ) ),
+    ( "signing in with Google: profile by OpenID",
+      UserProfile, _ascending( "openid_auth_stub.claimed_id" ),
+      lambda: UserProfile.objects.filter( openid_auth_stub__claimed_id="" ) ),
+    ( "logging in: user by email address",
+      User, None,
+      lambda: User.objects.filter( username="" ) ),
+    ( "activating an account: registration by activation code",
+      RegistrationStub, _ascending( "activationCode" ),
+      lambda: RegistrationStub.objects.filter( activationCode="" ) ),
+    ( "mail worker: the next email due",
+      QueuedEmail, _ascending( "failed", "next_attempt" ),
+      lambda: QueuedEmail.objects.filter( failed=False, next_attempt__lte=datetime.now() ).order_by( 'next_attempt' ) ),
+)
+
+def _stages( plan ):
+    ''' Every stage of a query plan from explain(), from the top down '''
+    if not plan:
+        return
+    yield plan
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        for stage in _stages( child ):
+            yield stage
+
+def summarize_plan( explained ):
+    '''
+    Boils the output of explain() down to (indexes used, whether the collection is
+    scanned, documents examined). Understands the output of MongoDB 2.x and 3.x.
+    '''
+    if 'queryPlanner' in explained:
+        stages = list( _stages( explained['queryPlanner']['winningPlan'] ) )
+        indexes = [stage['indexName'] for stage in stages if stage.get('stage') == 'IXSCAN']
+        scanned = any( stage.get('stage') == 'COLLSCAN' for stage in stages )
+        examined = explained.get( 'executionStats', {} ).get( 'totalDocsExamined' )
+    else:
+        cursor = explained.get( 'cursor', '' )
+        indexes = [cursor.split()[1]] if cursor.startswith( 'BtreeCursor' ) else []
+        scanned = cursor == 'BasicCursor'
+        examined = explained.get( 'nscannedObjects' )
+    return indexes, scanned, examined
@@ -0,0 +1,196 @@
+'''
+The outgoing email queue.
+
+send_email() in helpers.py only puts emails into the QueuedEmail collection, so
+that requests don't wait on the mail server and no email is lost if it is down.
+"manage.py mail_worker" runs workers that take emails from the queue and send them,
+each keeping one SMTP connection open while there is mail to send. An email that
+can't be sent is tried again later, waiting twice as long after each attempt, until
+MAX_ATTEMPTS attempts have failed. All of this is configured by the MAIL_QUEUE setting.
+'''
+import logging
+import smtplib
+import socket
+import time
+from datetime import datetime, timedelta
+from obietaxi import settings
+from models import QueuedEmail
+
+logger = logging.getLogger( __name__ )
+
+DEFAULTS = { 'QUEUE' : True,
+             'SMTP_HOST' : 'localhost',
+             'SMTP_PORT' : 25,
+             'MAX_ATTEMPTS' : 8,
+             'RETRY_SECONDS' : 30,
+             'RETRY_MAX_SECONDS' : 3600,
+             'LEASE_SECONDS' : 300,
+             'IDLE_SECONDS' : 60,
+             'POLL_SECONDS' : 2,
+             'ERROR_MAX_SECONDS' : 60 }
+
+def options( **overrides ):
+    ''' The MAIL_QUEUE setting, with defaults filled in and <overrides> applied '''
+    result = dict( DEFAULTS )
+    result.update( getattr(settings, 'MAIL_QUEUE', {}) )
+    result.update( overrides )
+    return result
+
+def format_message( sender, recipients, subject, body ):
+    return "\r\n".join( ["From: {}".format(sender),
+                         "To: {}".format(', '.join(recipients)),
+                         "Subject: {}".format(subject),
+                         "",
+                         body] )
+
+def enqueue( sender, recipients, subject, body ):
+    ''' Puts an email in the queue, and returns its QueuedEmail '''
+    return QueuedEmail.objects.create( sender=sender, recipients=recipients,
+                                       subject=subject, body=body )
+
+def enqueue_many( emails ):
+    ''' Puts each of <emails>, (sender, recipients, subject, body), in the queue with one insert '''
+    QueuedEmail.objects.insert( [QueuedEmail( sender=sender, recipients=recipients, subject=subject, body=body )
+                                 for sender, recipients, subject, body in emails],
+                                load_bulk=False )
+
+def permanent( error ):
+    '''
+    Whether <error>, raised while sending an email, will happen again however many
+    times the email is tried: the server refused a recipient or the email (5xx)
+    '''
+    if isinstance( error, smtplib.SMTPRecipientsRefused ):
+        return True
+    return isinstance( error, smtplib.SMTPResponseException ) and error.smtp_code >= 500
+
+def retry_delay( attempts, opts ):
+    ''' How long to wait before trying again an email that has failed <attempts> times '''
+    seconds = opts['RETRY_SECONDS'] * 2**(attempts - 1)
+    return timedelta( seconds=min(seconds, opts['RETRY_MAX_SECONDS']) )
+
+def claim( opts ):
+    '''
+    Takes the email that has waited longest among those due to be sent, or returns
+    None if there are none. The email stays in the queue, but no other worker will
+    take it for LEASE_SECONDS.
+    '''
+    now = datetime.now()
+    return QueuedEmail.objects( failed=False, next_attempt__lte=now ).order_by( 'next_attempt' ).modify(
+        new=True, set__next_attempt=now + timedelta(seconds=opts['LEASE_SECONDS']), inc__attempts=1 )
+
+def queue_depth():
+    '''
+    A dictionary describing the queue: how many emails are "waiting" to be sent,
+    how many of those are "due" now, how many have "failed", and how many seconds
+    the oldest waiting email has waited ("oldest_seconds")
+    '''
+    now = datetime.now()
+    waiting = QueuedEmail.objects( failed=False )
+    oldest = waiting.order_by( 'created' ).only( 'created' ).first()
+    return { 'waiting' : waiting.count(),
+             'due' : waiting.filter( next_attempt__lte=now ).count(),
+             'failed' : QueuedEmail.objects( failed=True ).count(),
+             'oldest_seconds' : int((now - oldest.created).total_seconds()) if oldest else 0 }
+
+class SMTPConnection( object ):
+    '''
+    A connection to the mail server that is opened when first needed and kept open
+    between emails, until close() is called
+    '''
+
+    def __init__( self, host, port ):
+        self.host, self.port = host, port
+        self.server = None
+        self.last_used = None
+
+    def send( self, email ):
+        '''
+        Sends the QueuedEmail <email>. If the server dropped the connection since
+        the last email, reconnects once.
+        '''
+        message = format_message( email.sender, email.recipients, email.subject, email.body )
+        for retry in (False, True):
+            if self.server is None:
+                self.server = smtplib.SMTP( self.host, self.port )
+                self.last_used = time.time()
+            try:
+                self.server.sendmail( email.sender, email.recipients, message )
+                self.last_used = time.time()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.server = None
+                if retry:
+                    raise
+
+    def close( self ):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.server = None
+
+    def idle( self, seconds ):
+        ''' Whether the connection is open and hasn't been used for <seconds> '''
+        return self.server is not None and time.time() - self.last_used > seconds
+
+def deliver( connection, email, opts ):
+    '''
+    Sends <email>, a QueuedEmail taken with claim(), over <connection>. Sent emails
+    are removed from the queue; others are scheduled to be tried again, or marked
+    as failed. Returns whether the email was sent.
+    '''
+    try:
+        connection.send( email )
+    except Exception as e:
+        # After anything but a plain refusal, the connection can't be trusted
+        if not isinstance( e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) ):
+            connection.close()
+        failed = permanent( e ) or email.attempts >= opts['MAX_ATTEMPTS']
+        QueuedEmail.objects( id=email.id ).update_one(
+            set__last_error=repr(e), set__failed=failed,
+            set__next_attempt=datetime.now() + retry_delay(email.attempts, opts) )
+        return False
+    email.delete()
+    return True
+
+def deliver_due( connection, opts, stop=None ):
+    '''
+    Sends emails from the queue until none are due, or <stop> (a threading.Event)
+    is set. Returns how many were sent.
+    '''
+    sent = 0
+    while not (stop and stop.is_set()):
+        email = claim( opts )
+        if email is None:
+            break
+        sent += deliver( connection, email, opts )
+    return sent
+
+def work( opts, stop ):
+    '''
+    Sends emails as they come into the queue until <stop>, a threading.Event, is set.
+    The SMTP connection is closed when there has been nothing to send for IDLE_SECONDS.
+
+    Errors from the queue itself (e.g. AutoReconnect while MongoDB fails over) are
+    logged, and the worker waits twice as long after each one in a row, up to
+    ERROR_MAX_SECONDS, before trying again.
+    '''
+    connection = SMTPConnection( opts['SMTP_HOST'], opts['SMTP_PORT'] )
+    errors = 0
+    try:
+        while not stop.is_set():
+            try:
+                sent = deliver_due( connection, opts, stop )
+            except Exception:
+                logger.exception( "Mail worker could not use the queue" )
+                stop.wait( min(opts['POLL_SECONDS'] * 2**min(errors, 16), opts['ERROR_MAX_SECONDS']) )
+                errors += 1
+                continue
+            errors = 0
+            if not sent:
+                if connection.idle( opts['IDLE_SECONDS'] ):
+                    connection.close()
+                stop.wait( opts['POLL_SECONDS'] )
+    finally:
+        connection.close()
@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from obietaxi import settings
+from taxi.archive import archive_rides, ensure_archive_indexes
+
+class Command( BaseCommand ):
+    '''
+    Moves rides that happened more than ARCHIVE_AFTER_DAYS days ago, with their
+    matches and feedback, out of the collections the site searches and into the
+    archive (see taxi/archive.py). Meant to be run regularly, e.g. nightly from cron:
+
+        0 4 * * * cd /path/to/obietaxi && python manage.py archive_rides
+    '''
+    help = 'Archives rides older than ARCHIVE_AFTER_DAYS days'
+    option_list = BaseCommand.option_list + (
+        make_option( '--days', type='int', dest='days', default=None,
+                     help='Archive rides older than this many days, instead of ARCHIVE_AFTER_DAYS' ),
+        make_option( '--batch-size', type='int', dest='batch_size', default=500,
+                     help='How many documents to move at a time' ),
+    )
+
+    def handle( self, *args, **options ):
+        days = options['days']
+        if days is None:
+            days = settings.ARCHIVE_AFTER_DAYS
+        before = datetime.now() - timedelta( days=days )
+        ensure_archive_indexes()
+        counts = archive_rides( before, options['batch_size'] )
+        for cls, count in sorted( counts.items(), key=lambda item: item[0].__name__ ):
+            self.stdout.write( "Archived %d %s documents\n"%(count, cls.__name__) )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from taxi.models import RideOffer, RideRequest
+
+class Command( BaseCommand ):
+    '''
+    Re-saves every RideOffer and RideRequest so that fields derived from other
+    fields (the bounding box of the route polygon, the time window) are filled in
+    for documents created before those fields existed.
+
+    Also removes the GeoJSON fields rides used to be saved with (RideOffer.route,
+    RideRequest.endpoints) and their 2dsphere indexes.
+    '''
+    help = 'Fills in derived fields on existing RideOffers and RideRequests'
+
+    def handle( self, *args, **options ):
+        for cls in (RideOffer, RideRequest):
+            count = 0
+            for ride in cls.objects.all():
+                ride.save()
+                count += 1
+            self.stdout.write( "Updated %d %s documents\n"%(count, cls.__name__) )
+
+        for cls, field in ((RideOffer, 'route'), (RideRequest, 'endpoints')):
+            collection = cls._get_collection()
+            collection.update( {field : {'$exists' : True}}, {'$unset' : {field : ''}}, multi=True )
+            if field + '_2dsphere' in collection.index_information():
+                collection.drop_index( field + '_2dsphere' )
@@ -0,0 +1,47 @@
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from taxi.indexes import HOT_QUERIES, summarize_plan
+
+class Command( BaseCommand ):
+    '''
+    Builds the indexes declared in taxi/indexes.py, in the background so that the
+    site keeps running meanwhile, then explains each hot query and reports which
+    index it uses. Queries that scan a whole collection are flagged.
+    '''
+    help = 'Builds the indexes for the hot queries and shows how each query is run'
+    option_list = BaseCommand.option_list + (
+        make_option( '--explain-only', action='store_true', dest='explain_only', default=False,
+                     help='Only explain the queries, without building any indexes' ),
+        make_option( '--verbose-plans', action='store_true', dest='verbose_plans', default=False,
+                     help='Print the whole output of explain() for each query' ),
+        make_option( '--strict', action='store_true', dest='strict', default=False,
+                     help='Fail if any query scans a whole collection' ),
+    )
+
+    def handle( self, *args, **options ):
+        if not options['explain_only']:
+            built = set()
+            for description, cls, keys, query in HOT_QUERIES:
+                if keys is None or (cls, tuple(keys)) in built:
+                    continue
+                name = cls._get_collection().create_index( keys, background=True )
+                built.add( (cls, tuple(keys)) )
+                self.stdout.write( "Index %s on %s\n"%(name, cls._get_collection_name()) )
+
+        scans = []
+        for description, cls, keys, query in HOT_QUERIES:
+            explained = query().explain()
+            indexes, scanned, examined = summarize_plan( explained )
+            self.stdout.write( "\n%s\n"%description )
+            self.stdout.write( "  indexes: %s\n"%(", ".join(indexes) or "none") )
+            if examined is not None:
+                self.stdout.write( "  documents examined: %s\n"%examined )
+            if scanned:
+                self.stdout.write( "  WARNING: scans the whole %s collection\n"%cls._get_collection_name() )
+                scans.append( description )
+            if options['verbose_plans']:
+                self.stdout.write( json.dumps( explained, indent=2, default=str ) + "\n" )
+
+        if scans and options['strict']:
+            raise CommandError( "%d queries scan whole collections"%len(scans) )
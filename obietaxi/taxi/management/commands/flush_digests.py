@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from taxi.digest import flush
+
+class Command( BaseCommand ):
+    '''
+    Sends users who take digests everything that is waiting for them (see
+    taxi/digest.py). Meant to be run on a schedule, e.g. every three hours from cron:
+
+        0 */3 * * * cd /path/to/obietaxi && python manage.py flush_digests
+    '''
+    help = 'Sends the digests of notifications waiting for users'
+
+    def handle( self, *args, **options ):
+        self.stdout.write( "Sent %d digests\n"%flush() )
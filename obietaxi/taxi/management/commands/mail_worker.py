@@ -0,0 +1,62 @@
+import threading
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from taxi import mail
+
+class Command( BaseCommand ):
+    '''
+    Sends the email queued by the site (see taxi/mail.py). Runs until interrupted,
+    with --workers threads each keeping their own connection to the mail server,
+    and reports how much mail is waiting every --report seconds. Several of these
+    can run at once, on one machine or many.
+
+    With --once, sends what is due and exits, e.g. to run from cron. With --status,
+    only reports on the queue.
+    '''
+    help = 'Sends queued email'
+    option_list = BaseCommand.option_list + (
+        make_option( '--workers', type='int', dest='workers', default=2,
+                     help='How many emails to send at once' ),
+        make_option( '--report', type='int', dest='report', default=60,
+                     help='Report the queue depth every this many seconds' ),
+        make_option( '--once', action='store_true', dest='once', default=False,
+                     help='Send the email that is due, then exit' ),
+        make_option( '--status', action='store_true', dest='status', default=False,
+                     help='Report the queue depth, then exit' ),
+    )
+
+    def report( self ):
+        self.stdout.write( "%(waiting)d emails waiting (%(due)d due, oldest %(oldest_seconds)ds old), "
+                           "%(failed)d failed\n"%mail.queue_depth() )
+
+    def handle( self, *args, **options ):
+        opts = mail.options()
+        if options['status']:
+            self.report()
+            return
+        if options['once']:
+            connection = mail.SMTPConnection( opts['SMTP_HOST'], opts['SMTP_PORT'] )
+            try:
+                sent = mail.deliver_due( connection, opts )
+            finally:
+                connection.close()
+            self.stdout.write( "Sent %d emails\n"%sent )
+            self.report()
+            return
+
+        stop = threading.Event()
+        workers = [threading.Thread( target=mail.work, args=(opts, stop) )
+                   for i in xrange(options['workers'])]
+        for worker in workers:
+            worker.start()
+        try:
+            while True:
+                self.report()
+                time.sleep( options['report'] )
+        except KeyboardInterrupt:
+            self.stdout.write( "Stopping once the emails being sent are done\n" )
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
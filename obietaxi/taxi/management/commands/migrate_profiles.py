@@ -0,0 +1,55 @@
+from bson.dbref import DBRef
+from django.core.management.base import BaseCommand
+from taxi.models import UserProfile, RideOffer, Trust, TrustSummary
+
+def _reference( cls, value ):
+    ''' A DBRef to the <cls> stored as <value> (an ObjectId or a DBRef), or None '''
+    if value is None:
+        return None
+    return DBRef( cls._get_collection_name(), value.id if isinstance(value, DBRef) else value )
+
+class Command( BaseCommand ):
+    '''
+    Moves what is left of the lists that UserProfiles used to hold:
+
+    * each embedded Trust becomes a document in the Trust collection, and the
+      profile gets its trust_count and recent_trust,
+    * the offers and requests lists are dropped, since rides are found by their
+      driver and passenger.
+
+    Profiles are read straight from the database, because the model no longer
+    has these fields. Profiles that have already been migrated are left alone, and
+    Trusts are upserted, keeping the dates they were given, so the command can be
+    run again if it was interrupted, even partway through a profile.
+    '''
+    help = 'Moves trust out of UserProfiles, and drops their offers and requests lists'
+
+    def handle( self, *args, **options ):
+        legacy = { '$or' : [ {'trust' : {'$exists' : True}},
+                             {'offers' : {'$exists' : True}},
+                             {'requests' : {'$exists' : True}} ] }
+        profiles = trusts = 0
+        collection = Trust._get_collection()
+        for son in UserProfile._get_collection().find( legacy, ['trust'] ):
+            trustee = _reference( UserProfile, son['_id'] )
+            summaries = []
+            for embedded in son.get( 'trust', [] ):
+                trust = Trust( trustee=trustee,
+                               truster=_reference( UserProfile, embedded.get('truster') ),
+                               offer=_reference( RideOffer, embedded.get('offer') ),
+                               message=embedded.get('message'),
+                               # Trust that wasn't dated is at least as old as the profile
+                               date=embedded.get('date') or son['_id'].generation_time.replace( tzinfo=None ) )
+                # Matched on every field, so that a Trust moved by an interrupted run
+                # isn't made twice
+                fields = trust.to_mongo()
+                collection.update( fields, fields, upsert=True )
+                summaries.append( TrustSummary( truster=trust.truster, message=trust.message,
+                                                date=trust.date ).to_mongo() )
+                trusts += 1
+            UserProfile.objects( id=son['_id'] ).update_one(
+                __raw__={ '$set' : { 'trust_count' : len(summaries),
+                                     'recent_trust' : summaries[-UserProfile.RECENT_TRUST_SIZE:] },
+                          '$unset' : { 'trust' : 1, 'offers' : 1, 'requests' : 1 } } )
+            profiles += 1
+        self.stdout.write( "Migrated %d profiles, moving %d Trusts\n"%(profiles, trusts) )
@@ -0,0 +1,44 @@
+from bson.dbref import DBRef
+from django.core.management.base import BaseCommand
+from mongologin.models import RegistrationStub
+from taxi.models import UserProfile, RideOffer, RideRequest
+
+def _ids( value ):
+    ''' <value>, a stored field, with every DBRef inside it replaced by the id it refers to '''
+    if isinstance( value, DBRef ):
+        return value.id
+    if isinstance( value, list ):
+        return [_ids( each ) for each in value]
+    if isinstance( value, dict ):
+        return dict( (key, _ids( each )) for key, each in value.iteritems() )
+    return value
+
+class Command( BaseCommand ):
+    '''
+    Rewrites references stored by mongoengine 0.7 for mongoengine 0.8 and later.
+
+    mongoengine 0.7 stored every ReferenceField as a DBRef. Since 0.8 they are
+    stored as plain ObjectIds, and queries on them (e.g. RideOffer.objects(driver=...))
+    are made with ObjectIds, so they don't find documents saved before the upgrade.
+    This replaces every DBRef in the collections below with the id it holds,
+    including those inside lists and embedded documents.
+
+    Documents are read and written straight from the database, and only those
+    holding a DBRef are written, so the command can be run again if it was interrupted.
+    '''
+    help = 'Replaces DBRefs stored by mongoengine 0.7 with ObjectIds'
+
+    def handle( self, *args, **options ):
+        for cls in (UserProfile, RideOffer, RideRequest, RegistrationStub):
+            collection = cls._get_collection()
+            count = 0
+            for son in collection.find():
+                changed = {}
+                for key, value in son.iteritems():
+                    converted = _ids( value )
+                    if key != '_id' and converted != value:
+                        changed[key] = converted
+                if changed:
+                    collection.update( {'_id' : son['_id']}, {'$set' : changed} )
+                    count += 1
+            self.stdout.write( "Updated %d %s documents\n"%(count, cls.__name__) )
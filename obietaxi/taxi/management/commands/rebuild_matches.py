@@ -0,0 +1,19 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from taxi.models import RideOffer
+from taxi.views import _record_matches
+
+class Command( BaseCommand ):
+    '''
+    Records the RideMatches of every upcoming RideOffer from scratch. Matches are
+    normally kept up to date as rides are posted, so this is only needed to fill in
+    matches for rides posted before the RideMatch collection existed.
+    '''
+    help = 'Recomputes the RideMatches of all upcoming ride offers'
+
+    def handle( self, *args, **options ):
+        count = 0
+        for offer in RideOffer.objects.filter( date__gte=datetime.now() ):
+            _record_matches( offer )
+            count += 1
+        self.stdout.write( "Matched %d ride offers\n"%count )
@@ -0,0 +1,95 @@
+'''
+Gives each request the UserProfile of whoever is logged in, as request.profile.
+
+Only the id of the profile is kept in the session. The profile itself is loaded
+the first time request.profile is used, at most once per request, and may be
+cached for PROFILE_CACHE_SECONDS (off by default) to save even that.
+
+Sessions begun before this kept the whole profile under LEGACY_PROFILE_SESSION_KEY.
+Those are moved over to PROFILE_SESSION_KEY the first time they are used.
+'''
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from django.http import HttpRequest
+from obietaxi import settings
+from helpers import profile_cache_key
+
+# Session key holding the id of the logged-in user's UserProfile
+PROFILE_SESSION_KEY = 'profile_id'
+# Session key that held the whole UserProfile, in sessions begun before PROFILE_SESSION_KEY
+LEGACY_PROFILE_SESSION_KEY = 'profile'
+
+def _load_profile( profile_id ):
+    from models import UserProfile
+    try:
+        return UserProfile.objects.get( pk=ObjectId(profile_id) )
+    except (UserProfile.DoesNotExist, InvalidId):
+        return None
+
+def _legacy_profile_id( request ):
+    '''
+    The id of the logged-in user's UserProfile, for a session without PROFILE_SESSION_KEY:
+    from the profile under LEGACY_PROFILE_SESSION_KEY, or else that of request.user.
+    The id is stored under PROFILE_SESSION_KEY for next time. Returns None if nobody
+    is logged in.
+    '''
+    legacy = request.session.get( LEGACY_PROFILE_SESSION_KEY )
+    if legacy is not None:
+        profile_id = getattr( legacy, 'id', legacy )
+    else:
+        user = getattr( request, 'user', None )
+        if user is None or not user.is_authenticated():
+            return None
+        from models import UserProfile
+        profile = UserProfile.objects( user=user ).only( 'id' ).first()
+        if profile is None:
+            return None
+        profile_id = profile.id
+    request.session[PROFILE_SESSION_KEY] = str( profile_id )
+    request.session.pop( LEGACY_PROFILE_SESSION_KEY, None )
+    return str( profile_id )
+
+def get_profile( request ):
+    ''' The UserProfile whose id is stored in the session of <request>, or None '''
+    profile_id = request.session.get( PROFILE_SESSION_KEY ) or _legacy_profile_id( request )
+    if not profile_id:
+        return None
+    timeout = getattr( settings, 'PROFILE_CACHE_SECONDS', 0 )
+    if not timeout:
+        return _load_profile( profile_id )
+
+    from django.core.cache import cache
+    key = profile_cache_key( profile_id )
+    profile = cache.get( key )
+    if profile is None:
+        profile = _load_profile( profile_id )
+        if profile is not None:
+            cache.set( key, profile, timeout )
+    return profile
+
+def set_profile( request, profile ):
+    ''' Log <profile> in to the session of <request> '''
+    request.session[PROFILE_SESSION_KEY] = str( profile.id )
+    request._cached_profile = profile
+
+class LazyProfile( object ):
+    ''' Loads request.profile when it is first used '''
+    def __get__( self, request, obj_type=None ):
+        if request is None:
+            return self
+        if not hasattr( request, '_cached_profile' ):
+            # Requests that SessionMiddleware hasn't seen have nobody logged in
+            request._cached_profile = get_profile( request ) if hasattr( request, 'session' ) else None
+        return request._cached_profile
+
+# Every request class, e.g. WSGIRequest, inherits this
+HttpRequest.profile = LazyProfile()
+
+class ProfileMiddleware( object ):
+    '''
+    Gives request.profile, the logged-in user's UserProfile or None. The property is
+    set up on HttpRequest once, when this module is imported; listing the middleware
+    makes sure that happens. Must come after SessionMiddleware and AuthenticationMiddleware.
+    '''
+    def process_request( self, request ):
+        return None
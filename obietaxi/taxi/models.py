@@ -1,15 +1,32 @@
 import mongoengine as mdb
+from datetime import datetime
 from mongologin.models import OpenidAuthStub
 from mongoengine.django.auth import User
-from taxi.helpers import geospatial_distance
+from taxi.helpers import geospatial_distance, time_window, forget_cached_profile
+from taxi.spatial import route_index
+from taxi.searchcache import offer_changed
 
-class Trust(mdb.EmbeddedDocument):
+class Trust(mdb.Document):
     '''
     Models a review/trust rating. This could be expanded in the future.
     '''
+    # Who is being trusted
+    trustee = mdb.ReferenceField('UserProfile')
     truster = mdb.ReferenceField('UserProfile')
     offer = mdb.ReferenceField('RideOffer')
     message = mdb.StringField()
+    date = mdb.DateTimeField( default=datetime.now )
+
+    meta = { "indexes" : [("trustee", "date")] }
+
+class TrustSummary(mdb.EmbeddedDocument):
+    '''
+    A copy of a recent Trust, kept on the trustee's profile so that it can be shown
+    without looking up the Trust collection
+    '''
+    truster = mdb.ReferenceField('UserProfile')
+    message = mdb.StringField()
+    date = mdb.DateTimeField()
 
 class Location(mdb.EmbeddedDocument):
     '''
@@ -26,14 +43,24 @@ class Location(mdb.EmbeddedDocument):
         if not isinstance( obj, Location ):return False
         return geospatial_distance( self.position, obj.position ) < EQUALS_DELTA
 
+def _set_time_window( ride ):
+    ''' Store the range of times <ride> could happen, so that the database can match rides '''
+    if ride.date:
+        ride.window_start, ride.window_end = time_window( ride.date, ride.fuzziness )
+
 class UserProfile(mdb.Document):
     """The basic model for a user."""
     phone_number = mdb.StringField()
-    trust = mdb.ListField( mdb.EmbeddedDocumentField('Trust') )
     active = mdb.BooleanField()
     reports = mdb.IntField(default=0)
-    offers = mdb.ListField(mdb.ReferenceField('RideOffer'))
-    requests = mdb.ListField(mdb.ReferenceField('RideRequest'))
+    # How many Trusts this user has been given, and the most recent of them.
+    # The Trusts themselves are in their own collection; a user's offers and requests
+    # are found by their driver/passenger.
+    trust_count = mdb.IntField(default=0)
+    recent_trust = mdb.ListField( mdb.EmbeddedDocumentField('TrustSummary') )
+    # Whether this user gets news about their rides in digests, rather than an email
+    # each time (see taxi/digest.py)
+    digest = mdb.BooleanField(default=False)
     # mongoengine user object
     # This already contains email, firstname, lastname
     user = mdb.ReferenceField( User, reverse_delete_rule=mdb.CASCADE )
@@ -44,6 +71,22 @@ class UserProfile(mdb.Document):
     # In case the user forgets their password
     password_reset_stub = mdb.StringField()
 
+    # Profiles saved before the offers, requests and trust lists moved out still have
+    # them until "manage.py migrate_profiles" is run
+    meta = { "strict" : False }
+
+    # How many Trusts to keep in recent_trust
+    RECENT_TRUST_SIZE = 5
+
+    def save( self, *args, **kwargs ):
+        result = super( UserProfile, self ).save( *args, **kwargs )
+        forget_cached_profile( self.id )
+        return result
+
+    def delete( self, *args, **kwargs ):
+        forget_cached_profile( self.id )
+        return super( UserProfile, self ).delete( *args, **kwargs )
+
     def __unicode__( self ):
         return '{} {}'.format( self.user.first_name, self.user.last_name )
 
@@ -71,8 +114,24 @@ class RideRequest(mdb.Document):
     # N.B.: This is unused. Could be a feature in the future
     repeat = mdb.StringField()
     ride_offer = mdb.ReferenceField('RideOffer')
+    # The range of times this ride could happen, given date and fuzziness
+    window_start = mdb.DateTimeField()
+    window_end = mdb.DateTimeField()
 
-    meta = { "indexes" : ["*start.position", "*end.position"] }
+    # Requests saved with the GeoJSON endpoints field still have it until
+    # "manage.py backfill_rides" is run
+    meta = { "indexes" : ["*start.position", "*end.position", ("window_start", "window_end"),
+                          # For paging through rides in order (see pagination.py)
+                          ("date", "id")],
+             "strict" : False }
+
+    def derive( self ):
+        ''' Fills in the fields derived from the others. This happens on save() '''
+        _set_time_window( self )
+
+    def save( self, *args, **kwargs ):
+        self.derive()
+        return super( RideRequest, self ).save( *args, **kwargs )
 
     def time( self ):
         return self.date.strftime("%m/%d/%Y at %I:%M %p")
@@ -94,6 +153,9 @@ class RideOffer(mdb.Document):
     fuzziness = mdb.StringField( default="1-hours" )
     # N.B.: This is unused. Could be a feature in the future
     repeat = mdb.StringField()
+    # The range of times this ride could happen, given date and fuzziness
+    window_start = mdb.DateTimeField()
+    window_end = mdb.DateTimeField()
 
     # Holds those who are asking for rides (but have not yet been accepted/declined)
     askers = mdb.ListField( mdb.ReferenceField('RideRequest') )
@@ -101,11 +163,106 @@ class RideOffer(mdb.Document):
     completed = mdb.BooleanField(default=False)
     # Stores the polygon over the driver's route from start --> end
     polygon = mdb.ListField(mdb.GeoPointField())
+    # Bounding box of the polygon, used by the route index (see spatial.py)
+    bbox_south = mdb.FloatField()
+    bbox_west = mdb.FloatField()
+    bbox_north = mdb.FloatField()
+    bbox_east = mdb.FloatField()
+    # When the offer was last saved, so that the route indexes of other processes
+    # can pick up the change (see spatial.py)
+    updated = mdb.DateTimeField()
+
+    # Offers saved with the GeoJSON route field still have it until
+    # "manage.py backfill_rides" is run
+    meta = { "indexes" : ["*start.position", "*end.position", ("window_start", "window_end"),
+                          # For paging through rides in order (see pagination.py)
+                          ("date", "id"),
+                          "updated"],
+             "strict" : False }
+
+    def derive( self ):
+        ''' Fills in the fields derived from the others. This happens on save() '''
+        _set_time_window( self )
+        # Keep the bounding box in step with the polygon
+        if self.polygon:
+            lats = [p[0] for p in self.polygon]
+            lngs = [p[1] for p in self.polygon]
+            self.bbox_south, self.bbox_north = min(lats), max(lats)
+            self.bbox_west, self.bbox_east = min(lngs), max(lngs)
+        else:
+            self.bbox_south = self.bbox_west = self.bbox_north = self.bbox_east = None
 
-    meta = { "indexes" : ["*start.position", "*end.position"] }
+    def save( self, *args, **kwargs ):
+        self.derive()
+        self.updated = datetime.now()
+        result = super( RideOffer, self ).save( *args, **kwargs )
+        route_index.add( self )
+        offer_changed( self )
+        return result
+
+    def delete( self, *args, **kwargs ):
+        route_index.discard( self.id )
+        result = super( RideOffer, self ).delete( *args, **kwargs )
+        offer_changed( self )
+        return result
 
     def time( self ):
         return self.date.strftime("%m/%d/%Y at %I:%M %p")
 
     def __unicode__( self ):
         return "from {} to {} on {}".format( self.start, self.end, self.time() )
+
+class RideMatch(mdb.Document):
+    '''
+    RideMatch records that a RideOffer and a RideRequest could be shared. These are
+    kept up to date as offers and requests are posted, so that pages showing a ride
+    can look up its matches instead of searching for them.
+    '''
+    offer = mdb.ReferenceField( RideOffer, reverse_delete_rule=mdb.CASCADE )
+    request = mdb.ReferenceField( RideRequest, reverse_delete_rule=mdb.CASCADE )
+    # Copied from the offer and request, for finding a user's matches
+    driver = mdb.ReferenceField( UserProfile )
+    passenger = mdb.ReferenceField( UserProfile )
+
+    meta = { "indexes" : [ { "fields" : ["offer", "request"], "unique" : True },
+                           ("offer", "passenger"),
+                           ("request", "driver") ] }
+
+class QueuedEmail(mdb.Document):
+    '''
+    An email waiting to be sent by "manage.py mail_worker" (see taxi/mail.py).
+    Emails are deleted once they have been sent.
+    '''
+    sender = mdb.StringField()
+    recipients = mdb.ListField( mdb.StringField() )
+    subject = mdb.StringField()
+    body = mdb.StringField()
+    created = mdb.DateTimeField( default=datetime.now )
+    # Not to be tried again before this time. A worker moves it forward when it takes
+    # the email, so that no other worker sends it meanwhile
+    next_attempt = mdb.DateTimeField( default=datetime.now )
+    attempts = mdb.IntField( default=0 )
+    last_error = mdb.StringField()
+    # Set when the email could not be sent after MAIL_QUEUE['MAX_ATTEMPTS'] attempts,
+    # or was refused outright
+    failed = mdb.BooleanField( default=False )
+
+    meta = { "indexes" : [("failed", "next_attempt")] }
+
+    def __unicode__( self ):
+        return '"{}" to {}'.format( self.subject, ', '.join(self.recipients) )
+
+class PendingNotification(mdb.Document):
+    '''
+    An email held back for the recipient's next digest (see taxi/digest.py)
+    '''
+    recipient = mdb.ReferenceField( UserProfile )
+    # The recipient's address, so that sending the digest needn't look it up
+    email = mdb.StringField()
+    subject = mdb.StringField()
+    body = mdb.StringField()
+    created = mdb.DateTimeField( default=datetime.now )
+    # Set by the flush that is sending this notification
+    batch = mdb.ObjectIdField()
+
+    meta = { "indexes" : [("recipient", "created"), "batch"] }
@@ -0,0 +1,86 @@
+'''
+Keyset pagination of rides.
+
+Rides are listed in order of (date, id), and a page ends with a cursor naming the
+last ride on it. The next page is whatever comes after that key, which the
+("date", "id") index on RideOffer and RideRequest finds without skipping over the
+earlier pages the way an offset would.
+'''
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from mongoengine.queryset import Q
+from obietaxi import settings
+
+EPOCH = datetime(1970, 1, 1)
+
+def page_size():
+    return getattr( settings, 'RIDES_PER_PAGE', 50 )
+
+def ride_key( ride ):
+    return (ride.date, ride.id)
+
+def encode_cursor( ride ):
+    ''' A cursor pointing just after <ride> '''
+    delta = ride.date - EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+    return "%d-%s"%(microseconds, ride.id)
+
+def decode_cursor( cursor ):
+    ''' The (date, id) named by <cursor>, or None if there is no cursor or it is garbled '''
+    try:
+        microseconds, ride_id = cursor.split( '-' )
+        return EPOCH + timedelta( microseconds=int(microseconds) ), ObjectId( ride_id )
+    except (AttributeError, ValueError, TypeError, OverflowError, InvalidId):
+        return None
+
+def rides_after( key ):
+    ''' A Q object finding the rides that come after <key>, a (date, id) '''
+    date, ride_id = key
+    return Q(date__gt=date) | Q(date=date, id__gt=ride_id)
+
+def _fetch( queryset, key, limit ):
+    ''' Up to <limit> rides from <queryset> coming after <key>, in order '''
+    if key:
+        queryset = queryset.filter( rides_after(key) )
+    return list( queryset.order_by( 'date', 'id' ).limit( limit ) )
+
+def _page( rides, size ):
+    if len(rides) > size:
+        return rides[:size], encode_cursor( rides[size-1] )
+    return rides, None
+
+def paginate_queryset( queryset, cursor=None, size=None ):
+    '''
+    Returns the page of rides from <queryset> following <cursor>, and the cursor
+    for the page after that (None on the last page).
+    '''
+    size = size or page_size()
+    return _page( _fetch(queryset, decode_cursor(cursor), size+1), size )
+
+def paginate_list( rides, cursor=None, size=None ):
+    '''
+    The same as paginate_queryset, for rides that have already been fetched. Searches
+    should only fetch the rides after decode_cursor( <cursor> ) in the first place.
+    '''
+    size = size or page_size()
+    key = decode_cursor( cursor )
+    rides = sorted( rides, key=ride_key )
+    if key:
+        rides = [ride for ride in rides if ride_key(ride) > key]
+    return _page( rides, size )
+
+def paginate_together( querysets, cursor=None, size=None ):
+    '''
+    Pages through several <querysets> as if they were one list ordered by (date, id).
+    Returns a list holding the rides on this page from each queryset, and the
+    cursor for the next page.
+    '''
+    size = size or page_size()
+    key = decode_cursor( cursor )
+    rides = sorted( ( (ride_key(ride), i, ride)
+                      for i, queryset in enumerate( querysets )
+                      for ride in _fetch( queryset, key, size+1 ) ),
+                    key=lambda item: item[0] )
+    next_cursor = encode_cursor( rides[size-1][2] ) if len(rides) > size else None
+    return [[item[2] for item in rides[:size] if item[1] == i] for i in xrange(len(querysets))], next_cursor
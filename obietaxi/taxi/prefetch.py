@@ -0,0 +1,69 @@
+'''
+Loads the people referenced by many rides at once.
+
+mongoengine fetches each referenced document the first time it is touched, so
+listing N rides along with their drivers' names costs 2N trips to the database
+(one for the UserProfile, one for its User). prefetch_profiles() gathers the ids
+from every ride first, loads them all with one query per collection, and puts the
+loaded documents where mongoengine would have put them itself.
+'''
+from bson.dbref import DBRef
+from mongoengine.django.auth import User
+from models import UserProfile
+
+# Fields of RideOffers and RideRequests that refer to UserProfiles
+PROFILE_FIELDS = ('driver', 'passenger', 'passengers')
+
+def reference_id( value ):
+    ''' The id of a referenced document, whether it has been loaded or not '''
+    if isinstance( value, DBRef ):
+        return value.id
+    return getattr( value, 'id', value )
+
+def reference_ids( document, field ):
+    '''
+    The ids of the documents referenced by <field> of <document>, which may be a
+    ReferenceField or a list of them, without loading the documents
+    '''
+    value = document._data.get( field )
+    if value is None:
+        return []
+    if isinstance( value, (list, tuple) ):
+        return [reference_id(v) for v in value if v is not None]
+    return [reference_id(value)]
+
+def _attach( document, field, loaded ):
+    ''' Replace references in <field> of <document> with documents in <loaded>, a dictionary by id '''
+    value = document._data.get( field )
+    if isinstance( value, (list, tuple) ):
+        document._data[field] = [loaded.get( reference_id(v), v ) for v in value]
+    elif value is not None:
+        document._data[field] = loaded.get( reference_id(value), value )
+
+def prefetch_profiles( rides, fields=PROFILE_FIELDS ):
+    '''
+    Loads the UserProfiles referenced by <fields> of each of <rides>, and their Users,
+    with two queries. Returns <rides> as a list, with the profiles attached.
+    '''
+    rides = list( rides )
+    wanted = set()
+    for ride in rides:
+        for field in fields:
+            if field in ride._fields:
+                wanted.update( reference_ids(ride, field) )
+    if not wanted:
+        return rides
+
+    profiles = dict( (p.id, p) for p in UserProfile.objects.filter( id__in=list(wanted) ) )
+    user_ids = set()
+    for profile in profiles.itervalues():
+        user_ids.update( reference_ids(profile, 'user') )
+    users = dict( (u.id, u) for u in User.objects.filter( id__in=list(user_ids) ) ) if user_ids else {}
+
+    for profile in profiles.itervalues():
+        _attach( profile, 'user', users )
+    for ride in rides:
+        for field in fields:
+            if field in ride._fields:
+                _attach( ride, field, profiles )
+    return rides
@@ -0,0 +1,47 @@
+'''
+Which fields of RideOffers and RideRequests each kind of page loads.
+
+A RideOffer can carry hundreds of route polygon vertices, and both kinds of ride
+carry their lists of askers. Pages that list rides need none of that, so they
+load rides through project():
+
+    "list"    rows on browse and search pages: where, when and who
+    "match"   candidates in the searches of views.py, which are checked against
+              the search and then encoded or listed
+    "detail"  a single ride, or a user's own rides: everything but the route
+
+Rides loaded this way are for showing only. Don't save() them: fields that were
+not loaded would be recomputed from nothing.
+'''
+from models import RideOffer, RideRequest
+
+_RIDE = ('id', 'start', 'end', 'date', 'message')
+# Used by the searches to check time windows
+_WINDOW = ('fuzziness', 'window_start', 'window_end')
+
+_ONLY = {
+    'list' : { RideOffer : _RIDE + ('driver',),
+               RideRequest : _RIDE + ('passenger',) },
+    'match' : { RideOffer : _RIDE + _WINDOW + ('driver', 'passengers'),
+                RideRequest : _RIDE + _WINDOW + ('passenger', 'ride_offer') },
+}
+_EXCLUDE = {
+    'detail' : { RideOffer : ('polygon', 'bbox_south', 'bbox_west', 'bbox_north', 'bbox_east'),
+                 RideRequest : () },
+}
+
+def project( queryset, use ):
+    ''' <queryset>, loading only the fields needed for <use>: "list", "match" or "detail" '''
+    cls = queryset._document
+    if use in _ONLY:
+        return queryset.only( *_ONLY[use][cls] )
+    if not _EXCLUDE[use][cls]:
+        return queryset
+    return queryset.exclude( *_EXCLUDE[use][cls] )
+
+def raw_projection( cls, use ):
+    ''' The same as project(), as a projection for pymongo's find() '''
+    if use in _ONLY:
+        return dict( (cls._fields[name].db_field, True) for name in _ONLY[use][cls] )
+    # find() takes an empty projection to mean the _id alone
+    return dict( (cls._fields[name].db_field, False) for name in _EXCLUDE[use][cls] ) or None
@@ -0,0 +1,88 @@
+'''
+Changes to the lists kept on rides and profiles (askers, passengers, trust),
+made in place by the database.
+
+Appending to a list in Python and calling save() writes the whole list back, so
+two people asking to join the same offer at once would each overwrite the other's
+request. These functions use $addToSet and $pull instead, which only touch the one
+element and can't lose concurrent changes. They don't update the documents passed
+in: reload them if you need the new lists.
+'''
+from bson.objectid import ObjectId
+from helpers import forget_cached_profile
+from models import UserProfile, Trust, TrustSummary
+
+def _update( document, **update ):
+    ''' Apply <update> to <document> in the database '''
+    return type(document).objects( id=document.id ).update_one( **update )
+
+def _update_profile( profile, **update ):
+    result = _update( profile, **update )
+    forget_cached_profile( profile.id )
+    return result
+
+# Asking to join an offer / offering a ride to a request
+
+def add_offer_asker( offer, req ):
+    ''' <req> asks to join <offer> '''
+    return _update( offer, add_to_set__askers=req )
+
+def remove_offer_asker( offer, req ):
+    return _update( offer, pull__askers=req )
+
+def add_request_asker( req, offer ):
+    ''' <offer> is offered to <req> '''
+    return _update( req, add_to_set__askers=offer )
+
+def remove_request_asker( req, offer ):
+    return _update( req, pull__askers=offer )
+
+# Accepting
+
+def accept_request( offer, req ):
+    ''' The driver of <offer> takes on <req>, which asked to join it '''
+    _update( offer, add_to_set__passengers=req.passenger, pull__askers=req )
+    _update( req, set__ride_offer=offer )
+
+def accept_offer( req, offer ):
+    ''' The passenger of <req> takes up <offer>, which was offered to them '''
+    _update( offer, add_to_set__passengers=req.passenger )
+    _update( req, set__ride_offer=offer, pull__askers=offer )
+
+# Trust
+
+def _trust_update( trust ):
+    ''' The update counting <trust> on its trustee's profile '''
+    summary = TrustSummary( truster=trust.truster, message=trust.message, date=trust.date )
+    return { '$inc' : { 'trust_count' : 1 },
+             '$push' : { 'recent_trust' : {
+                 '$each' : [summary.to_mongo()],
+                 '$slice' : -UserProfile.RECENT_TRUST_SIZE } } }
+
+def add_trust( trustee, truster, offer, message ):
+    '''
+    Records that <truster> trusts <trustee> after riding together on <offer>. Counts it
+    on the trustee's profile and keeps it among the profile's recent_trust.
+    '''
+    trust = Trust.objects.create( trustee=trustee, truster=truster, offer=offer, message=message )
+    _update_profile( trustee, __raw__=_trust_update(trust) )
+    return trust
+
+def add_trusts( truster, offer, messages ):
+    '''
+    add_trust() for all of the passengers on <offer> at once: <messages> maps each
+    trustee to the message left for them. Takes two trips to the database however
+    many trustees there are.
+    '''
+    trusts = [Trust( id=ObjectId(), trustee=trustee, truster=truster, offer=offer, message=message )
+              for trustee, message in messages.iteritems()]
+    if not trusts:
+        return trusts
+    Trust.objects.insert( trusts, load_bulk=False )
+    bulk = UserProfile._get_collection().initialize_unordered_bulk_op()
+    for trust in trusts:
+        bulk.find( { '_id' : trust.trustee.id } ).update_one( _trust_update(trust) )
+    bulk.execute()
+    for trust in trusts:
+        forget_cached_profile( trust.trustee.id )
+    return trusts
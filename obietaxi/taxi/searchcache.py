@@ -0,0 +1,163 @@
+'''
+Caches which RideOffers start near a place around a time, for views._offer_search.
+
+A search for offers starts by finding those that start within NEARBY_DISTANCE of
+the search's start during its time window. In the days before a break the same few
+searches ("Oberlin to Cleveland Airport, the day of X") come in over and over, so
+these candidates are cached, under a key made of:
+
+    the grid cell holding the start, GRID degrees on a side,
+    the date bucket holding the date, BUCKET_HOURS long, and
+    the fuzziness.
+
+An entry holds every offer that could be a candidate for any search with its key:
+those starting within NEARBY_DISTANCE of the cell, with time windows overlapping
+that of a search made at any time in the bucket. Only their ids, start points and
+windows are kept. The search checks those against itself and loads the offers that
+pass, so it never shows a deleted or out of date offer.
+
+Saving a RideOffer could add it to entries, so the entries it could belong to are
+made stale. Every entry records the generation of the (cell, bucket) pairs it
+covers when it was filled, and offer_changed() moves on the generations of the
+pairs covering the offer. Only entries recording an old generation are filled again.
+Offers written without save() (e.g. bulk inserts) are only seen once entries expire.
+
+Configured by the SEARCH_CACHE setting. BACKEND is one of CACHES, which should be
+shared by every process that saves offers, or they won't see each other's changes.
+'''
+import math
+import random
+from datetime import datetime, timedelta
+from django.core.cache import get_cache
+from obietaxi import settings
+from helpers import time_window, bounding_box, NEARBY_DISTANCE
+
+DEFAULTS = { 'ENABLED' : False,
+             'BACKEND' : 'default',
+             'GRID' : 0.05,
+             'BUCKET_HOURS' : 24,
+             'SECONDS' : 3600 }
+
+EPOCH = datetime( 1970, 1, 1 )
+# Windows spanning more buckets than this (e.g. "anytime") are counted against a
+# cell's "wide" generation, rather than that of each bucket
+MAX_BUCKETS = 16
+
+# BACKEND --> cache
+_caches = {}
+
+def options():
+    ''' The SEARCH_CACHE setting, with defaults filled in '''
+    result = dict( DEFAULTS )
+    result.update( getattr(settings, 'SEARCH_CACHE', {}) )
+    return result
+
+def enabled():
+    return options()['ENABLED']
+
+def _cache( opts ):
+    if opts['BACKEND'] not in _caches:
+        _caches[opts['BACKEND']] = get_cache( opts['BACKEND'] )
+    return _caches[opts['BACKEND']]
+
+def _token():
+    ''' A new generation. These are random rather than counted, so that a generation
+    dropped from the cache and made again can't be taken for the old one. '''
+    return "%x"%random.getrandbits( 48 )
+
+def cell( point, grid ):
+    ''' The grid cell holding <point>, (lat,lng) '''
+    return int( math.floor(point[0] / grid) ), int( math.floor(point[1] / grid) )
+
+def bucket( date, hours ):
+    ''' The date bucket holding <date> '''
+    delta = date.replace( tzinfo=None ) - EPOCH
+    return int( (delta.days * 86400 + delta.seconds) // (hours * 3600) )
+
+def _buckets( window, hours ):
+    ''' The buckets spanned by <window>, or None if there are more than MAX_BUCKETS '''
+    first, last = bucket( window[0], hours ), bucket( window[1], hours )
+    if last - first >= MAX_BUCKETS:
+        return None
+    return range( first, last + 1 )
+
+def _generation_key( c, b ):
+    return "offers:gen:%d:%d:%s"%(c[0], c[1], b)
+
+def _region( c, grid ):
+    ''' (south, west, north, east) holding every point within NEARBY_DISTANCE of cell <c> '''
+    south, west = c[0] * grid, c[1] * grid
+    boxes = [bounding_box( corner, NEARBY_DISTANCE )
+             for corner in ((south, west), (south, west + grid), (south + grid, west), (south + grid, west + grid))]
+    return ( min(box[0] for box in boxes), min(box[1] for box in boxes),
+             max(box[2] for box in boxes), max(box[3] for box in boxes) )
+
+def _search_window( b, fuzziness, hours ):
+    ''' The union of the windows of searches with <fuzziness> at any time in bucket <b> '''
+    start = EPOCH + timedelta( hours=hours * b )
+    end = start + timedelta( hours=hours ) - timedelta( microseconds=1 )
+    return time_window( start, fuzziness )[0], time_window( end, fuzziness )[1]
+
+def nearby_offers( point, date, fuzziness, fetch ):
+    '''
+    (id, lat, lng, window start, window end) for RideOffers that may start within
+    NEARBY_DISTANCE of <point> and have time windows overlapping that of a search
+    at <date> with <fuzziness>. There may be others too, which the caller should
+    check for.
+
+    On a miss, calls <fetch>( (south, west, north, east), window ) for the rows of
+    offers starting inside the box, with time windows overlapping the window.
+    '''
+    opts = options()
+    c = cell( point, opts['GRID'] )
+    b = bucket( date, opts['BUCKET_HOURS'] )
+    window = _search_window( b, fuzziness, opts['BUCKET_HOURS'] )
+    buckets = _buckets( window, opts['BUCKET_HOURS'] )
+    if buckets is None:
+        keys = [_generation_key( c, 'all' ), _generation_key( c, 'wide' )]
+    else:
+        keys = [_generation_key( c, 'wide' )] + [_generation_key( c, each ) for each in buckets]
+    key = "offers:%d:%d:%d:%s"%(c[0], c[1], b, fuzziness)
+
+    cache = _cache( opts )
+    found = cache.get_many( [key] + keys )
+    generations = dict( (k, found[k]) for k in keys if k in found )
+    missing = dict( (k, _token()) for k in keys if k not in found )
+    if missing:
+        cache.set_many( missing, opts['SECONDS'] )
+        generations.update( missing )
+    entry = found.get( key )
+    if entry is not None and entry[0] == generations:
+        return entry[1]
+
+    rows = fetch( _region( c, opts['GRID'] ), window )
+    cache.set( key, (generations, rows), opts['SECONDS'] )
+    return rows
+
+def offer_changed( offer ):
+    '''
+    Makes stale the entries that <offer>, a RideOffer that has just been saved or
+    deleted, could belong to
+    '''
+    opts = options()
+    if not opts['ENABLED'] or not offer.start:
+        return
+    grid = opts['GRID']
+    window = (offer.window_start, offer.window_end)
+    if None in window:
+        window = time_window( offer.date, offer.fuzziness )
+    buckets = _buckets( window, opts['BUCKET_HOURS'] )
+
+    # Cells whose regions could hold the start of the offer, with one more on each
+    # side since the regions are worked out from the cells' corners
+    south, west, north, east = bounding_box( offer.start.position, NEARBY_DISTANCE )
+    first, last = cell( (south, west), grid ), cell( (north, east), grid )
+    keys = []
+    for i in xrange( first[0] - 1, last[0] + 2 ):
+        for j in xrange( first[1] - 1, last[1] + 2 ):
+            keys.append( _generation_key( (i, j), 'all' ) )
+            if buckets is None:
+                keys.append( _generation_key( (i, j), 'wide' ) )
+            else:
+                keys.extend( _generation_key( (i, j), each ) for each in buckets )
+    _cache( opts ).set_many( dict( (k, _token()) for k in keys ), opts['SECONDS'] )
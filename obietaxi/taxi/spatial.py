@@ -0,0 +1,200 @@
+'''
+A worker-local spatial index over the route polygons of upcoming RideOffers.
+
+The index is an R-tree over polygon bounding boxes whose leaves hold already-built
+Polygon objects, so a route-containment search is a walk down the tree followed by
+exact point-in-polygon tests on the few routes whose boxes contain the points.
+'''
+import math
+import threading
+from datetime import datetime, timedelta
+from Polygon import Polygon
+
+def _union( boxes ):
+    ''' The smallest box (south, west, north, east) containing all of <boxes> '''
+    return ( min(b[0] for b in boxes), min(b[1] for b in boxes),
+             max(b[2] for b in boxes), max(b[3] for b in boxes) )
+
+def _contains( outer, inner ):
+    ''' Whether box <outer> contains box <inner> '''
+    return ( outer[0] <= inner[0] and outer[1] <= inner[1] and
+             outer[2] >= inner[2] and outer[3] >= inner[3] )
+
+def _str_pack( items, capacity ):
+    '''
+    Groups <items>, a list of (box, child) pairs, into nodes of at most <capacity>
+    children using Sort-Tile-Recursive packing. Returns the (box, children) pairs
+    making up the next level of the tree.
+    '''
+    node_count = int( math.ceil(len(items) / float(capacity)) )
+    slice_size = int( math.ceil(math.sqrt(node_count)) ) * capacity
+    # Sort into vertical slices by latitude, then each slice by longitude
+    items = sorted( items, key=lambda item: item[0][0] + item[0][2] )
+    nodes = []
+    for i in range( 0, len(items), slice_size ):
+        vertical = sorted( items[i:i+slice_size], key=lambda item: item[0][1] + item[0][3] )
+        for j in range( 0, len(vertical), capacity ):
+            children = vertical[j:j+capacity]
+            nodes.append( (_union([c[0] for c in children]), children) )
+    return nodes
+
+class RouteIndex( object ):
+    '''
+    Spatial index of the route polygons of all RideOffers departing in the future.
+
+    The tree is bulk-loaded the first time it is queried. Offers added afterwards
+    are kept in a short list that is scanned linearly, and are folded into a new
+    tree once there are more than REBUILD_THRESHOLD of them.
+
+    Offers saved in this process are indexed as they are saved. Those that other
+    processes saved are picked up at most every CATCHUP_INTERVAL, by asking the
+    database for offers updated since our last check, and offers that have
+    departed are dropped at the same time. Deleting a document leaves nothing to
+    ask for, so the whole index is loaded again every RELOAD_INTERVAL to drop
+    offers that other processes deleted.
+
+    The index only narrows down which offers could match: callers still fetch the
+    offers by id from the database, so offers deleted elsewhere drop out there.
+    '''
+
+    # Maximum number of children of a node of the tree
+    NODE_CAPACITY = 16
+    # How many offers may be added or removed before rebuilding the tree
+    REBUILD_THRESHOLD = 64
+    # How often to look for offers saved by other processes
+    CATCHUP_INTERVAL = timedelta(seconds=5)
+    # How often to load the whole index again
+    RELOAD_INTERVAL = timedelta(minutes=10)
+    # Each process stamps RideOffer.updated with its own clock, so allow some
+    # clock skew when looking for offers saved by other processes
+    CATCHUP_MARGIN = timedelta(minutes=1)
+
+    def __init__( self ):
+        self._lock = threading.RLock()
+        self._root = None
+        # offer id --> (bounding box, Polygon, date)
+        self._entries = {}
+        # offer ids not yet in the tree
+        self._pending = []
+        # how many entries in the tree have been removed since it was built
+        self._removed = 0
+        self._last_check = None
+        self._last_load = None
+
+    def _offers( self, **filters ):
+        ''' RideOffers matching <filters>, with the fields the index needs '''
+        from taxi.models import RideOffer
+        return RideOffer.objects.filter( **filters ).only( 'id', 'date', 'polygon', 'bbox_south',
+                                                           'bbox_west', 'bbox_north', 'bbox_east' )
+
+    def _rebuild( self ):
+        ''' Bulk-load a new tree from the entries we know about '''
+        level = [(entry[0], offer_id) for offer_id, entry in self._entries.iteritems()]
+        while len(level) > self.NODE_CAPACITY:
+            level = _str_pack( level, self.NODE_CAPACITY )
+        self._root = (_union([item[0] for item in level]), level) if level else None
+        self._pending = []
+        self._removed = 0
+
+    def _insert( self, offer, now ):
+        ''' Index <offer> if it has a route and hasn't departed by <now> '''
+        if not offer.polygon or offer.bbox_south is None or offer.date is None or offer.date < now:
+            return
+        self._entries[offer.id] = ( (offer.bbox_south, offer.bbox_west, offer.bbox_north, offer.bbox_east),
+                                    Polygon(offer.polygon), offer.date )
+        self._pending.append( offer.id )
+
+    def _evict( self, now ):
+        ''' Drop the offers that have departed by <now> '''
+        for offer_id in [offer_id for offer_id, entry in self._entries.iteritems() if entry[2] < now]:
+            self.discard( offer_id )
+
+    def _catch_up( self ):
+        '''
+        Load the index if it hasn't been loaded for RELOAD_INTERVAL, or pick up the
+        offers saved since we last looked if we haven't looked for CATCHUP_INTERVAL
+        '''
+        now = datetime.now()
+        if self._last_load is None or now - self._last_load >= self.RELOAD_INTERVAL:
+            self._entries = {}
+            for offer in self._offers( date__gte=now, bbox_south__ne=None ):
+                self._insert( offer, now )
+            self._rebuild()
+            self._last_load = now
+        elif now - self._last_check >= self.CATCHUP_INTERVAL:
+            # Offers that were edited so that they no longer belong in the index are
+            # fetched too, so that they can be dropped
+            for offer in self._offers( updated__gt=self._last_check - self.CATCHUP_MARGIN ):
+                self.discard( offer.id )
+                self._insert( offer, now )
+            self._evict( now )
+        else:
+            return
+        self._last_check = now
+        if len(self._pending) + self._removed > self.REBUILD_THRESHOLD:
+            self._rebuild()
+
+    def add( self, offer ):
+        ''' Index a RideOffer that has just been saved '''
+        with self._lock:
+            # Nothing to do until the index is first used
+            if self._last_load is None:
+                return
+            self.discard( offer.id )
+            self._insert( offer, datetime.now() )
+
+    def discard( self, offer_id ):
+        ''' Remove the RideOffer with id <offer_id> from the index '''
+        with self._lock:
+            if offer_id in self._entries:
+                del self._entries[offer_id]
+                if offer_id in self._pending:
+                    self._pending.remove( offer_id )
+                else:
+                    self._removed += 1
+
+    def containing( self, *points ):
+        '''
+        Returns the ids of indexed RideOffers whose route polygons contain
+        all of <points>, each given as (lat,lng).
+        '''
+        return self.containing_each( [points] )[0]
+
+    def containing_each( self, point_lists ):
+        '''
+        The same as containing() for each of <point_lists>, as a list of lists of ids.
+        Offers saved by other processes are only looked for once.
+        '''
+        with self._lock:
+            self._catch_up()
+            return [self._search( points ) for points in point_lists]
+
+    def _search( self, points ):
+        ''' The ids of the offers in the index whose routes contain all of <points> '''
+        box = _union( [(p[0], p[1], p[0], p[1]) for p in points] )
+
+        # Walk the tree, then check the recent additions
+        candidates = set()
+        stack = [self._root] if self._root and _contains( self._root[0], box ) else []
+        while stack:
+            children = stack.pop()[1]
+            for child in children:
+                if not _contains( child[0], box ):
+                    continue
+                if isinstance( child[1], list ):
+                    stack.append( child )
+                else:
+                    candidates.add( child[1] )
+        candidates.update( offer_id for offer_id in self._pending
+                           if _contains(self._entries[offer_id][0], box) )
+
+        # Exact tests on the routes whose boxes contain the points
+        matches = []
+        for offer_id in candidates:
+            entry = self._entries.get( offer_id )
+            if entry and all( entry[1].isInside(*p) for p in points ):
+                matches.append( offer_id )
+        return matches
+
+# The index for this process
+route_index = RouteIndex()
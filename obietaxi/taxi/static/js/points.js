@@ -9,7 +9,7 @@ var ObietaxiMapper = ObietaxiMapper || {};
 (function() {
     var map, markersArray = [];
     var routeBoxes;
-    var directionService, directionsRenderer, routeBoxer;
+    var directionService, directionsRenderer;
     var routeBounds;
 
     // What we do when the page loads
@@ -39,19 +39,20 @@ var ObietaxiMapper = ObietaxiMapper || {};
 						      ObietaxiMapper.polyfield || "#id_polygon" );
 				       }
 				     );
-	routeBoxer = new RouteBoxer();
     }
 
     function doPolygon( directions ) {
 	// Bounding-box encapsulation distance
 	var distance = "10";
 
-	// Box around the overview path of the first route
-	var path = directions.routes[0].overview_path;
-	var boxes = routeBoxer.box( path, distance );
+	// The server boxes the overview path of the first route, so just send
+	// it the encoded path
+	var polyline = directions.routes[0].overview_polyline;
+	var route = { "polyline" : polyline.points || polyline,
+		      "distance" : distance };
 
-	// Save the JSON'd boxes in the "polygon" field of the form
-	$(ObietaxiMapper.polyfield || "#id_polygon").val( JSON.stringify(boxesToJSON(boxes)) );
+	// Save the JSON'd route in the "polygon" field of the form
+	$(ObietaxiMapper.polyfield || "#id_polygon").val( JSON.stringify(route) );
     }
 
     // Find a route between two points. Find also all points we have
@@ -82,21 +83,5 @@ var ObietaxiMapper = ObietaxiMapper || {};
 	} );
     }
 
-    // Convert boxes into JSON
-    function boxesToJSON( boxes ) {
-	var box_list = [];
-	for ( var i=0; i<boxes.length; i++ ) {
-	    var ne = boxes[i].getNorthEast();
-	    var sw = boxes[i].getSouthWest();
-
-	    box_list[i*4] = ne.lat();
-	    box_list[i*4 + 1] = ne.lng();
-	    box_list[i*4 + 2] = sw.lat();
-	    box_list[i*4 + 3] = sw.lng();
-	}
-
-	return { "rectangles" : box_list };
-    }
-
     $(document).ready( initialize );
 }());
@@ -7,10 +7,33 @@ Replace this with more appropriate tests for your application.
 
 from mongorunner import TestCase
 from mongoengine.django.auth import User
+from pymongo.errors import AutoReconnect
 from django.test.client import RequestFactory, Client
+from django.core.management import call_command
 from taxi import views
 from taxi import models
+from taxi import helpers
+from taxi import repository
+from taxi import archive
+from taxi import mail
+from taxi import emails
+from taxi import digest
+from taxi import searchcache
+from taxi import spatial
+from taxi import pagination
+from obietaxi import settings
+from obietaxi import querystats
 from datetime import datetime, timedelta
+from StringIO import StringIO
+import asyncore
+import json
+import math
+import os
+import shutil
+import tempfile
+import smtpd
+import threading
+import time
 
 # Some users to play with
 #       fname           lname           email                   phone
@@ -58,8 +81,6 @@ def create_request(from_place, to_place, requester, **kwargs):
         date = kwargs.get('date')
         del kwargs['date']
     req = models.RideRequest.objects.create(passenger=p, start=l1, end=l2, message=msg, date=date)
-    p.requests.append(req)
-    p.save()
     return req
 
 def create_offer(from_place, to_place, offerer, **kwargs):
@@ -77,8 +98,6 @@ def create_offer(from_place, to_place, offerer, **kwargs):
         date = kwargs.get('date')
         del kwargs['date']
     off = models.RideOffer.objects.create(driver=p, start=l1, end=l2, message=msg, date=date, **kwargs)
-    p.offers.append(off)
-    p.save()
     return off
 
 class BrowseAllTest(TestCase):
@@ -113,6 +132,37 @@ class BrowseAllTest(TestCase):
         self.assertEqual(len(response.context["ride_requests"]), 4)
         self.assertEqual(len(response.context["ride_offers"]), 2)
 
+    def test_pages(self):
+        '''Browsing a page at a time shows every ride once, in order'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        for i, place in enumerate((iga, walmart, cvs)):
+            self.fixtures.append(create_request(place, airport, joe, date=tomorrow + timedelta(hours=i)))
+            self.fixtures.append(create_offer(airport, place, alex, date=tomorrow + timedelta(hours=i, minutes=30)))
+        per_page = settings.RIDES_PER_PAGE
+        settings.RIDES_PER_PAGE = 4
+        try:
+            seen, cursor = [], None
+            for page in xrange(3):
+                response = self.client.get("/browse/", {'cursor':cursor} if cursor else {})
+                rides = list(response.context["ride_requests"]) + list(response.context["ride_offers"])
+                seen.extend(sorted(rides, key=lambda r: r.date))
+                cursor = response.context["next_cursor"]
+                if not cursor:
+                    break
+        finally:
+            settings.RIDES_PER_PAGE = per_page
+        self.assertEqual(page, 1)
+        self.assertEqual([r.id for r in seen], [r.id for r in sorted(self.fixtures[6:], key=lambda r: r.date)])
+
+    def test_prefetch_profiles(self):
+        '''Drivers and their users are loaded before the page is rendered'''
+        self.fixtures.append(create_offer(walmart, iga, alex))
+        response = self.client.get("/browse/")
+        offer = response.context["ride_offers"][0]
+        self.assertTrue(isinstance(offer._data['driver'], models.UserProfile))
+        self.assertTrue(isinstance(offer._data['driver']._data['user'], User))
+        self.assertEqual(offer.driver.user.first_name, alex[0])
+
 class SearchTest(TestCase):
     '''Tests search functionalities'''
 
@@ -141,3 +191,603 @@ class SearchTest(TestCase):
 
         self.assertEqual(len(response.context["ride_offers"]), 1, msg="Did not find an offer result")
         self.assertEqual(response.context["ride_offers"][0], offer, msg="Offer result did not match")
+
+    def test_search_offer_along_route(self):
+        '''Requests lying inside an offer's route polygon should find the offer'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        # A box around Oberlin and the airport
+        route = [(41.2, -82.3), (41.5, -82.3), (41.5, -81.7), (41.2, -81.7)]
+        offer = create_offer(walmart, airport, alex, date=tomorrow, polygon=route)
+        self.fixtures.append(offer)
+        results = views._offer_search(start_lat=iga[1], start_lng=iga[2],
+                                      end_lat=cvs[1], end_lng=cvs[2],
+                                      date=tomorrow, fuzziness='1-hours')
+        self.assertEqual(results, [offer])
+
+        # Somewhere far away from the route
+        results = views._offer_search(start_lat=iga[1], start_lng=iga[2],
+                                      end_lat=40.0, end_lng=-80.0,
+                                      date=tomorrow, fuzziness='1-hours')
+        self.assertEqual(results, [])
+
+    def test_search_offer_time_window(self):
+        '''Offers only match requests whose time windows overlap theirs'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        offer = create_offer(walmart, iga, alex, date=tomorrow, fuzziness='2-hours')
+        self.fixtures.append(offer)
+        search = {'start_lat':walmart[1], 'start_lng':walmart[2],
+                  'end_lat':iga[1], 'end_lng':iga[2]}
+        # Windows [t-2h, t+2h] and [t+2.5h, t+3.5h] overlap
+        results = views._offer_search(date=tomorrow + timedelta(hours=2, minutes=30),
+                                      fuzziness='1-hours', **search)
+        self.assertEqual(results, [offer])
+        results = views._offer_search(date=tomorrow + timedelta(hours=4),
+                                      fuzziness='1-hours', **search)
+        self.assertEqual(results, [])
+
+    def test_search_request_along_route(self):
+        '''Only requests with both ends inside an offer's route should match it'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        route = [(41.2, -82.3), (41.5, -82.3), (41.5, -81.7), (41.2, -81.7)]
+        inside = create_request(iga, airport, joe, date=tomorrow)
+        outside = create_request(iga, ("Pittsburgh", 40.44, -79.99), bud, date=tomorrow)
+        self.fixtures.extend([inside, outside])
+        results = views._request_search(polygon=route, date=tomorrow, fuzziness='1-hours')
+        self.assertEqual(results, [inside])
+
+    def test_search_request_crossed_route(self):
+        '''A route crossing itself finds the same requests searched for alone or with others'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        # A bow tie, crossing itself at (41.35, -82.0)
+        route = [(41.2, -82.3), (41.5, -81.7), (41.2, -81.7), (41.5, -82.3)]
+        inside = create_request(iga, airport, joe, date=tomorrow)
+        outside = create_request(iga, ("Pittsburgh", 40.44, -79.99), bud, date=tomorrow)
+        self.fixtures.extend([inside, outside])
+        search = dict(polygon=route, date=tomorrow, fuzziness='1-hours')
+        elsewhere = dict(search, polygon=[(p[0] + 10, p[1]) for p in route])
+        self.assertEqual(views._request_search(**search), [inside])
+        self.assertEqual(views._request_search(limit=1, **search), [inside])
+        self.assertEqual(views._request_search_many([search, elsewhere]), [[inside], []])
+
+    def test_search_pages(self):
+        '''Searches only fetch the rides after the cursor, and request searches only a page of them'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        route = [(41.2, -82.3), (41.5, -82.3), (41.5, -81.7), (41.2, -81.7)]
+        requests = [create_request(iga, airport, joe, date=tomorrow + timedelta(minutes=i)) for i in xrange(3)]
+        self.fixtures.extend(requests)
+        first = views._request_search(polygon=route, date=tomorrow, fuzziness='1-hours', limit=2)
+        self.assertEqual(first, requests[:2])
+        cursor = pagination.encode_cursor(first[-1])
+        rest = views._request_search(polygon=route, date=tomorrow, fuzziness='1-hours',
+                                     after=pagination.decode_cursor(cursor), limit=2)
+        self.assertEqual(rest, requests[2:])
+
+        offers = [create_offer(walmart, iga, alex, date=tomorrow + timedelta(minutes=i)) for i in xrange(2)]
+        self.fixtures.extend(offers)
+        results = views._offer_search(start_lat=walmart[1], start_lng=walmart[2], end_lat=iga[1], end_lng=iga[2],
+                                      date=tomorrow, fuzziness='1-hours', after=pagination.ride_key(offers[0]))
+        self.assertEqual(results, offers[1:])
+
+        self.assertEqual(pagination.decode_cursor("9" * 30 + "-" + str(offers[0].id)), None)
+
+    def test_search_many(self):
+        '''Bulk searches return the same results as searching one at a time'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        self.fixtures.append(create_offer(walmart, iga, alex, date=tomorrow))
+        self.fixtures.append(create_offer(cvs, airport, bud, date=tomorrow))
+        self.fixtures.append(create_offer(walmart, iga, bud, date=tomorrow + timedelta(days=3)))
+        searches = []
+        for start, end in ((walmart, iga), (cvs, airport), (iga, walmart)):
+            searches.append({'start_lat':start[1], 'start_lng':start[2],
+                             'end_lat':end[1], 'end_lng':end[2],
+                             'date':tomorrow, 'fuzziness':'1-hours'})
+        results = views._offer_search_many(searches)
+        self.assertEqual(len(results), 3)
+        for search, result in zip(searches, results):
+            self.assertEqual(set(result), set(views._offer_search(**search)))
+        self.assertEqual(len(results[0]), 1)
+
+    def test_search_many_windows(self):
+        '''Each bulk search keeps its own time window, even next to an "anytime" search'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        later = create_offer(walmart, iga, alex, date=tomorrow + timedelta(days=3))
+        far_off = create_offer(cvs, airport, bud, date=tomorrow + timedelta(days=5))
+        self.fixtures.extend([later, far_off])
+        searches = [{'start_lat':walmart[1], 'start_lng':walmart[2], 'end_lat':iga[1], 'end_lng':iga[2],
+                     'date':tomorrow, 'fuzziness':'1-hours'},
+                    {'start_lat':cvs[1], 'start_lng':cvs[2], 'end_lat':airport[1], 'end_lng':airport[2],
+                     'date':tomorrow, 'fuzziness':'anytime'}]
+        self.assertEqual(views._offer_search_many(searches), [[], [far_off]])
+
+    def test_bulk_search_view(self):
+        '''The bulk search endpoint takes POSTed JSON, a limited number of searches at a time'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        offer = create_offer(walmart, iga, alex, date=tomorrow)
+        self.fixtures.append(offer)
+        search = {'start_lat':walmart[1], 'start_lng':walmart[2], 'end_lat':iga[1], 'end_lng':iga[2],
+                  'start_time':time.mktime(tomorrow.timetuple()) * 1000, 'fuzziness':'1-hours'}
+        self.assertEqual(self.client.get("/search/bulk/").status_code, 405)
+
+        response = self.client.post("/search/bulk/", json.dumps({'offer_searches':[search]}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)
+        self.assertEqual(len(results["offer_searches"]), 1)
+        self.assertEqual(len(results["offer_searches"][0]), 1)
+        self.assertEqual(results["request_searches"], [])
+
+        too_many = {'offer_searches':[search] * (settings.MAX_BULK_SEARCHES + 1)}
+        response = self.client.post("/search/bulk/", json.dumps(too_many), content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+        route = {'rectangles':[41.5, -81.7, 41.2, -82.3], 'start_time':search['start_time'], 'fuzziness':'1-hours'}
+        for bad in ([], {'offer_searches':{}}, {'offer_searches':[1]},
+                    {'offer_searches':[dict(search, start_lat=None)]},
+                    {'offer_searches':[dict(search, start_lng=float('nan'))]},
+                    {'offer_searches':[dict(search, start_time="tomorrow")]},
+                    {'offer_searches':[dict(search, fuzziness="soon")]},
+                    {'request_searches':[dict(route, start_time=None)]},
+                    {'request_searches':[dict(route, rectangles=[41.5, -81.7, 41.2])]},
+                    {'request_searches':[dict(route, rectangles="41.5,-81.7,41.2,-82.3")]}):
+            response = self.client.post("/search/bulk/", json.dumps(bad), content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post("/search/bulk/", json.dumps({'request_searches':[route]}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_record_matches(self):
+        '''Posting a ride records its matches with rides on the other side'''
+        tomorrow = datetime.now() + timedelta(days=1)
+        offer = create_offer(walmart, iga, alex, date=tomorrow)
+        req = create_request(walmart, iga, joe, date=tomorrow)
+        other = create_request(cvs, airport, bud, date=tomorrow)
+        self.fixtures.extend([offer, req, other])
+        views._record_matches(req)
+        views._record_matches(other)
+        matches = models.RideMatch.objects.filter(offer=offer)
+        self.assertEqual([m.request for m in matches], [req])
+
+        # Re-matching the offer gives the same result, and cancelling removes it
+        views._record_matches(offer)
+        self.assertEqual(models.RideMatch.objects.filter(offer=offer).count(), 1)
+        req.delete()
+        self.assertEqual(models.RideMatch.objects.filter(offer=offer).count(), 0)
+
+    def test_search_cache(self):
+        '''Searches answered from the cache still see offers as they come and go'''
+        original = settings.SEARCH_CACHE
+        cache_dir = tempfile.mkdtemp()
+        backends = {'search_locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                      'LOCATION': 'search'},
+                    'search_file': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                    'LOCATION': cache_dir}}
+        settings.CACHES.update(backends)
+        tomorrow = datetime.now() + timedelta(days=1)
+        search = dict(start_lat=walmart[1], start_lng=walmart[2], end_lat=iga[1], end_lng=iga[2],
+                      date=tomorrow, fuzziness='2-hours')
+        try:
+            for backend in backends:
+                settings.SEARCH_CACHE = dict(original, ENABLED=True, BACKEND=backend)
+                first = create_offer(walmart, iga, alex, date=tomorrow)
+                self.assertEqual(views._offer_search(**search), [first])
+
+                # The same search again is answered from the cache
+                fetches = []
+                rows = searchcache.nearby_offers((walmart[1], walmart[2]), tomorrow, '2-hours',
+                                                 lambda box, window: fetches.append(box) or [])
+                self.assertEqual(fetches, [])
+                self.assertEqual([row[0] for row in rows], [first.id])
+
+                second = create_offer(walmart, iga, bud, date=tomorrow)
+                self.assertEqual(set(views._offer_search(**search)), set([first, second]))
+                first.delete()
+                second.delete()
+                self.assertEqual(views._offer_search(**search), [])
+        finally:
+            settings.SEARCH_CACHE = original
+            for backend in backends:
+                del settings.CACHES[backend]
+            shutil.rmtree(cache_dir)
+
+    def test_distance_one_and_many(self):
+        '''The distance between two points is the same worked out alone or in a batch'''
+        points = [(iga[1], iga[2]), (airport[1], airport[2]), (cvs[1], cvs[2])]
+        origin = (walmart[1], walmart[2])
+        for point, distance in zip(points, helpers.geospatial_distances(points, origin)):
+            self.assertAlmostEqual(helpers.geospatial_distance(point, origin), distance)
+
+class RepositoryTest(TestCase):
+    '''Tests for updating ride lists in place'''
+
+    def setUp(self):
+        self.fixtures = []
+        for user in (joe, alex, bud):
+            user, profile = create_user(user)
+            self.fixtures.extend([user, profile])
+
+    def tearDown(self):
+        for f in self.fixtures:
+            f.delete()
+
+    def test_concurrent_askers(self):
+        '''Two people asking to join the same offer at once are both kept'''
+        offer = create_offer(walmart, iga, alex)
+        first = create_request(walmart, iga, joe)
+        second = create_request(walmart, iga, bud)
+        self.fixtures.extend([offer, first, second])
+        # Both views loaded the offer before either saved
+        stale = models.RideOffer.objects.get(pk=offer.id)
+        repository.add_offer_asker(offer, first)
+        repository.add_offer_asker(stale, second)
+        repository.add_offer_asker(stale, second)
+        self.assertEqual(set(models.RideOffer.objects.get(pk=offer.id).askers), set([first, second]))
+
+        repository.accept_request(offer, first)
+        offer.reload()
+        self.assertEqual(offer.askers, [second])
+        self.assertEqual(offer.passengers, [first.passenger])
+        self.assertEqual(models.RideRequest.objects.get(pk=first.id).ride_offer, offer)
+
+    def test_add_trust(self):
+        '''Trust goes in its own collection, and only the most recent is kept on the profile'''
+        offer = create_offer(walmart, iga, alex)
+        self.fixtures.append(offer)
+        driver, passenger = offer.driver, models.UserProfile.objects.get(phone_number=joe[3])
+        for i in xrange(models.UserProfile.RECENT_TRUST_SIZE + 2):
+            self.fixtures.append(repository.add_trust(passenger, driver, offer, "thanks %d" % i))
+        passenger.reload()
+        self.assertEqual(passenger.trust_count, models.UserProfile.RECENT_TRUST_SIZE + 2)
+        self.assertEqual(len(passenger.recent_trust), models.UserProfile.RECENT_TRUST_SIZE)
+        self.assertEqual(passenger.recent_trust[-1].message, "thanks %d" % (models.UserProfile.RECENT_TRUST_SIZE + 1))
+        self.assertEqual(models.Trust.objects.filter(trustee=passenger).count(), passenger.trust_count)
+
+    def test_add_trusts(self):
+        '''Feedback for a whole car is recorded at once'''
+        offer = create_offer(walmart, iga, alex)
+        self.fixtures.append(offer)
+        passengers = [models.UserProfile.objects.get(phone_number=u[3]) for u in (joe, bud)]
+        trusts = repository.add_trusts(offer.driver, offer, {passengers[0]: "thanks", passengers[1]: ""})
+        self.fixtures.extend(trusts)
+        for passenger in passengers:
+            passenger.reload()
+            self.assertEqual(passenger.trust_count, 1)
+        self.assertEqual(passengers[0].recent_trust[0].message, "thanks")
+
+    def test_migrate_profiles_again(self):
+        '''Running migrate_profiles again after it was interrupted doesn't make Trusts twice'''
+        offer = create_offer(walmart, iga, alex)
+        self.fixtures.append(offer)
+        passenger = models.UserProfile.objects.get(phone_number=joe[3])
+        dates = [datetime(2013, 1, 1), datetime(2013, 2, 1)]
+        trust = [{'truster': offer.driver.id, 'offer': offer.id, 'message': "thanks %d" % i, 'date': date}
+                 for i, date in enumerate(dates)]
+        # The second run finds the profile as the first left it before unsetting its trust
+        for run in xrange(2):
+            models.UserProfile._get_collection().update({'_id': passenger.id}, {'$set': {'trust': trust}})
+            call_command('migrate_profiles', stdout=StringIO())
+        trusts = models.Trust.objects.filter(trustee=passenger).order_by('date')
+        self.fixtures.extend(trusts)
+        self.assertEqual([t.date for t in trusts], dates)
+        passenger.reload()
+        self.assertEqual(passenger.trust_count, 2)
+
+class ArchiveTest(TestCase):
+    '''Tests for archiving past rides'''
+
+    def setUp(self):
+        self.fixtures = []
+        for user in (joe, alex):
+            user, profile = create_user(user)
+            self.fixtures.extend([user, profile])
+
+    def tearDown(self):
+        for f in self.fixtures:
+            f.delete()
+
+    def test_archive_rides(self):
+        '''Old rides and their matches move to the archive, and can still be read'''
+        long_ago = datetime.now() - timedelta(days=60)
+        old_offer = create_offer(walmart, iga, alex, date=long_ago)
+        old_request = create_request(walmart, iga, joe, date=long_ago)
+        new_offer = create_offer(walmart, iga, alex)
+        self.fixtures.append(new_offer)
+        models.RideMatch.objects.create(offer=old_offer, request=old_request,
+                                        driver=old_offer.driver, passenger=old_request.passenger)
+
+        counts = archive.archive_rides(datetime.now() - timedelta(days=30))
+        self.assertEqual(counts[models.RideOffer], 1)
+        self.assertEqual(counts[models.RideRequest], 1)
+        self.assertEqual(counts[models.RideMatch], 1)
+        self.assertEqual(list(models.RideOffer.objects.all()), [new_offer])
+        self.assertEqual(models.RideMatch.objects.count(), 0)
+
+        history = archive.archived(models.RideOffer, driver=new_offer.driver.id)
+        self.assertEqual([o.id for o in history], [old_offer.id])
+        self.assertEqual(history[0].start.title, walmart[0])
+
+class QueryStatsTest(TestCase):
+    '''Tests for counting database operations'''
+
+    def test_query_shape(self):
+        shape = querystats.query_shape({'$or': [{'driver': {'$in': [1, 2]}}, {'date': datetime.now()}]})
+        self.assertEqual(shape, '{$or: [{driver: {$in: [?]}}, ...]}')
+
+    def test_counts_operations(self):
+        querystats.install()
+        querystats._local.stats = stats = querystats.RequestStats()
+        try:
+            user, profile = create_user(joe)
+            models.UserProfile.objects.filter(id=profile.id).first()
+        finally:
+            querystats._local.stats = None
+        user.delete()
+        profile.delete()
+        self.assertTrue(stats.operations >= 3)
+        self.assertTrue(any('find user_profile {_id: ?}' in shape for count, seconds, shape in stats.shapes()))
+
+    def test_getmore(self):
+        '''The first batch of a query is counted as the query, and later ones as getmores'''
+        querystats.install()
+        fixtures = [create_user(user) for user in (joe, alex, bud)]
+        querystats._local.stats = stats = querystats.RequestStats()
+        try:
+            list(models.UserProfile._get_collection().find().batch_size(2))
+        finally:
+            querystats._local.stats = None
+        for user, profile in fixtures:
+            delete_user(user, profile)
+        self.assertEqual([entry[0] for entry in stats.log], ["find", "getmore"])
+
+class SinkServer(smtpd.SMTPServer):
+    '''An SMTP server on a free local port that keeps what it receives'''
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = []
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self.close()
+        self.thread.join()
+
+class MailQueueTest(TestCase):
+    '''Tests for the outgoing email queue'''
+
+    def setUp(self):
+        self.sink = SinkServer()
+        self.options = mail.options(SMTP_HOST='127.0.0.1', SMTP_PORT=self.sink.port)
+
+    def tearDown(self):
+        self.sink.stop()
+        models.QueuedEmail.drop_collection()
+
+    def test_send_email_queues(self):
+        helpers.send_email(email_to='joe@obietaxi.com', email_subject='Hi', email_body='Hello')
+        self.assertEqual(self.sink.received, [])
+        self.assertEqual(mail.queue_depth()['due'], 1)
+
+        connection = mail.SMTPConnection(self.options['SMTP_HOST'], self.options['SMTP_PORT'])
+        helpers.send_email(email_to='alex@obietaxi.com', email_subject='Hi', email_body='Hello')
+        self.assertEqual(mail.deliver_due(connection, self.options), 2)
+        connection.close()
+        self.assertEqual(sorted(r[1] for r in self.sink.received),
+                         [['alex@obietaxi.com'], ['joe@obietaxi.com']])
+        self.assertTrue('Subject: Obietaxi: Hi' in self.sink.received[0][2])
+        self.assertEqual(models.QueuedEmail.objects.count(), 0)
+
+    def test_send_message_emails(self):
+        '''A message sent to several people is queued at once, rendered once per recipient context'''
+        helpers.send_message_emails('mongologin/static/emails/forgot_password.txt', 'Hi',
+                                    [('joe@obietaxi.com', {'user': User(first_name='Joe')}),
+                                     ('alex@obietaxi.com', {'user': User(first_name='Alex')})],
+                                    {'reset_link': 'http://obietaxi.com/reset'})
+        bodies = dict((e.recipients[0], e.body) for e in models.QueuedEmail.objects)
+        self.assertTrue('Joe' in bodies['joe@obietaxi.com'])
+        self.assertTrue('Alex' in bodies['alex@obietaxi.com'])
+        self.assertTrue('http://obietaxi.com/reset' in bodies['alex@obietaxi.com'])
+
+    def test_retry_later(self):
+        mail.enqueue('noreply@obietaxi.com', ['joe@obietaxi.com'], 'Hi', 'Hello')
+        self.sink.stop()
+        connection = mail.SMTPConnection(self.options['SMTP_HOST'], self.options['SMTP_PORT'])
+        self.assertEqual(mail.deliver_due(connection, self.options), 0)
+        email = models.QueuedEmail.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertFalse(email.failed)
+        self.assertTrue(email.next_attempt > datetime.now())
+        self.sink = SinkServer()
+
+    def test_worker_survives_errors(self):
+        '''A worker that can't reach the queue keeps trying, rather than dying'''
+        stop = threading.Event()
+        calls = []
+        def claim(opts):
+            calls.append(opts)
+            if len(calls) < 3:
+                raise AutoReconnect("the queue is down")
+            stop.set()
+            return None
+        original = mail.claim
+        mail.claim = claim
+        try:
+            mail.work(mail.options(POLL_SECONDS=0.01, SMTP_PORT=self.sink.port), stop)
+        finally:
+            mail.claim = original
+        self.assertEqual(len(calls), 3)
+
+class DigestTest(TestCase):
+    '''Tests for sending notifications in digests'''
+
+    def setUp(self):
+        self.user, self.profile = create_user(joe)
+
+    def tearDown(self):
+        self.user.delete()
+        self.profile.delete()
+        models.QueuedEmail.drop_collection()
+        models.PendingNotification.drop_collection()
+
+    def test_digest(self):
+        digest.notify(self.profile, 'First', 'One')
+        self.assertEqual(models.QueuedEmail.objects.count(), 1)
+
+        self.profile.digest = True
+        self.profile.save()
+        digest.notify(self.profile, 'Second', 'Two')
+        digest.notify(self.profile, 'Third', 'Three')
+        self.assertEqual(models.QueuedEmail.objects.count(), 1)
+        self.assertEqual(digest.flush(), 1)
+        self.assertEqual(models.PendingNotification.objects.count(), 0)
+        email = models.QueuedEmail.objects.get(subject__contains='2 messages')
+        self.assertTrue('Second' in email.body and 'Three' in email.body)
+        self.assertEqual(digest.flush(), 0)
+
+    def test_flush_when_full(self):
+        self.profile.digest = True
+        self.profile.save()
+        for i in xrange(settings.DIGEST_MAX_PENDING):
+            digest.notify(self.profile, 'Ride %d' % i, 'Hello')
+        self.assertEqual(models.PendingNotification.objects.count(), 0)
+        self.assertEqual(models.QueuedEmail.objects.count(), 1)
+
+class EmailTemplateTest(TestCase):
+    '''Tests for rendering email templates'''
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.txt')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def write(self, contents, mtime):
+        with open(self.filename, 'w') as output:
+            output.write(contents)
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_render(self):
+        self.write("Hi {{user.first_name}}, from {{city.upper()}}", 1000)
+        context = {'user': User(first_name='Joe'), 'city': 'Oberlin'}
+        self.assertEqual(helpers.render_message(self.filename, context), "Hi Joe, from OBERLIN")
+        # Changes to the file are picked up
+        self.write("Bye {{user.first_name}}", 2000)
+        self.assertEqual(helpers.render_message(self.filename, context), "Bye Joe")
+
+    def test_restricted(self):
+        for placeholder in ("{{__import__('os').getcwd()}}", "{{user.first_name + 'x'}}", "{{a[0]}}"):
+            self.assertRaises(emails.TemplateError, emails.compile_template, placeholder)
+
+class RouteIndexTest(TestCase):
+    '''Tests for the in-process index of offer routes'''
+
+    def setUp(self):
+        self.fixtures = []
+        user, profile = create_user(alex)
+        self.fixtures.extend([user, profile])
+        self.route = [(41.2, -82.3), (41.5, -82.3), (41.5, -81.7), (41.2, -81.7)]
+        self.offer = create_offer(walmart, airport, alex, polygon=self.route)
+        self.fixtures.append(self.offer)
+        # An index of its own, standing in for that of another process
+        self.index = spatial.RouteIndex()
+        self.index.CATCHUP_INTERVAL = timedelta(0)
+
+    def tearDown(self):
+        for f in self.fixtures:
+            f.delete()
+
+    def test_edited_elsewhere(self):
+        '''Routes saved by other processes are picked up, and moved or departed ones dropped'''
+        self.assertEqual(self.index.containing((iga[1], iga[2])), [self.offer.id])
+        elsewhere = [(p[0] + 10, p[1]) for p in self.route]
+        self.offer.polygon = elsewhere
+        self.offer.save()
+        self.assertEqual(self.index.containing((iga[1], iga[2])), [])
+        self.assertEqual(self.index.containing((51.3, -82.0)), [self.offer.id])
+
+        self.offer.date = datetime.now() - timedelta(hours=1)
+        self.offer.save()
+        self.assertEqual(self.index.containing((51.3, -82.0)), [])
+
+    def test_evict_departed(self):
+        self.assertEqual(self.index.containing((iga[1], iga[2])), [self.offer.id])
+        self.index._evict(self.offer.date + timedelta(minutes=1))
+        self.assertEqual(self.index._entries, {})
+
+    def test_catch_up_throttled(self):
+        self.index.containing((iga[1], iga[2]))
+        self.index.CATCHUP_INTERVAL = timedelta(hours=1)
+        other = create_offer(walmart, airport, alex, polygon=self.route)
+        self.fixtures.append(other)
+        self.assertEqual(self.index.containing((iga[1], iga[2])), [self.offer.id])
+
+class RouteBoxerTest(TestCase):
+    '''Tests for boxing routes on the server'''
+
+    def test_decode_polyline(self):
+        # The example from Google's documentation
+        points = helpers.decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        expected = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        for point, expect in zip(points, expected):
+            self.assertAlmostEqual(point[0], expect[0])
+            self.assertAlmostEqual(point[1], expect[1])
+
+    def test_route_boxes_cover_route(self):
+        path = [(iga[1], iga[2]), (airport[1], airport[2])]
+        boxes = helpers.route_boxes(path, 10)
+        def covered(point):
+            for i in xrange(0, len(boxes), 4):
+                if boxes[i+2] <= point[0] <= boxes[i] and boxes[i+3] <= point[1] <= boxes[i+1]:
+                    return True
+            return False
+        for i in xrange(11):
+            point = (iga[1] + (airport[1] - iga[1]) * i / 10.0,
+                     iga[2] + (airport[2] - iga[2]) * i / 10.0)
+            self.assertTrue(covered(point))
+            self.assertTrue(covered((point[0] + 0.05, point[1])))
+        self.assertFalse(covered((40.0, -80.0)))
+
+    def test_route_distance_limits(self):
+        '''Distances are kept within limits, and routes needing huge grids are refused'''
+        path = [(iga[1], iga[2]), (airport[1], airport[2])]
+        smallest = helpers.route_boxes(path, helpers.MIN_ROUTE_DISTANCE)
+        for distance in (0, -5, 1e-9, float('nan')):
+            self.assertEqual(helpers.route_boxes(path, distance), smallest)
+        self.assertEqual(helpers.route_boxes(path, 1e6), helpers.route_boxes(path, helpers.MAX_ROUTE_DISTANCE))
+        self.assertRaises(helpers.RouteError, helpers.route_boxes, [(-60, -170), (70, 170)], 1)
+
+        response = Client().post("/request/search/", '{"polyline": "_p~iF~ps|U_ulLnnqC_mqNvxq`@", "distance": "far"}',
+                                 content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_merged_route_covers_boxes(self):
+        '''The simplified route polygon still covers every box along the route'''
+        path = [(iga[1], iga[2]), (airport[1], airport[2]), (cvs[1], cvs[2])]
+        boxes = helpers.route_boxes(path, 10)
+        polygon, contour = views._merge_boxes(boxes)
+        self.assertEqual(polygon.nPoints(), len(contour))
+        self.assertFalse(helpers.self_intersects(contour))
+        for i in xrange(0, len(boxes), 4):
+            for corner in ((boxes[i], boxes[i+1]), (boxes[i+2], boxes[i+3]),
+                           (boxes[i], boxes[i+3]), (boxes[i+2], boxes[i+1])):
+                self.assertTrue(polygon.isInside(*corner))
+
+    def test_simplify_self_crossing(self):
+        '''Outlines that would cross themselves once simplified are kept as they are'''
+        contour = [(-0.58, 0.53), (-0.6, 0.44), (-0.08, -0.91), (0.15, -0.36), (0.32, -0.66), (0.22, -0.43)]
+        self.assertFalse(helpers.self_intersects(contour))
+        self.assertEqual(helpers.simplify_contour(contour, 0.1), contour)
+        self.assertTrue(helpers.self_intersects([(0, 0), (1, 1), (1, 0), (0, 1)]))
+
+    def test_simplify_tolerance_cap(self):
+        '''The tolerance isn't raised past its cap to get down to the most vertices'''
+        circle = [(math.cos(i * math.pi / 100), math.sin(i * math.pi / 100)) for i in xrange(200)]
+        capped = helpers.simplify_contour(circle, 0.0001, max_vertices=4, max_tolerance=0.01)
+        self.assertEqual(capped, helpers.simplify_contour(circle, 0.0001 * 2**6))
+        self.assertTrue(len(capped) > 4)
+        self.assertTrue(len(helpers.simplify_contour(circle, 0.0001, max_vertices=4)) <= 4)
@@ -3,56 +3,169 @@ from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
 from mongoengine.queryset import Q
 from mongoengine.django.auth import User
-from models import RideRequest, UserProfile, RideOffer, Location, Trust
-from forms import AskForRideForm, OfferRideForm, OfferOptionsForm, RequestOptionsForm, CancellationForm, DriverFeedbackForm, RiderFeedbackForm, RideRequestOfferSearchForm, RideOfferPutForm, RideRequestPutForm
+from models import RideRequest, UserProfile, RideOffer, RideMatch, Location
+from forms import FUZZY_OPTIONS, AskForRideForm, OfferRideForm, OfferOptionsForm, RequestOptionsForm, CancellationForm, DriverFeedbackForm, RiderFeedbackForm, RideRequestOfferSearchForm, RideOfferPutForm, RideRequestPutForm
 from datetime import datetime, timedelta
 from random import random
 from time import strptime,mktime
 from django.core.urlresolvers import reverse
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseRedirect, HttpResponse, Http404
-from Polygon.Shapes import Rectangle, Polygon
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, Http404
+from django.views.decorators.http import require_POST
+from Polygon import Polygon
+from Polygon.Shapes import Rectangle
 from encoders import RideRequestEncoder, RideOfferEncoder
-from helpers import send_email, _hostname, geospatial_distance, get_mongo_or_404, render_message
+from spatial import route_index
+from prefetch import prefetch_profiles, reference_id, reference_ids
+from pagination import paginate_list, paginate_together, decode_cursor, rides_after, page_size
+import repository
+import digest
+import searchcache
+from projections import project, raw_projection
+from archive import archived
+from obietaxi import settings
+from helpers import send_email, send_emails, send_message_emails, _hostname, geospatial_distances, points_in_polygon, bounding_box, time_window, simplify_contour, decode_polyline, route_boxes, RouteError, get_mongo_or_404, render_message, NEARBY_DISTANCE
 import json
+import math
+import numpy
 
 ####################
 # HELPERS TO VIEWS #
 ####################
 
-def _dates_match( date1, fuzzy1, date2, fuzzy2 ):
+# Route polygons cover everything within this many km of the route
+ROUTE_BOX_DISTANCE = 10
+
+# The fuzzinesses a search may have
+FUZZINESS = [option[0] for option in FUZZY_OPTIONS]
+
+# The error code of a write that would break a unique index
+DUPLICATE_KEY = 11000
+
+def _window_filters( date, fuzziness ):
     '''
-    Determines if there is an overlap between two sets of dates (including fuzziness).
-    Returns True or False.
+    Returns query filters that find rides whose time windows overlap that of a ride
+    at <date> with <fuzziness>. An empty dictionary means any ride will do.
     '''
+    if fuzziness == 'anytime':
+        return {}
+    window = time_window( date, fuzziness )
+    return { 'window_start__lte':window[1], 'window_end__gte':window[0] }
 
-    # What fuzzy trumps? It is the lesser of the two fuzzies :)
-    for fuzz_option in ('1-hours','2-hours','3-hours','4-hours','5-hours','day','week','anytime'):
-        if fuzz_option in (fuzzy1, fuzzy2):
-            fuzzy = fuzz_option
-
-    # Larger fuzzy times: check date
-    if fuzzy == 'anytime':
-        return True
-    elif fuzzy == 'week' and abs( (date1.date() - date2.date()).days ) > 7:
-        return False
-    elif fuzzy == 'day' and date1.date() != date2.date():
-        return False
+def _any_of( clauses ):
+    '''
+    A Q object finding documents that match any of <clauses>, e.g. one for each search
+    in a bulk search. Each clause is a dictionary of query filters and the (date, id)
+    of the ride a page of results starts after, or None for the first page.
 
-    # Check times for small fuzzies
-    if '-' in fuzzy:
-        numHours = int(fuzzy.split('-')[0])
-        lowerBound = (date1 - timedelta(hours=numHours)).replace(tzinfo=None)
-        upperBound = (date1 + timedelta(hours=numHours)).replace(tzinfo=None)
-        date2 = date2.replace(tzinfo=None)
-        date1 = date1.replace(tzinfo=None)
+    Each search keeps its own area, time window and page, rather than the database
+    scanning everything between them. Clauses repeated by several searches are only
+    sent once.
+    '''
+    query = None
+    seen = []
+    for clause in clauses:
+        if clause in seen:
+            continue
+        seen.append( clause )
+        filters, after = clause
+        clause = Q( **filters ) if after is None else Q( **filters ) & rides_after( after )
+        query = clause if query is None else query | clause
+    return query
+
+def _in_windows( rides, window ):
+    ''' A boolean NumPy array telling which of <rides> have time windows overlapping <window> '''
+    starts = numpy.array( [ride.window_start for ride in rides], dtype='datetime64[us]' )
+    ends = numpy.array( [ride.window_end for ride in rides], dtype='datetime64[us]' )
+    return (starts <= numpy.datetime64(window[1])) & (ends >= numpy.datetime64(window[0]))
+
+def _offer_search_many( searches, other_filters=None ):
+    '''
+    Searches for the RideOffers matching each of <searches>, dictionaries holding the
+    criteria taken by _offer_search. The searches share their trips to the database:
+    one query finds offers starting near any of the requests (or they come from
+    searchcache.py, if it is enabled), and another fetches the offers whose routes
+    contain a request's endpoints, according to the route index.
 
-        if date2 < lowerBound or date2 > upperBound:
-            return False
+    <other_filters> is a dictionary of other filters to apply in the query.
 
-    return True
+    Returns a list holding the list of matching RideOffers for each search.
+    '''
+    if not searches:
+        return []
+    req_starts = [(float(s['start_lat']), float(s['start_lng'])) for s in searches]
+    req_ends = [(float(s['end_lat']), float(s['end_lng'])) for s in searches]
+    windows = [_window_filters( s['date'], s['fuzziness'] ) for s in searches]
+    pages = [s.get( 'after' ) for s in searches]
+    other_filters = other_filters or {}
+
+    candidates = {}
+    # offer ids for each search, to be loaded below
+    wanted = [set() for s in searches]
+    if searchcache.enabled() and not other_filters:
+        # Offers starting near each request's start, from the cache (see searchcache.py)
+        for search, req_start, ids in zip( searches, req_starts, wanted ):
+            south, west, north, east = bounding_box( req_start, NEARBY_DISTANCE )
+            window = time_window( search['date'], search['fuzziness'] )
+            for offer_id, lat, lng, window_start, window_end in searchcache.nearby_offers(
+                    req_start, search['date'], search['fuzziness'], _nearby_offer_rows ):
+                if south <= lat <= north and west <= lng <= east and window_start <= window[1] and window_end >= window[0]:
+                    ids.add( offer_id )
+    else:
+        # Offers starting within NEARBY_DISTANCE of a request's start, during its time window
+        clauses = []
+        for req_start, window, after in zip( req_starts, windows, pages ):
+            south, west, north, east = bounding_box( req_start, NEARBY_DISTANCE )
+            clauses.append( (dict( window, start__position__within_box=[(south,west),(north,east)] ), after) )
+        for offer in project( RideOffer.objects.filter( _any_of(clauses), **other_filters ), 'match' ):
+            candidates[offer.id] = offer
+
+    # Offers whose routes contain both of a request's endpoints, during its time window
+    on_route = [set( ids ) for ids in route_index.containing_each( zip(req_starts, req_ends) )]
+    clauses = []
+    for routed, ids, window, after in zip( on_route, wanted, windows, pages ):
+        routed = routed.difference( candidates )
+        if routed:
+            clauses.append( (dict( window, id__in=sorted(routed) ), after) )
+        ids = ids.difference( candidates, routed )
+        if ids:
+            clauses.append( ({ 'id__in':sorted(ids) }, after) )
+    if clauses:
+        for offer in project( RideOffer.objects.filter( _any_of(clauses), **other_filters ), 'match' ):
+            candidates[offer.id] = offer
+
+    offers = candidates.values()
+    if not offers:
+        return [[] for s in searches]
+    offer_starts = [offer.start.position for offer in offers]
+    offer_ends = [offer.end.position for offer in offers]
+
+    # Check every candidate against each search, all candidates at once:
+    # 1. Time windows must overlap, and
+    # 2. Must have start point near req. start and end point near req. end --OR--
+    # 3. Must have polygon field that overlays start & end of this request
+    results = []
+    for search, req_start, req_end, routed in zip( searches, req_starts, req_ends, on_route ):
+        matches = _in_windows( offers, time_window(search['date'], search['fuzziness']) )
+        nearby = ( (geospatial_distances(offer_starts, req_start) < NEARBY_DISTANCE) &
+                   (geospatial_distances(offer_ends, req_end) < NEARBY_DISTANCE) )
+        matches &= nearby | numpy.array( [offer.id in routed for offer in offers] )
+        results.append( [offer for offer, match in zip( offers, matches ) if match] )
+    return results
+
+def _nearby_offer_rows( box, window ):
+    '''
+    (id, lat, lng, window start, window end) of the RideOffers starting inside <box>,
+    (south, west, north, east), with time windows overlapping <window>. Fills searchcache.
+    '''
+    south, west, north, east = box
+    offers = RideOffer.objects.filter( start__position__within_box=[(south,west),(north,east)],
+                                       window_start__lte=window[1], window_end__gte=window[0] )
+    return [(offer.id, offer.start.position[0], offer.start.position[1], offer.window_start, offer.window_end)
+            for offer in offers.only( 'id', 'start', 'window_start', 'window_end' )]
 
 def _offer_search( **kwargs ):
     '''
@@ -69,83 +182,186 @@ def _offer_search( **kwargs ):
 
     NOT REQUIRED:
     other_filters : a dictionary containing other filters to apply in the query
+    after : a (date, id), from pagination.decode_cursor(); only offers coming after
+            it are looked for
 
     Returns a list of RideOffers that match
     '''
-
-    # Find all offers that match our time constraints
-    request_date = kwargs['date']
-    request_fuzzy = kwargs['fuzziness']
-    if '-' in request_fuzzy:
-        delta = timedelta(hours=int(request_fuzzy.split('-')[0]))
-        earliest_offer = request_date - delta
-        latest_offer = request_date + delta
-    elif request_fuzzy == 'day':
-        earliest_offer = datetime(request_date.year, request_date.month, request_date.day)
-        next_day = request_date + timedelta(days=1)
-        latest_offer = datetime(next_day.year, next_day.month, next_day.day)
-    elif request_fuzzy == 'week':
-        delta = timedelta(days=3, hours=12)
-        earliest_offer = request_date - delta
-        latest_offer = request_date + delta
-
-    if 'other_filters' in kwargs:
-        if request_fuzzy == 'anytime':
-            offers = RideOffer.objects.filter( **kwargs['other_filters'] )
-        else:
-            offers = RideOffer.objects.filter( date__gte=earliest_offer,
-                                               date__lte=latest_offer,
-                                               **kwargs['other_filters'] )
-    else:
-        if request_fuzzy == 'anytime':
-            offers = RideOffer.objects.all()
-        else:
-            offers = RideOffer.objects.filter( date__gte=earliest_offer,
-                                               date__lte=latest_offer )
-
-    # Filter offers further:
-    # 1. Must have start point near req. start and end point near req. end --OR--
-    # 2. Must have polygon field that overlays start & end of this request
-    filtered_offers = []
-    for offer in offers:
-        # Results might be less fuzzy than we are, so do some checking here
-        if not _dates_match( offer.date, offer.fuzziness, request_date, request_fuzzy ):
-            continue
-        # Geographical constraints
-        req_start = (float(kwargs['start_lat']),
-                     float(kwargs['start_lng']))
-        req_end = (float(kwargs['end_lat']),
-                   float(kwargs['end_lng']))
-        start_dist = geospatial_distance( offer.start.position, req_start )
-        end_dist = geospatial_distance( offer.end.position, req_end )
-        if start_dist < 5 and end_dist < 5:
-            filtered_offers.append( offer )
-        elif len(offer.polygon) > 0:
-            polygon = Polygon( offer.polygon )
-            if polygon.isInside( *req_start ) and polygon.isInside( *req_end ):
-                filtered_offers.append( offer )
-    return filtered_offers
+    return _offer_search_many( [kwargs], kwargs.get('other_filters') )[0]
 
 def _merge_boxes( boxes ):
     '''
     Merges a list of points specifying contiguous boxes into a single
     Polygon.  Returns the polygon, list of points on the polygon.
+
+    The contour is simplified according to the ROUTE_SIMPLIFY_TOLERANCE,
+    ROUTE_MAX_VERTICES and ROUTE_MAX_SIMPLIFY_TOLERANCE settings. Simplifying moves
+    the outline by up to the tolerance, inwards as well as outwards, so each box is
+    first grown by ROUTE_SIMPLIFY_TOLERANCE on every side: that way the simplified
+    polygon still covers every box. A contour simplified harder than that to get
+    down to ROUTE_MAX_VERTICES can cut into the boxes by the difference, and one
+    that needs more than ROUTE_MAX_SIMPLIFY_TOLERANCE keeps its extra vertices.
     '''
-    # bboxArea = the union of all the bounding boxes on the route
-    bboxArea = None
-    # union all the boxes together
+    tolerance = settings.ROUTE_SIMPLIFY_TOLERANCE
+    # Make a Rectangle out of the width/height of each bounding box
+    # longitude = x, latitude = y
+    areas = []
     for i in xrange(0,len(boxes),4):
-        # Make a Rectangle out of the width/height of a bounding box
-        # longitude = x, latitude = y
-        theRect = Rectangle( abs(boxes[i] - boxes[i+2]),
-                             abs(boxes[i+1] - boxes[i+3]) )
-        theRect.shift( boxes[i+2], boxes[i+3] )
-        bboxArea = bboxArea + theRect if bboxArea else theRect
+        theRect = Rectangle( abs(boxes[i] - boxes[i+2]) + 2*tolerance,
+                             abs(boxes[i+1] - boxes[i+3]) + 2*tolerance )
+        theRect.shift( boxes[i+2] - tolerance, boxes[i+3] - tolerance )
+        areas.append( theRect )
+
+    # bboxArea = the union of all the bounding boxes on the route.
+    # Union neighbours pairwise, so that each union works on polygons of similar size
+    # rather than adding one box at a time to an ever-growing polygon.
+    while len(areas) > 1:
+        areas = [areas[i] + areas[i+1] if i+1 < len(areas) else areas[i]
+                 for i in xrange(0,len(areas),2)]
 
     # turn bboxArea into a list of points
-    bboxContour = [list(t) for t in bboxArea.contour( 0 )]
+    bboxContour = simplify_contour( [list(t) for t in areas[0].contour( 0 )], tolerance,
+                                    settings.ROUTE_MAX_VERTICES, settings.ROUTE_MAX_SIMPLIFY_TOLERANCE )
+
+    # The area is built from the contour, so that the two agree
+    return Polygon( bboxContour ), bboxContour
 
-    return bboxArea, bboxContour
+def _record_matches( ride ):
+    '''
+    Records the RideMatches of <ride>, a RideOffer or RideRequest that has just been
+    posted, by matching it against the other side only. Matches of a deleted ride
+    go away with it.
+
+    A ride posted at the same time on the other side may record some of the same
+    matches. The unique (offer, request) index keeps one of each, and the matches
+    are inserted unordered, so that a duplicate doesn't stop the rest.
+    '''
+    if isinstance( ride, RideOffer ):
+        RideMatch.objects.filter( offer=ride ).delete()
+        # Requests along the route...
+        requests = dict( (req.id, req) for req in _request_search( polygon=ride.polygon,
+                                                                    date=ride.date,
+                                                                    fuzziness=ride.fuzziness ) )
+        # ...and those starting and ending near the offer
+        south, west, north, east = bounding_box( ride.start.position, NEARBY_DISTANCE )
+        nearby = list( RideRequest.objects.filter( start__position__within_box=[(south,west),(north,east)],
+                                                   **_window_filters( ride.date, ride.fuzziness ) ) )
+        if nearby:
+            close = (geospatial_distances( [req.start.position for req in nearby], ride.start.position ) < NEARBY_DISTANCE) & \
+                    (geospatial_distances( [req.end.position for req in nearby], ride.end.position ) < NEARBY_DISTANCE)
+            requests.update( (req.id, req) for req, near in zip( nearby, close ) if near )
+        matches = [RideMatch( offer=ride, request=req, driver=ride.driver, passenger=req.passenger )
+                   for req in requests.values()]
+    else:
+        RideMatch.objects.filter( request=ride ).delete()
+        offers = _offer_search( start_lat=ride.start.position[0], start_lng=ride.start.position[1],
+                                end_lat=ride.end.position[0], end_lng=ride.end.position[1],
+                                date=ride.date, fuzziness=ride.fuzziness )
+        matches = [RideMatch( offer=offer, request=ride, driver=offer.driver, passenger=ride.passenger )
+                   for offer in offers]
+    if matches:
+        bulk = RideMatch._get_collection().initialize_unordered_bulk_op()
+        for match in matches:
+            bulk.insert( match.to_mongo() )
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            if e.details.get( 'writeConcernErrors' ) or \
+                    any( error['code'] != DUPLICATE_KEY for error in e.details['writeErrors'] ):
+                raise
+
+def _route_polygon( route ):
+    '''
+    Builds the polygon around a route posted by a client, which is either
+    {"polyline": <encoded polyline>, "distance": <km>}, to be boxed here, or
+    {"rectangles": [...]} from clients that run RouteBoxer themselves.
+    Returns the same as _merge_boxes. Raises RouteError for a route that can't be boxed.
+    '''
+    if not isinstance( route, dict ):
+        raise RouteError( "The route must be an object" )
+    if 'polyline' in route:
+        if not isinstance( route['polyline'], basestring ):
+            raise RouteError( "The polyline must be a string" )
+        try:
+            distance = float( route.get('distance', ROUTE_BOX_DISTANCE) )
+        except (TypeError, ValueError):
+            raise RouteError( "The distance must be a number of km" )
+        boxes = route_boxes( decode_polyline(route['polyline']), distance )
+    else:
+        try:
+            boxes = numpy.asarray( route.get('rectangles'), dtype=float )
+        except (TypeError, ValueError):
+            boxes = None
+        if boxes is None or boxes.ndim != 1 or not len(boxes) or len(boxes) % 4 or not numpy.isfinite( boxes ).all():
+            raise RouteError( "The rectangles must be a list of numbers, four for each box" )
+        boxes = boxes.tolist()
+    return _merge_boxes( boxes )
+
+def _ending_inside( requests, polygon ):
+    ''' Those of <requests> ending inside <polygon> '''
+    inside = points_in_polygon( [req.end.position for req in requests], polygon )
+    return [req for req, end_inside in zip( requests, inside ) if end_inside]
+
+def _first_ending_inside( requests, polygon, limit ):
+    '''
+    The first <limit> of <requests>, a QuerySet, that end inside <polygon>. They are
+    checked <limit> at a time, so that no more are fetched than are needed.
+    '''
+    found, batch = [], []
+    for req in requests:
+        batch.append( req )
+        if len(batch) == limit:
+            found.extend( _ending_inside( batch, polygon ) )
+            batch = []
+            if len(found) >= limit:
+                break
+    found.extend( _ending_inside( batch, polygon ) )
+    return found[:limit]
+
+def _request_search_many( searches, other_filters=None, limit=None ):
+    '''
+    Searches for the RideRequests matching each of <searches>, dictionaries holding
+    the criteria taken by _request_search. One query fetches the requests starting
+    inside any of the routes, during that search's time window; these are then
+    checked against each search.
+
+    Routes are treated as flat in (lat,lng), as they are drawn: the database's
+    $polygon, points_in_polygon and the route index all agree on what is inside.
+
+    <other_filters> is a dictionary of other filters to apply in the query. If there
+    is a single search, only the first <limit> matches in (date, id) order are
+    returned.
+
+    Returns a list holding the list of matching RideRequests for each search.
+    '''
+    routed = [s for s in searches if s['polygon']]
+    if not routed:
+        return [[] for s in searches]
+    # Requests starting inside a route, during its time window
+    clauses = [(dict( _window_filters( s['date'], s['fuzziness'] ), start__position__within_polygon=s['polygon'] ),
+                s.get( 'after' )) for s in routed]
+    requests = RideRequest.objects.filter( _any_of(clauses), **(other_filters or {}) )
+    if limit and len(routed) == 1:
+        # Only the ends are left to check, so the page can be taken in order
+        page = _first_ending_inside( project( requests.order_by( 'date', 'id' ), 'match' ),
+                                     routed[0]['polygon'], limit )
+        return [page if s['polygon'] else [] for s in searches]
+    requests = list( project( requests, 'match' ) )
+    if not requests:
+        return [[] for s in searches]
+    req_starts = [req.start.position for req in requests]
+    req_ends = [req.end.position for req in requests]
+
+    results = []
+    for search in searches:
+        if not search['polygon']:
+            results.append( [] )
+            continue
+        matches = _in_windows( requests, time_window(search['date'], search['fuzziness']) )
+        matches &= points_in_polygon( req_starts, search['polygon'] )
+        matches &= points_in_polygon( req_ends, search['polygon'] )
+        results.append( [req for req, match in zip( requests, matches ) if match] )
+    return results
 
 def _request_search( **kwargs ):
     '''
@@ -159,30 +375,14 @@ def _request_search( **kwargs ):
 
     NOT REQUIRED:
     other_filters : a dictionary containing other filters to apply in the query
+    after : a (date, id), from pagination.decode_cursor(); only requests coming after
+            it are looked for
+    limit : how many requests to return at most, the first in (date, id) order
 
-    Returns a list of RideOffers that match
+    Returns a list of RideRequests that match
 
     '''
-    polygon = kwargs['polygon']
-    offer_start_time = kwargs['date']
-    offer_fuzziness = kwargs['fuzziness']
-
-    # RideRequests within the bounds
-    if not 'other_filters' in kwargs:
-        requests_within_start = RideRequest.objects.filter( start__position__within_polygon=polygon )
-    else:
-        requests_within_start = RideRequest.objects.filter( start__position__within_polygon=polygon,
-                                                            **kwargs['other_filters'] )
-
-    # Filter by date
-    def in_date( req ):
-        return _dates_match( req.date, req.fuzziness, offer_start_time, offer_fuzziness )
-    requests_within_start = [req for req in requests_within_start if in_date(req)]
-
-    # Can't do two geospatial queries at once :(
-    bboxArea = Polygon( polygon )
-    requests_on_route = [r for r in requests_within_start if bboxArea.isInside(*r.end.position)]
-    return requests_on_route
+    return _request_search_many( [kwargs], kwargs.get('other_filters'), kwargs.get('limit') )[0]
 
 
 #########
@@ -194,7 +394,7 @@ def offer_ride( request ):
     ''' Sends an offer for a ride to someone who has made a RideRequest '''
 
     data = request.POST
-    profile = request.session.get("profile")
+    profile = request.profile
     req = RideRequest.objects.get( pk=ObjectId(data['request_id']) )
     msg = data['msg']
     offer_choices = data['offer_choices'] if 'offer_choices' in data else 'new'
@@ -214,8 +414,7 @@ def offer_ride( request ):
             date = req.date,
             message = msg
         )
-        profile.offers.append( offer )
-        profile.save()
+        _record_matches( offer )
     else:
         offer = RideOffer.objects.get( pk=ObjectId(offer_choices) )
         offer.message = msg
@@ -237,13 +436,11 @@ def offer_ride( request ):
     appended = render_message( 'taxi/static/emails/offer_ride_accept_or_decline.txt', locals() )
     msg = "\r\n".join( (msg,30*'-',appended) )
 
-    # Save this asker in the offer's 'askers' field
-    req.askers.append( offer )
-    req.save()
+    # Save this asker in the request's 'askers' field
+    repository.add_request_asker( req, offer )
 
-    dest_email = req.passenger.user.username
     subject = "{} can drive you to {}".format( profile, req.end )
-    send_email( email_to=dest_email, email_body=msg, email_subject=subject )
+    digest.notify( req.passenger, subject, msg )
     messages.add_message( request, messages.SUCCESS, "Your offer has been sent successfully." )
     return HttpResponseRedirect( reverse("browse") )
 
@@ -257,7 +454,7 @@ def process_offer_ride( request, ride_response, ride_offer, ride_request ):
     request_id = ride_request
     offer_id = ride_offer
     response = ride_response
-    profile = request.session.get("profile")
+    profile = request.profile
 
     # Do some error checking
     def fail( msg ):
@@ -281,13 +478,7 @@ def process_offer_ride( request, ride_response, ride_offer, ride_request ):
 
     # Update the RideOffer instance to accept/decline the request
     if response == 'accept':
-        req.ride_offer = offer
-
-        if len(offer.passengers) == 0:
-            offer.passengers = [profile]
-        else:
-            offer.passengers.append( profile )
-        offer.save()
+        repository.accept_offer( req, offer )
 
         # Email the driver, confirming the fact that they've decided to give a ride.
         body_driver = render_message( "taxi/static/emails/driver_thankyou.txt", locals() )
@@ -301,9 +492,9 @@ def process_offer_ride( request, ride_response, ride_offer, ride_request ):
         send_email( email_to=profile.user.username,
                     email_body=body_requester,
                     email_subject="Your ride %s"%str(req) )
+    else:
+        repository.remove_request_asker( req, offer )
 
-    req.askers.remove( offer )
-    req.save()
     messages.add_message( request,
                           messages.SUCCESS, "You have {} {}'s offer".format('accepted' if response == 'accept' else 'declined',
                                                                             str(driver)) )
@@ -315,7 +506,7 @@ def ask_for_ride( request ):
     ''' Asks for a ride from a particular offer '''
 
     data = request.POST
-    profile = request.session.get("profile")
+    profile = request.profile
     offer = RideOffer.objects.get( pk=ObjectId(data['offer_id']) )
     msg = data['msg']
     request_id = data['request_choices'] if 'request_choices' in data else 'new'
@@ -336,8 +527,7 @@ def ask_for_ride( request ):
             date = offer.date
         )
         request_id = req.id
-        profile.requests.append( req )
-        profile.save()
+        _record_matches( req )
     else:
         req = RideRequest.objects.get( pk=ObjectId(request_id) )
         req.message = msg
@@ -360,12 +550,10 @@ def ask_for_ride( request ):
     msg = "\r\n".join( (msg,30*'-',appended) )
 
     # Save this asker in the offer's 'askers' field
-    offer.askers.append( req )
-    offer.save()
+    repository.add_offer_asker( offer, req )
 
-    dest_email = offer.driver.user.username
     subject = "{} {} is asking you for a ride!".format( request.user.first_name, request.user.last_name )
-    send_email( email_to=dest_email, email_body=msg, email_subject=subject )
+    digest.notify( offer.driver, subject, msg )
     messages.add_message( request, messages.SUCCESS, "Your request has been sent successfully." )
     return HttpResponseRedirect( reverse("browse") )
 
@@ -377,7 +565,7 @@ def process_ask_for_ride( request, ride_response, ride_offer, ride_request ):
     offer_id = ride_offer
     request_id = ride_request
     response = ride_response
-    profile = request.session.get("profile")
+    profile = request.profile
 
     # Do some error checking
     def fail( msg ):
@@ -401,13 +589,8 @@ def process_ask_for_ride( request, ride_response, ride_offer, ride_request ):
 
     # Update the RideOffer instance to accept/decline the request
     if response == 'accept':
-        if len(offer.passengers) == 0:
-            offer.passengers = [rider]
-        else:
-            offer.passengers.append( rider )
-        # Save this offer inside of the RideRequest
-        req.ride_offer = offer
-        req.save()
+        # Add the passenger to the offer, and save this offer inside of the RideRequest
+        repository.accept_request( offer, req )
         # Email the driver, confirming the fact that they've decided to give a ride.
         # Also give them passenger's contact info.
         body_driver = render_message( "taxi/static/emails/driver_thankyou.txt", locals() )
@@ -421,9 +604,9 @@ def process_ask_for_ride( request, ride_response, ride_offer, ride_request ):
         send_email( email_to=rider.user.username,
                     email_body=body_requester,
                     email_subject="Your ride from %s to %s"%(offer.start,offer.end) )
+    else:
+        repository.remove_offer_asker( offer, req )
 
-    offer.askers.remove( req )
-    offer.save()
     messages.add_message( request,
                           messages.SUCCESS,
                           "You have {} {}'s request".format('accepted' if response == 'accept' else 'declined',
@@ -468,15 +651,17 @@ def _process_ro_form( request, type ):
         kwargs = { 'start':startLocation, 'end':endLocation, 'date':date, 'fuzziness':fuzziness }
 
         # Associate request/offer with user
-        profile = request.session.get('profile')
+        profile = request.profile
         kwargs[ 'passenger' if type == 'request' else 'driver' ] = profile
 
         # Create offer/request object in database
         ride_requests = ride_offers = None
         if type == 'offer':
-            # Also grab "polygon" field, merge boxes into polygon
-            boxes = json.loads( data['polygon'] )
-            polygon, contour = _merge_boxes( boxes['rectangles'] )
+            # Also grab "polygon" field, turn the route into a polygon
+            try:
+                polygon, contour = _route_polygon( json.loads(data['polygon']) )
+            except RouteError as e:
+                return HttpResponseBadRequest( str(e) )
             kwargs['polygon'] = contour
             ro = RideOffer( **kwargs )
 
@@ -486,7 +671,7 @@ def _process_ro_form( request, type ):
                                          start=ro.start,
                                          end=ro.end ).count() == 0:
                 ro.save()
-                profile.offers.append( ro )
+                _record_matches( ro )
         elif type == 'request':
             rr = RideRequest( **kwargs )
 
@@ -496,8 +681,7 @@ def _process_ro_form( request, type ):
                                            start=rr.start,
                                            end=rr.end ).count() == 0:
                 rr.save()
-                profile.requests.append( rr )
-        profile.save()
+                _record_matches( rr )
 
         ride_requests = RideRequest.objects.filter( date__gte=datetime.now() )
         ride_offers = RideOffer.objects.filter( date__gte=datetime.now() )
@@ -526,8 +710,11 @@ def offer_search( request ):
     # Use the form data
     form = RideRequestOfferSearchForm( request.POST )
     if form.is_valid():
-        filtered_offers = _offer_search( **form.cleaned_data )
-        return HttpResponse( json.dumps({"offers":filtered_offers}, cls=RideOfferEncoder),
+        cursor = request.POST.get( 'cursor' )
+        filtered_offers, next_cursor = paginate_list( _offer_search(after=decode_cursor(cursor), **form.cleaned_data),
+                                                      cursor )
+        prefetch_profiles( filtered_offers )
+        return HttpResponse( json.dumps({"offers":filtered_offers, "next":next_cursor}, cls=RideOfferEncoder),
                              mimetype='application/json' )
     # Something went wrong.... return an empty response?
     return HttpResponse()
@@ -540,9 +727,15 @@ def offer_search_and_display( request ):
     '''
     form = RideRequestOfferSearchForm( request.POST )
     if form.is_valid():
-        ride_offers = _offer_search( **form.cleaned_data )
-        # Filter outdated results
-        ride_offers = [o for o in ride_offers if o.date >= datetime.now()]
+        # Leave out outdated results. This is done here rather than in the query, so
+        # that the search can be answered from the cache.
+        now = datetime.now()
+        cursor = request.POST.get( 'cursor' )
+        ride_offers = [offer for offer in _offer_search( after=decode_cursor(cursor), **form.cleaned_data )
+                       if offer.date >= now]
+        ride_offers, next_cursor = paginate_list( ride_offers, cursor )
+        prefetch_profiles( ride_offers )
+        page_params = _page_params( request )
         return _browse( request, locals() )
     return render_to_response( "index.html",
                                locals(),
@@ -563,16 +756,25 @@ def request_search( request ):
 
     '''
     postData = json.loads( request.raw_post_data )
-    rectangles = postData['rectangles']
-    bboxArea, bboxContour = _merge_boxes( rectangles )
+    try:
+        bboxArea, bboxContour = _route_polygon( postData )
+    except RouteError as e:
+        return HttpResponseBadRequest( str(e) )
 
     offer_start_time = datetime.fromtimestamp( float(postData['start_time'])/1000 )
     offer_fuzziness = postData['fuzziness']
 
     requestEncoder = RideRequestEncoder()
-    requests = { "requests" : [requestEncoder.default(r) for r in _request_search( polygon=bboxContour,
-                                                                                   date=offer_start_time,
-                                                                                   fuzziness=offer_fuzziness )] }
+    cursor = postData.get( 'cursor' )
+    ride_requests, next_cursor = paginate_list( _request_search( polygon=bboxContour,
+                                                                 date=offer_start_time,
+                                                                 fuzziness=offer_fuzziness,
+                                                                 after=decode_cursor(cursor),
+                                                                 limit=page_size() + 1 ),
+                                                cursor )
+    prefetch_profiles( ride_requests )
+    requests = { "requests" : [requestEncoder.default(r) for r in ride_requests],
+                 "next" : next_cursor }
     return HttpResponse( json.dumps(requests), mimetype='application/json' )
 
 def request_search_and_display( request ):
@@ -583,52 +785,133 @@ def request_search_and_display( request ):
     '''
     form = RideRequestOfferSearchForm( request.POST )
     if form.is_valid():
-        rectangles = json.loads( form.cleaned_data['polygon'] )['rectangles']
-        bboxArea, bboxContour = _merge_boxes( rectangles )
+        try:
+            bboxArea, bboxContour = _route_polygon( json.loads(form.cleaned_data['polygon']) )
+        except RouteError as e:
+            return HttpResponseBadRequest( str(e) )
 
         offer_start_time = form.cleaned_data['date']
         offer_fuzziness = form.cleaned_data['fuzziness']
 
-        requestEncoder = RideRequestEncoder()
-        ride_requests =  _request_search( polygon=bboxContour,
-                                          date=offer_start_time,
-                                          fuzziness=offer_fuzziness )
-        # Filter out outdated requests
-        ride_requests = [r for r in ride_requests if r.date >= datetime.now()]
+        # Leave out outdated requests
+        cursor = request.POST.get( 'cursor' )
+        ride_requests = _request_search( polygon=bboxContour,
+                                         date=offer_start_time,
+                                         fuzziness=offer_fuzziness,
+                                         other_filters={'date__gte':datetime.now()},
+                                         after=decode_cursor(cursor),
+                                         limit=page_size() + 1 )
+        ride_requests, next_cursor = paginate_list( ride_requests, cursor )
+        prefetch_profiles( ride_requests )
+        page_params = _page_params( request )
         return _browse( request, locals() )
 
     return render_to_response( "index.html",
                                locals(),
                                context_instance=RequestContext(request) )
 
+def _bulk_search_criteria( search, coordinates=() ):
+    '''
+    The criteria of <search>, one of the searches posted to bulk_search: its date,
+    fuzziness and each of <coordinates>, and the (date, id) to start after from its
+    cursor. Raises ValueError if any of them is missing or isn't of the right kind.
+    '''
+    if search.get( 'fuzziness' ) not in FUZZINESS:
+        raise ValueError( "fuzziness must be one of %s"%", ".join(FUZZINESS) )
+    try:
+        criteria = dict( (key, float(search[key])) for key in coordinates )
+        date = datetime.fromtimestamp( float(search['start_time'])/1000 )
+    except (KeyError, TypeError, ValueError, OverflowError):
+        raise ValueError( "Each search needs %s as numbers"%", ".join(('start_time',) + coordinates) )
+    if any( math.isnan(value) or math.isinf(value) for value in criteria.values() ):
+        raise ValueError( "%s must be finite"%", ".join(coordinates) )
+    criteria.update( date=date, fuzziness=search['fuzziness'], after=decode_cursor(search.get('cursor')) )
+    return criteria
+
+@require_POST
+def bulk_search( request ):
+    '''
+    Runs many searches in one call. The POST body is JSON:
+
+    { "offer_searches" : [ {"start_lat", "start_lng", "end_lat", "end_lng",
+                            "start_time", "fuzziness"}, ... ],
+      "request_searches" : [ {"polyline" and "distance", or "rectangles",
+                              "start_time", "fuzziness"}, ... ] }
+
+    where start_time is in milliseconds since the epoch. Any search may also have a
+    "cursor" from an earlier call, to get the next page of its results. Returns JSON
+    with the same keys, holding a page of the matching RideOffers/RideRequests for each
+    search, in order, and "offer_searches_next"/"request_searches_next" holding the
+    cursor for the next page of each (null on the last page).
+
+    Each kind of search may be made at most MAX_BULK_SEARCHES times in one call.
+    Anything else is answered with 400 Bad Request.
+    '''
+    try:
+        postData = json.loads( request.raw_post_data )
+    except ValueError:
+        return HttpResponseBadRequest( "The body must be JSON" )
+    if not isinstance( postData, dict ):
+        return HttpResponseBadRequest( "The body must be a JSON object" )
+    for kind in ('offer_searches', 'request_searches'):
+        searches = postData.get( kind, [] )
+        if not isinstance( searches, list ) or not all( isinstance(search, dict) for search in searches ):
+            return HttpResponseBadRequest( "%s must be a list of objects"%kind )
+        if len(searches) > settings.MAX_BULK_SEARCHES:
+            return HttpResponseBadRequest( "At most %d searches of each kind"%settings.MAX_BULK_SEARCHES )
+
+    try:
+        offer_searches = [_bulk_search_criteria( search, ('start_lat', 'start_lng', 'end_lat', 'end_lng') )
+                          for search in postData.get('offer_searches', [])]
+        request_searches = [dict( _bulk_search_criteria( search ), polygon=_route_polygon( search )[1] )
+                            for search in postData.get('request_searches', [])]
+    except ValueError as e:
+        # RouteError is a ValueError too
+        return HttpResponseBadRequest( str(e) )
+
+    offer_pages = [paginate_list( offers, search.get('cursor') )
+                   for offers, search in zip( _offer_search_many(offer_searches), postData.get('offer_searches', []) )]
+    request_pages = [paginate_list( requests, search.get('cursor') )
+                     for requests, search in zip( _request_search_many(request_searches),
+                                                  postData.get('request_searches', []) )]
+    offer_results = [page[0] for page in offer_pages]
+    request_results = [page[0] for page in request_pages]
+    # Load everyone in all of the results at once
+    prefetch_profiles( sum(offer_results, []) + sum(request_results, []) )
+
+    offerEncoder = RideOfferEncoder()
+    requestEncoder = RideRequestEncoder()
+    results = {
+        "offer_searches" : [[offerEncoder.default(o) for o in offers]
+                            for offers in offer_results],
+        "request_searches" : [[requestEncoder.default(r) for r in requests]
+                              for requests in request_results],
+        "offer_searches_next" : [page[1] for page in offer_pages],
+        "request_searches_next" : [page[1] for page in request_pages]
+    }
+    return HttpResponse( json.dumps(results), mimetype='application/json' )
+
 def request_show( request, request_id ):
     ''' Renders a page displaying more information about a particular RideRequest '''
 
-    ride_request = get_mongo_or_404( RideRequest, pk=ObjectId(request_id) )
+    ride_request = get_mongo_or_404( project(RideRequest.objects, 'detail'), pk=ObjectId(request_id) )
 
     # This information is used in the template to determine if the user has already
     # offered a ride to this RideRequest
-    user_profile = request.session.get("profile")
-    def is_driver():
-        if not ride_request.ride_offer:
+    user_profile = request.profile
+    def has_offered():
+        # Look at the drivers of the offers made to this request, without loading
+        # the offers and their routes
+        offers = reference_ids( ride_request, 'askers' ) + reference_ids( ride_request, 'ride_offer' )
+        if not user_profile or not offers:
             return False
-        return user_profile == ride_request.ride_offer.driver
-    if not user_profile in ride_request.askers and user_profile != ride_request.passenger and not is_driver():
+        return RideOffer.objects.filter( id__in=offers, driver=user_profile ).count() > 0
+    if reference_id( ride_request._data['passenger'] ) != getattr( user_profile, 'id', None ) and not has_offered():
         # Find RideOffers the logged-in user has made that would work well with this request
         if user_profile:
-            # TODO: Make this neater?
-            searchParams = {}
-            searchParams['start_lat'],searchParams['start_lng'] = ride_request.start.position
-            searchParams['end_lat'],searchParams['end_lng'] = ride_request.end.position
-            searchParams['date'] = ride_request.date
-            searchParams['fuzziness'] = ride_request.fuzziness
-
-            import sys
-            sys.stderr.write("my other offers: %s\n"%str([offer for offer in user_profile.offers]))
-
-            searchParams['other_filters'] = { 'id__in' : tuple([offer.id for offer in user_profile.offers]) }
-
-            offers = _offer_search( **searchParams )
+            matches = RideMatch.objects.filter( request=ride_request, driver=user_profile ).only( 'offer' )
+            offers = project( RideOffer.objects.filter( id__in=[reference_id(m._data['offer']) for m in matches] ),
+                              'list' )
             offers = [(str(offer.id),str(offer)) for offer in offers]
             form = OfferRideForm(initial={'request_id':request_id},
                                  offer_choices=offers)
@@ -640,27 +923,25 @@ def request_show( request, request_id ):
 def offer_show( request, offer_id ):
     ''' Renders a page displaying more information about a particular RideOffer '''
 
-    ride_offer = get_mongo_or_404( RideOffer, pk=ObjectId(offer_id) )
+    ride_offer = get_mongo_or_404( project(RideOffer.objects, 'detail'), pk=ObjectId(offer_id) )
 
     # This information is used in the template to determine if the user has already
     # requested a ride from this RideOffer
-    user_profile = request.session.get("profile")
-    if not user_profile in ride_offer.askers+ride_offer.passengers and user_profile != ride_offer.driver:
+    user_profile = request.profile
+    def has_asked():
+        if not user_profile:
+            return False
+        if user_profile.id in reference_ids( ride_offer, 'passengers' ):
+            return True
+        requests = reference_ids( ride_offer, 'askers' )
+        return requests and RideRequest.objects.filter( id__in=requests, passenger=user_profile ).count() > 0
+    if reference_id( ride_offer._data['driver'] ) != getattr( user_profile, 'id', None ) and not has_asked():
 
         # Find RideOffers the logged-in user has made that would work well with this request
         if user_profile:
-            searchParams = {
-                'polygon': ride_offer.polygon,
-                'date': ride_offer.date,
-                'fuzziness': ride_offer.fuzziness,
-                'other_filters': {'passenger':user_profile}
-            }
-
-            requests = _request_search( **searchParams )
-
-            import sys
-            sys.stderr.write("request search in offer_show returned the following: %s"%str(requests))
-
+            matches = RideMatch.objects.filter( offer=ride_offer, passenger=user_profile ).only( 'request' )
+            requests = project( RideRequest.objects.filter( id__in=[reference_id(m._data['request']) for m in matches] ),
+                                'list' )
             requests = [(str(req.id),str(req)) for req in requests]
             form = AskForRideForm(initial={'offer_id':offer_id},
                                   request_choices=requests)
@@ -672,6 +953,11 @@ def offer_show( request, offer_id ):
 # BROWSING #
 ############
 
+def _page_params( request ):
+    ''' The search parameters posted in <request>, to be posted again for the next page '''
+    return [(name, value) for name, value in request.POST.items()
+            if name not in ('cursor', 'csrfmiddlewaretoken')]
+
 def _browse( request, context ):
     if not 'offer_form' in context:
         offer_form = RideOfferPutForm()
@@ -686,11 +972,15 @@ def _browse( request, context ):
 
 def browse( request ):
     '''
-    Lists all RideRequests and RideOffers and renders them into "browse.html"
+    Lists upcoming RideRequests and RideOffers, a page at a time, and renders them into "browse.html"
 
     '''
-    ride_requests = RideRequest.objects.filter( date__gte=datetime.now(), ride_offer=None )
-    ride_offers = RideOffer.objects.filter( date__gte=datetime.now() )
+    cursor = request.GET.get( 'cursor' )
+    (ride_requests, ride_offers), next_cursor = paginate_together(
+        [project( RideRequest.objects.filter( date__gte=datetime.now(), ride_offer=None ), 'list' ),
+         project( RideOffer.objects.filter( date__gte=datetime.now() ), 'list' )], cursor )
+    # The page shows who posted each ride, so load them all up front
+    prefetch_profiles( ride_requests + ride_offers )
 
     return _browse( request, locals() )
 
@@ -716,7 +1006,7 @@ def cancel_ride(request, ride_id):
         rider = None
 
     # confirm correct user
-    profile = request.session.get('profile')
+    profile = request.profile
     if not profile in (driver,rider):
         raise PermissionDenied
 
@@ -740,28 +1030,23 @@ def cancel_ride(request, ride_id):
 
             if req is not None:
                 reason_msg = data['reason']
-                email_message = render_message( "taxi/static/emails/passenger_cancelled.txt", locals() )
-                if req.offer:
+                offer = req.ride_offer
+                if offer:
+                    email_message = render_message( "taxi/static/emails/passenger_cancelled.txt", locals() )
                     send_email(
                         email_subject='Rider Cancellation',
-                        email_to=req.offer.driver.user.username,
+                        email_to=offer.driver.user.username,
                         email_body=email_message
                     )
-                #user_id = req.
                 req.delete()
             elif offer is not None:
                 reason_msg = data['reason']
-                for passenger in offer.passengers:
-                    email_message = render_message( "taxi/static/emails/driver_cancelled.txt", locals() )
-                    send_email(
-                        email_subject='Ride Cancellation',
-                        email_to=passenger.user.username,
-                        email_body=email_message
-                    )
-
-                for each_ride in RideRequest.objects.filter(ride_offer=offer):
-                    each_ride.ride_offer = None
-                    each_ride.save()
+                # Email every passenger at once, and let go of their requests with one update
+                passengers = prefetch_profiles( [offer], ('passengers',) )[0].passengers
+                send_message_emails( "taxi/static/emails/driver_cancelled.txt", 'Ride Cancellation',
+                                     [(passenger.user.username, {'passenger':passenger}) for passenger in passengers],
+                                     locals() )
+                RideRequest.objects.filter( ride_offer=offer ).update( set__ride_offer=None )
                 offer.delete()
 
             return HttpResponseRedirect( reverse('user_landing') )
@@ -788,7 +1073,7 @@ def process_request_update(request, request_id):
     ride_request = get_mongo_or_404( RideRequest, pk=ObjectId(request_id) )
 
     # confirm correct user
-    if not request.session.get('profile') == RideRequest.objects.get(pk=ObjectId(request_id)).passenger:
+    if not request.profile == ride_request.passenger:
         raise PermissionDenied
 
     if request.method == 'POST':
@@ -805,8 +1090,8 @@ def process_request_update(request, request_id):
 
             return render_to_response('request_options.html', locals(), context_instance=RequestContext(request))
 
-    if RideRequest.objects.get(pk=ObjectId(request_id)).message:
-        message = RideRequest.objects.get(pk=ObjectId(request_id))
+    if ride_request.message:
+        message = ride_request.message
         form = RequestOptionsForm(initial={'request_id':request_id, 'message':message})
     else:
         form = RequestOptionsForm(initial={'request_id':request_id})
@@ -822,7 +1107,7 @@ def process_offer_update(request, offer_id):
     ride_offer = get_mongo_or_404( RideOffer, pk=ObjectId(offer_id) )
 
     # Confirm correct user
-    if not request.session.get('profile') == RideOffer.objects.get(pk=ObjectId(offer_id)).driver:
+    if not request.profile == ride_offer.driver:
         raise PermissionDenied
 
     if request.method =='POST':
@@ -831,7 +1116,6 @@ def process_offer_update(request, offer_id):
         # Form validates
         if form.is_valid():
             data = form.cleaned_data
-            ride_offer = RideOffer.objects.get(pk=ObjectId(data['offer_id']))
 
             # Parse out the form and update RideOffer
             if data['message']:
@@ -859,8 +1143,15 @@ def userprofile_show( request, user_id ):
     ''' Shows all RideRequests and RideOffers for a particular user '''
 
     profile = get_mongo_or_404(UserProfile, pk=user_id)
-    my_offers = RideOffer.objects.filter( driver=profile, completed=False )
-    my_requests = RideRequest.objects.filter( passenger=profile )
+    my_offers = project( RideOffer.objects.filter( driver=profile, completed=False ), 'detail' )
+    my_requests = project( RideRequest.objects.filter( passenger=profile ), 'detail' )
+    # Rides from long ago have been archived
+    my_offers = list( my_offers ) + archived( RideOffer, raw_projection( RideOffer, 'detail' ),
+                                              settings.ARCHIVE_HISTORY_SIZE,
+                                              driver=profile.id, completed=False )
+    my_requests = list( my_requests ) + archived( RideRequest, raw_projection( RideRequest, 'detail' ),
+                                                  settings.ARCHIVE_HISTORY_SIZE,
+                                                  passenger=profile.id )
 
     rides_requested, rides_offered, ride_requests_completed, ride_offers_completed = [], [], [], []
     now = datetime.now()
@@ -878,7 +1169,7 @@ def userprofile_show( request, user_id ):
             rides_offered.append( o )
 
     # Show the user their home page if they are the logged-in user
-    if request.session.get('profile') == profile:
+    if request.profile == profile:
         return render_to_response( "user_home.html", locals(), context_instance=RequestContext(request) )
 
     # Put other context variables for a user's home page here...
@@ -888,7 +1179,24 @@ def userprofile_show( request, user_id ):
 def user_landing( request ):
     ''' Shows all RideRequests and RideOffers for the logged-in user.
     user_id is the id of the User, not of the Profile'''
-    return userprofile_show( request, request.session.get("profile").id )
+    if request.profile is None:
+        raise Http404
+    return userprofile_show( request, request.profile.id )
+
+@login_required
+def digest_toggle( request ):
+    ''' Turns digest mode (see digest.py) on or off for the logged-in user '''
+    if request.method == 'POST':
+        profile = request.profile
+        profile.digest = request.POST.get( 'digest' ) == 'on'
+        profile.save()
+        if profile.digest:
+            messages.add_message( request, messages.SUCCESS, "News about your rides will come in a digest." )
+        else:
+            # Don't keep back what was waiting for the next digest
+            digest.flush( recipient=profile )
+            messages.add_message( request, messages.SUCCESS, "News about your rides will be emailed right away." )
+    return HttpResponseRedirect( reverse('user_landing') )
 
 
 ###########
@@ -901,7 +1209,7 @@ def driver_feedback( request, offer_id ):
 
     # Submitting feedback
     if request.method == 'POST':
-        profile = request.session.get("profile")
+        profile = request.profile
         def fail( msg ):
             ''' What to do when we get an error '''
             messages.add_message( request, messages.ERROR, msg )
@@ -914,6 +1222,8 @@ def driver_feedback( request, offer_id ):
         if offer.completed:
             return fail( "You have already left feedback for that trip." )
 
+        # Load the passengers and their users in two queries, rather than two each
+        prefetch_profiles( [offer], ('passengers',) )
         form = DriverFeedbackForm( offer, request.POST )
         if form.is_valid():
             data = form.cleaned_data
@@ -925,33 +1235,33 @@ def driver_feedback( request, offer_id ):
             if form_ids != actual_ids:
                 return fail( "Cannot leave feedback on that trip because the feedback left for one or more passengers was invalid." )
 
-            # Increment trust rating for all passengers, and send emails
+            # Increment trust rating for all passengers, and send emails, all at once
+            by_id = dict( (str(p.id), p) for p in offer.passengers )
+            trust = {}
+            emails = []
             for name, val in passengers.iteritems():
-                passenger = UserProfile.objects.get( pk=ObjectId(name.split("_")[1]) )
-                trust = Trust(message=val, truster=profile, offer=offer)
-                if len(passenger.trust) == 0:
-                    passenger.trust = [trust]
+                passenger = by_id[name.split("_")[1]]
+                trust[passenger] = val
+
+                if len(group_message) > 0 and len(val)>0:
+                    email_body = "%s\r\n\r\nAdditionally, your driver says:\r\n\r\n%s"%(
+                        group_message,
+                        val
+                    )
+                elif len(group_message) > 0:
+                    email_body = group_message
+                elif len(val) > 0:
+                    email_body = val
                 else:
-                    passenger.trust.append(trust)
-                passenger.save()
-
-                if len(group_message) > 0 or len(val) > 0:
-                    if len(group_message) > 0 and len(val)>0:
-                        email_body = "%s\r\n\r\nAdditionally, your driver says:\r\n\r\n%s"%(
-                            group_message,
-                            val
-                        )
-                    elif len(group_message) > 0:
-                        email_body = group_message
-                    elif len(val) > 0:
-                        email_body = val
-                send_email( email_to=passenger.user.username,
-                            email_subject="Correspondence on your trip %s"%str(offer),
-                            email_body=email_body )
+                    continue
+                emails.append( dict( email_to=passenger.user.username,
+                                     email_subject="Correspondence on your trip %s"%str(offer),
+                                     email_body=email_body ) )
+            repository.add_trusts( profile, offer, trust )
+            send_emails( emails )
 
             # Mark this trip as having been reviewed already
-            offer.completed = True
-            offer.save()
+            RideOffer.objects( id=offer.id ).update_one( set__completed=True )
 
             messages.add_message( request, messages.SUCCESS, "Your correspondence has been recorded." )
             return HttpResponseRedirect( reverse('user_landing') )
@@ -964,7 +1274,7 @@ def driver_feedback( request, offer_id ):
 def rider_feedback(request, request_id):
 
     # confirm correct user
-    profile = request.session.get('profile')
+    profile = request.profile
     if profile != RideRequest.objects.get(pk=ObjectId(request_id)).passenger:
         raise PermissionDenied
 